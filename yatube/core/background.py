@@ -0,0 +1,49 @@
+"""Фоновые задания в пуле процессов.
+
+Работа, которую не должен ждать пользователь (миниатюры, перенос постов в
+ленты), отправляется в пул после коммита. Размер пула задаёт настройка:
+BACKGROUND_WORKERS для прочих заданий, THUMBNAIL_WORKERS для миниатюр,
+чтобы долгий перенос не задерживал картинки. Пул создаётся лениво, по
+одному на настройку и процесс; при нуле процессов задание выполняется
+сразу.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+
+
+def pool(workers):
+    """Пул процессов с настроенным Django."""
+    # spawn, а не fork: дочерний процесс не должен унаследовать
+    # открытые соединения с базой
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=django.setup,
+    )
+
+
+_executors = {}
+_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    with _lock:
+        if workers not in _executors:
+            _executors[workers] = pool(getattr(settings, workers))
+        return _executors[workers]
+
+
+def submit(func, *args, workers='BACKGROUND_WORKERS'):
+    """Выполняет func(*args) в пуле из settings.<workers> процессов.
+
+    func должна быть уровня модуля. Возвращает Future или None, если
+    задание уже выполнено в этом процессе.
+    """
+    if not getattr(settings, workers):
+        func(*args)
+        return None
+    return _get_executor(workers).submit(func, *args)
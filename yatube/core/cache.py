@@ -0,0 +1,229 @@
+"""Двухуровневый кеш: LRU в памяти процесса перед общим бэкендом.
+
+L1 — ограниченный по объёму LRU с коротким TTL, L2 — общий для всех
+процессов бэкенд из CACHES (alias в OPTIONS['L2']). Записи проходят в оба
+уровня, чтение сначала идёт в L1. Удаление в одном процессе не видно в L1
+других процессов, поэтому инвалидация строится на ключах версий: ключи с
+префиксами из OPTIONS['L2_ONLY_PREFIXES'] (версии, блокировки) в L1 не
+попадают и всегда читаются из L2, а данные кешируются под ключами, в
+которые входит версия.
+
+add() атомарен между процессами: из двух одновременных add одного ключа
+успешен ровно один. В memcached и Redis это делает сам бэкенд, а у
+FileBasedCache add — это has_key и затем set, поэтому он выполняется под
+файлом-замком, созданным с O_EXCL. Замок защищает только add от add:
+set() того же ключа может перезаписать значение в любой момент. Замок,
+оставшийся от упавшего процесса, считается брошенным через
+OPTIONS['ADD_LOCK_TIMEOUT'] секунд.
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'core.cache.TwoTierCache',
+            'OPTIONS': {
+                'L2': 'shared',
+                'L1_TIMEOUT': 5,
+                'L1_MAX_BYTES': 32 * 1024 * 1024,
+                'L2_ONLY_PREFIXES': ('posts:version:', 'posts:lock:'),
+                'ADD_LOCK_TIMEOUT': 10,
+            },
+        },
+        'shared': {...},
+    }
+"""
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from contextlib import suppress
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.filebased import FileBasedCache
+
+
+class _LRU:
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+
+# caches в Django потоко-локальный, а L1 должен быть общим на процесс
+_l1_stores = {}
+_l1_stores_lock = threading.Lock()
+
+
+class TwoTierCache(BaseCache):
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._l2_alias = options.get('L2', 'shared')
+        self._l1_timeout = options.get('L1_TIMEOUT', 5)
+        self._l1_max_bytes = options.get('L1_MAX_BYTES', 32 * 1024 * 1024)
+        self._l2_only = tuple(options.get('L2_ONLY_PREFIXES', ()))
+        self._add_lock_timeout = options.get('ADD_LOCK_TIMEOUT', 10)
+        with _l1_stores_lock:
+            store = _l1_stores.setdefault(location or self._l2_alias, _LRU())
+        self._l1 = store.entries
+        self._store = store
+        self._lock = store.lock
+
+    @property
+    def l2(self):
+        return caches[self._l2_alias]
+
+    def _local(self, key):
+        return not key.startswith(self._l2_only)
+
+    # L1
+
+    def _l1_get(self, key):
+        with self._lock:
+            entry = self._l1.get(key)
+            if entry is None:
+                return None
+            expires_at, pickled = entry
+            if expires_at <= time.monotonic():
+                self._l1_delete(key)
+                return None
+            self._l1.move_to_end(key)
+        return pickled
+
+    def _l1_set(self, key, value, timeout):
+        if timeout is not DEFAULT_TIMEOUT and timeout is not None:
+            if timeout <= 0:
+                self._l1_discard(key)
+                return
+            ttl = min(timeout, self._l1_timeout)
+        else:
+            ttl = self._l1_timeout
+        pickled = pickle.dumps(value, self.pickle_protocol)
+        if len(pickled) > self._l1_max_bytes:
+            self._l1_discard(key)
+            return
+        with self._lock:
+            self._l1_delete(key)
+            self._l1[key] = (time.monotonic() + ttl, pickled)
+            self._store.bytes += len(pickled)
+            while self._store.bytes > self._l1_max_bytes:
+                _, (_, evicted) = self._l1.popitem(last=False)
+                self._store.bytes -= len(evicted)
+
+    def _l1_delete(self, key):
+        entry = self._l1.pop(key, None)
+        if entry is not None:
+            self._store.bytes -= len(entry[1])
+
+    def _l1_discard(self, key):
+        with self._lock:
+            self._l1_delete(key)
+
+    # L2
+
+    def _l2_add(self, key, value, timeout):
+        l2 = self.l2
+        if not isinstance(l2, FileBasedCache):
+            return l2.add(key, value, timeout)
+        os.makedirs(l2._dir, exist_ok=True)
+        lock = l2._key_to_file(key) + '.lock'
+        for attempt in range(2):
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                # замок держит другой add: ключ уже добавляют
+                if attempt or not self._abandoned(lock):
+                    return False
+                with suppress(FileNotFoundError):
+                    os.remove(lock)
+                continue
+            try:
+                return l2.add(key, value, timeout)
+            finally:
+                with suppress(FileNotFoundError):
+                    os.remove(lock)
+        return False
+
+    def _abandoned(self, lock):
+        try:
+            age = time.time() - os.path.getmtime(lock)
+        except FileNotFoundError:
+            return True
+        return age > self._add_lock_timeout
+
+    # API кеша
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local = self._local(key)
+        key = self.make_key(key, version=version)
+        added = self._l2_add(key, value, timeout)
+        if added and local:
+            self._l1_set(key, value, timeout)
+        return added
+
+    def get(self, key, default=None, version=None):
+        local = self._local(key)
+        key = self.make_key(key, version=version)
+        if local:
+            pickled = self._l1_get(key)
+            if pickled is not None:
+                return pickle.loads(pickled)
+        missing = object()
+        value = self.l2.get(key, missing)
+        if value is missing:
+            return default
+        if local:
+            self._l1_set(key, value, DEFAULT_TIMEOUT)
+        return value
+
+    def get_many(self, keys, version=None):
+        # промахи L1 добираются из L2 одним обращением
+        found = {}
+        remote = {}
+        for key in keys:
+            made = self.make_key(key, version=version)
+            pickled = self._l1_get(made) if self._local(key) else None
+            if pickled is not None:
+                found[key] = pickle.loads(pickled)
+            else:
+                remote[made] = key
+        if remote:
+            for made, value in self.l2.get_many(list(remote)).items():
+                key = remote[made]
+                found[key] = value
+                if self._local(key):
+                    self._l1_set(made, value, DEFAULT_TIMEOUT)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local = self._local(key)
+        key = self.make_key(key, version=version)
+        self.l2.set(key, value, timeout)
+        if local:
+            self._l1_set(key, value, timeout)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self._l1_discard(key)
+        return self.l2.touch(key, timeout)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self._l1_discard(key)
+        self.l2.delete(key)
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        self._l1_discard(key)
+        return self.l2.incr(key, delta)
+
+    def has_key(self, key, version=None):
+        return self.get(key, self, version=version) is not self
+
+    def clear(self):
+        with self._lock:
+            self._l1.clear()
+            self._store.bytes = 0
+        self.l2.clear()
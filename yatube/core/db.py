@@ -0,0 +1,30 @@
+"""Настройка соединений SQLite под конкурентную нагрузку.
+
+На каждом новом соединении выполняются PRAGMA из SQLITE_PRAGMAS: WAL
+позволяет читать параллельно с записью, synchronous=NORMAL в режиме WAL
+не теряет согласованность при сбое процесса, busy_timeout заставляет
+писателя подождать блокировку вместо мгновенного 'database is locked'.
+Соединения между запросами переиспользуются через CONN_MAX_AGE.
+"""
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+def apply_pragmas(cursor, pragmas):
+    # busy_timeout первым: смене journal_mode тоже нужна блокировка
+    for name in sorted(pragmas, key=lambda name: name != 'busy_timeout'):
+        cursor.execute(f'PRAGMA {name} = {pragmas[name]}')
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    # курсор драйвера, а не Django: настройка соединения не запрос
+    # пользователя и не должна попадать в учёт и бюджеты запросов
+    cursor = connection.connection.cursor()
+    try:
+        apply_pragmas(cursor, settings.SQLITE_PRAGMAS)
+    finally:
+        cursor.close()
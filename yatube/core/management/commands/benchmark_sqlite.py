@@ -0,0 +1,133 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.db import apply_pragmas
+
+SCHEMA = '''
+    CREATE TABLE post (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        author_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        pub_date REAL NOT NULL
+    );
+    CREATE INDEX post_author_pub_date ON post (author_id, pub_date DESC);
+'''
+READ = ('SELECT id, text FROM post WHERE author_id = ? '
+        'ORDER BY pub_date DESC LIMIT 10')
+WRITE = 'INSERT INTO post (author_id, text, pub_date) VALUES (?, ?, ?)'
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает конкурентное чтение и запись в SQLite без настроек '
+            'и с SQLITE_PRAGMAS, а также цену нового соединения на запрос')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument(
+            '--duration', type=float, default=3,
+            help='Секунды нагрузки на каждый режим',
+        )
+        parser.add_argument('--rows', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp(prefix='yatube-bench-')
+        try:
+            for title, pragmas in (
+                ('по умолчанию', {}),
+                ('SQLITE_PRAGMAS', settings.SQLITE_PRAGMAS),
+            ):
+                path = os.path.join(directory, f'{len(pragmas)}.sqlite3')
+                self.prepare(path, options['rows'])
+                self.report_concurrency(title, path, pragmas, options)
+                self.report_connections(title, path, pragmas)
+        finally:
+            shutil.rmtree(directory)
+
+    def connect(self, path, pragmas):
+        # как в Django: таймаут блокировки по умолчанию, автокоммит
+        connection = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False)
+        apply_pragmas(connection.cursor(), pragmas)
+        return connection
+
+    def prepare(self, path, rows):
+        connection = sqlite3.connect(path)
+        connection.executescript(SCHEMA)
+        connection.executemany(WRITE, (
+            (number % 100, f'Post {number}', number) for number in range(rows)
+        ))
+        connection.commit()
+        connection.close()
+
+    def report_concurrency(self, title, path, pragmas, options):
+        stats = {'read': 0, 'write': 0, 'locked': 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + options['duration']
+
+        def worker(kind, number):
+            connection = self.connect(path, pragmas)
+            done = locked = 0
+            while time.monotonic() < deadline:
+                try:
+                    if kind == 'read':
+                        connection.execute(READ, (number % 100,)).fetchall()
+                    else:
+                        connection.execute('BEGIN IMMEDIATE')
+                        connection.execute(
+                            WRITE, (number, 'Benchmark', time.time()))
+                        connection.execute('COMMIT')
+                    done += 1
+                except sqlite3.OperationalError:
+                    if connection.in_transaction:
+                        connection.execute('ROLLBACK')
+                    locked += 1
+                number += 1
+            connection.close()
+            with lock:
+                stats[kind] += done
+                stats['locked'] += locked
+
+        threads = [
+            threading.Thread(target=worker, args=('read', number))
+            for number in range(options['readers'])
+        ] + [
+            threading.Thread(target=worker, args=('write', number))
+            for number in range(options['writers'])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = options['duration']
+        self.stdout.write(
+            f'{title}: чтений/с {stats["read"] / duration:.0f}, '
+            f'записей/с {stats["write"] / duration:.0f}, '
+            f'ошибок блокировки {stats["locked"]}'
+        )
+
+    def report_connections(self, title, path, pragmas, requests=500):
+        started = time.perf_counter()
+        for number in range(requests):
+            connection = self.connect(path, pragmas)
+            connection.execute(READ, (number % 100,)).fetchall()
+            connection.close()
+        per_request = time.perf_counter() - started
+        connection = self.connect(path, pragmas)
+        started = time.perf_counter()
+        for number in range(requests):
+            connection.execute(READ, (number % 100,)).fetchall()
+        persistent = time.perf_counter() - started
+        connection.close()
+        self.stdout.write(
+            f'{title}: запрос с новым соединением '
+            f'{per_request / requests * 1e6:.0f} мкс, '
+            f'с постоянным {persistent / requests * 1e6:.0f} мкс'
+        )
@@ -0,0 +1,70 @@
+import logging
+
+from django.conf import settings
+
+from .queries import QueryBudgetExceeded, record_queries
+from .routers import pinned_to_primary
+
+logger = logging.getLogger('core.queries')
+
+
+class QueryCountMiddleware:
+    """Считает SQL-запросы каждого запроса и сверяет их с бюджетом."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.query_budget = None
+        with record_queries() as recorder:
+            response = self.get_response(request)
+        request.query_stats = recorder.summary()
+        self.report(request, response, recorder)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = getattr(view_func, 'query_budget', None)
+
+    def report(self, request, response, recorder):
+        budget = request.query_budget
+        message = '%s %s: %d queries, %.1f ms, %d duplicates'
+        args = (request.method, request.path, recorder.count,
+                recorder.duration * 1000, recorder.duplicates)
+        if budget is not None and recorder.count > budget:
+            logger.warning(message + ' (budget %d)', *args, budget)
+            if settings.QUERY_BUDGET_STRICT:
+                raise QueryBudgetExceeded(
+                    f'{request.path}: {recorder.count} queries, '
+                    f'budget {budget}')
+        else:
+            logger.debug(message, *args)
+        if settings.DEBUG:
+            response['X-Query-Count'] = str(recorder.count)
+            response['X-Query-Time-Ms'] = f'{recorder.duration * 1000:.1f}'
+            response['X-Query-Duplicates'] = str(recorder.duplicates)
+
+
+class ReplicaPinMiddleware:
+    """Read-your-writes: изменяющий запрос и запросы того же клиента в
+    течение REPLICA_PIN_SECONDS после него читают с основной базы."""
+
+    cookie_name = 'pin_primary'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return self.get_response(request)
+        writes = request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+        if not writes and self.cookie_name not in request.COOKIES:
+            return self.get_response(request)
+        with pinned_to_primary():
+            response = self.get_response(request)
+        if writes:
+            response.set_cookie(
+                self.cookie_name, '1',
+                max_age=settings.REPLICA_PIN_SECONDS,
+                httponly=True, samesite='Lax',
+            )
+        return response
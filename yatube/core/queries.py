@@ -0,0 +1,67 @@
+"""Учёт SQL-запросов на запрос пользователя и бюджеты для представлений.
+
+Представление объявляет бюджет декоратором @query_budget(n), а
+QueryCountMiddleware считает запросы, время в БД и повторы, пишет их в
+лог, а при DEBUG — в заголовки ответа.
+"""
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.db import connections
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(limit):
+    """Объявляет максимальное число SQL-запросов для представления."""
+    def decorator(view_func):
+        view_func.query_budget = limit
+        return view_func
+    return decorator
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append(
+                (sql, repr(params), time.perf_counter() - started))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(duration for _, _, duration in self.queries)
+
+    @property
+    def duplicates(self):
+        """Сколько запросов повторили уже выполненный (тот же SQL и
+        параметры) — верный признак N+1 или отсутствия кеша."""
+        seen = Counter((sql, params) for sql, params, _ in self.queries)
+        return sum(times - 1 for times in seen.values())
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'duration': self.duration,
+            'duplicates': self.duplicates,
+        }
+
+
+@contextmanager
+def record_queries():
+    recorder = QueryRecorder()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield recorder
@@ -0,0 +1,85 @@
+"""Чтение с реплик для представлений, которые только читают.
+
+Алиасы реплик перечислены в DATABASE_REPLICAS. С реплики читают только
+представления, помеченные @replica_reads, и только пока запрос не
+закреплён за основной базой (pinned_to_primary): ReplicaPinMiddleware
+закрепляет изменяющие запросы и следующие за ними запросы того же
+клиента, чтобы он сразу видел свои изменения. Запись всегда идёт в
+default.
+
+Кешированное значение, прочитанное с реплики, живёт не дольше
+REPLICA_PIN_SECONDS (replica_timeout): реплика могла ещё не догнать
+запись, сдвинувшую версию ключа, но за это время догоняет.
+"""
+import random
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+_state = threading.local()
+
+
+@contextmanager
+def _override(name):
+    previous = getattr(_state, name, False)
+    setattr(_state, name, True)
+    try:
+        yield
+    finally:
+        setattr(_state, name, previous)
+
+
+def replica_reads(view_func):
+    """Разрешает представлению читать с реплики."""
+    @wraps(view_func)
+    def wrapper(*args, **kwargs):
+        with _override('replica'):
+            return view_func(*args, **kwargs)
+    return wrapper
+
+
+def pinned_to_primary():
+    """Контекст, внутри которого все чтения идут в основную базу."""
+    return _override('pinned')
+
+
+def reads_from_replica():
+    """Идут ли чтения в текущем контексте на реплику."""
+    return bool(settings.DATABASE_REPLICAS
+                and getattr(_state, 'replica', False)
+                and not getattr(_state, 'pinned', False))
+
+
+def replica_timeout(timeout):
+    """TTL кеша для значения, прочитанного в текущем контексте."""
+    if not reads_from_replica():
+        return timeout
+    if timeout is None:
+        return settings.REPLICA_PIN_SECONDS
+    return min(timeout, settings.REPLICA_PIN_SECONDS)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if reads_from_replica():
+            return random.choice(settings.DATABASE_REPLICAS)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # на репликах те же данные, что и в основной базе
+        aliases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if {obj1._state.db, obj2._state.db} <= aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        # схема попадает на реплики вместе с репликацией
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
@@ -0,0 +1,65 @@
+import copy
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class QueryBudgetMixin:
+    """Для TestCase: проверяет, что представления укладываются в бюджет.
+
+    Ответы тестового клиента несут статистику запросов, собранную
+    QueryCountMiddleware; бюджет объявляется декоратором @query_budget.
+    """
+
+    def assertWithinQueryBudget(self, response):
+        request = response.wsgi_request
+        budget = request.query_budget
+        self.assertIsNotNone(
+            budget, f'{request.path}: для представления не задан бюджет')
+        stats = request.query_stats
+        self.assertLessEqual(
+            stats['count'], budget,
+            f'{request.path}: {stats["count"]} запросов при бюджете {budget}')
+        return stats
+
+    def strict_query_budget(self):
+        """Превышение бюджета приводит к исключению прямо в запросе."""
+        return override_settings(QUERY_BUDGET_STRICT=True)
+
+
+class TestRunner(DiscoverRunner):
+    """Прогон тестов со строгими бюджетами запросов и файловыми кешами во
+    временном каталоге.
+
+    Превышение @query_budget в тестах — исключение, а не строка в логе.
+    Тесты вызывают cache.clear(), и с настройками по умолчанию это стирало
+    бы кеш разработчика в BASE_DIR/cache. Каталог передаётся и через
+    YATUBE_CACHE_DIR, чтобы его видели процессы фоновых пулов.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_dir = tempfile.mkdtemp(prefix='yatube-test-cache-')
+        caches = copy.deepcopy(settings.CACHES)
+        for name, options in caches.items():
+            if options['BACKEND'].endswith('.FileBasedCache'):
+                options['LOCATION'] = os.path.join(self.cache_dir, name)
+        self.previous_cache_dir = os.environ.get('YATUBE_CACHE_DIR')
+        os.environ['YATUBE_CACHE_DIR'] = os.path.join(
+            self.cache_dir, 'shared')
+        self.test_settings = override_settings(
+            CACHES=caches, QUERY_BUDGET_STRICT=True)
+        self.test_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.test_settings.disable()
+        if self.previous_cache_dir is None:
+            del os.environ['YATUBE_CACHE_DIR']
+        else:
+            os.environ['YATUBE_CACHE_DIR'] = self.previous_cache_dir
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
@@ -1,6 +1,10 @@
 from django.contrib import admin
+from django.contrib.auth import admin as auth_admin, get_user_model
 
-from .models import Group, Post, Comment, Follow
+from . import deletion, search
+from .models import Group, Post, Comment, DeletionJob, Follow
+
+User = get_user_model()
 
 
 class PostAdmin(admin.ModelAdmin):
@@ -13,6 +17,12 @@ class PostAdmin(admin.ModelAdmin):
     list_editable = ('group', 'text')
     empty_value_display = '-пусто-'
 
+    def get_search_results(self, request, queryset, search_term):
+        # полнотекстовый индекс вместо LIKE '%...%' по всей таблице
+        if not search_term:
+            return queryset, False
+        return search.filter_matching(queryset, search_term), False
+
 # При регистрации модели Post источником конфигурации для неё назначаем
 # класс PostAdmin
 
@@ -24,9 +34,53 @@ class GroupAdmin(admin.ModelAdmin):
     search_fields = ('title', 'description')
     # Добавляем возможность фильтрации по дате
     list_editable = ('title', 'description')
+    actions = ('schedule_deletion',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(pending_deletion=False)
+
+    def schedule_deletion(self, request, queryset):
+        for group in queryset:
+            deletion.schedule_group_deletion(group)
+        self.message_user(
+            request, f'Поставлено в очередь на удаление: {len(queryset)}')
+    schedule_deletion.short_description = 'Удалить в фоне'
+
+
+class UserAdmin(auth_admin.UserAdmin):
+    actions = ('schedule_deletion',)
+
+    def schedule_deletion(self, request, queryset):
+        for user in queryset:
+            deletion.schedule_user_deletion(user)
+        self.message_user(
+            request, f'Поставлено в очередь на удаление: {len(queryset)}')
+    schedule_deletion.short_description = 'Удалить в фоне со всеми постами'
+
+
+class DeletionJobAdmin(admin.ModelAdmin):
+    list_display = (
+        'kind', 'label', 'status', 'step', 'processed', 'total', 'progress',
+        'created', 'finished')
+    list_filter = ('status', 'kind')
+    readonly_fields = (
+        'kind', 'object_id', 'label', 'status', 'step', 'processed',
+        'total', 'error', 'created', 'finished')
+
+    def has_add_permission(self, request):
+        return False
+
+    def progress(self, job):
+        return f'{job.progress}%'
+    progress.short_description = 'Прогресс'
 
 
 admin.site.register(Post, PostAdmin)
 admin.site.register(Group, GroupAdmin)
 admin.site.register(Comment)
 admin.site.register(Follow)
+admin.site.register(DeletionJob, DeletionJobAdmin)
+# posts стоит в INSTALLED_APPS раньше auth, но импорт auth_admin выше
+# уже зарегистрировал стандартную админку пользователей
+admin.site.unregister(User)
+admin.site.register(User, UserAdmin)
@@ -0,0 +1,227 @@
+"""Автодополнение авторов и групп по префиксу без запросов к базе.
+
+Индекс — отсортированный список пар (ключ, элемент), где ключи — это
+username, полное имя и название группы, а также их хвосты с каждого
+слова ('лев толстой', 'толстой'). Поиск — bisect к первому ключу с
+префиксом и проход вперёд, пока префикс совпадает.
+
+Авторы и группы лежат в двух отдельных индексах, каждый строится при
+первом обращении и обновляется сигналами в своём процессе. Изменения из
+других процессов видны по ключам версий пользователей и групп, которые
+проверяются не чаще раза в AUTOCOMPLETE_REFRESH секунд; при расхождении
+заново строится только индекс, чья версия сменилась.
+"""
+import bisect
+import heapq
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.urls import reverse
+
+from core.routers import pinned_to_primary
+
+from . import cache as feed_cache
+from .models import Group
+
+User = get_user_model()
+
+
+def normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+def _keys(*texts):
+    keys = set()
+    for text in texts:
+        words = normalize(text).split(' ')
+        for position in range(len(words)):
+            if words[position]:
+                keys.add(' '.join(words[position:]))
+    return keys
+
+
+def _author(user):
+    full_name = user.get_full_name()
+    label = f'{full_name} ({user.username})' if full_name else user.username
+    return ('author', user.pk), (label, user.username), _keys(
+        user.username, full_name)
+
+
+def _group(group):
+    return ('group', group.pk), (group.title, group.slug), _keys(
+        group.title, group.slug)
+
+
+class PrefixIndex:
+    def __init__(self, entries=()):
+        self.items = {}
+        self.keys = []
+        for item, data, keys in entries:
+            self.items[item] = (data, keys)
+            self.keys.extend((key, item) for key in keys)
+        self.keys.sort()
+
+    def add(self, item, data, keys):
+        self.remove(item)
+        self.items[item] = (data, keys)
+        for key in keys:
+            bisect.insort(self.keys, (key, item))
+
+    def remove(self, item):
+        data, keys = self.items.pop(item, (None, ()))
+        for key in keys:
+            position = bisect.bisect_left(self.keys, (key, item))
+            if (position < len(self.keys)
+                    and self.keys[position] == (key, item)):
+                del self.keys[position]
+
+    def matches(self, prefix):
+        """(ключ, элемент, данные) с префиксом prefix в порядке ключей."""
+        position = bisect.bisect_left(self.keys, (prefix,))
+        while position < len(self.keys):
+            key, item = self.keys[position]
+            if not key.startswith(prefix):
+                return
+            yield key, item, self.items[item][0]
+            position += 1
+
+    def search(self, prefix, limit):
+        return _first([self], prefix, limit)
+
+
+def _first(indexes, prefix, limit):
+    # индексы сливаются по ключу, элемент берётся по первому ключу
+    found = {}
+    prefix = normalize(prefix)
+    matches = heapq.merge(
+        *(index.matches(prefix) for index in indexes),
+        key=lambda match: match[:2])
+    for key, item, data in matches:
+        if len(found) >= limit:
+            break
+        found.setdefault(item, data)
+    return list(found.items())
+
+
+def _load_authors():
+    users = User.objects.filter(is_active=True).only(
+        'pk', 'username', 'first_name', 'last_name')
+    return PrefixIndex(_author(user) for user in users.iterator())
+
+
+def _load_groups():
+    groups = Group.objects.filter(pending_deletion=False).only(
+        'pk', 'title', 'slug')
+    return PrefixIndex(_group(group) for group in groups.iterator())
+
+
+# вид элемента: ключ версии и загрузка его индекса
+KINDS = {
+    'author': (feed_cache.USERS_VERSION_KEY, _load_authors),
+    'group': (feed_cache.GROUPS_VERSION_KEY, _load_groups),
+}
+
+
+class _State:
+    def __init__(self):
+        self.indexes = {}
+        self.versions = {}
+        self.checked_at = 0.0
+
+
+_state = _State()
+_lock = threading.Lock()
+
+
+def _indexes():
+    now = time.monotonic()
+    if (len(_state.indexes) == len(KINDS)
+            and now < _state.checked_at + settings.AUTOCOMPLETE_REFRESH):
+        return _state.indexes
+    for kind, (key, load) in KINDS.items():
+        version = feed_cache.get_version(key)
+        if kind not in _state.indexes or version != _state.versions[kind]:
+            # индекс живёт до смены версии, поэтому читаем с основной базы
+            with pinned_to_primary():
+                _state.indexes[kind] = load()
+            _state.versions[kind] = version
+    _state.checked_at = now
+    return _state.indexes
+
+
+def search(query, limit):
+    """До limit авторов и групп, у которых ключ начинается с query."""
+    with _lock:
+        matches = _first(_indexes().values(), query, limit)
+    results = []
+    for (kind, pk), (label, slug) in matches:
+        if kind == 'author':
+            url = reverse('posts:profile', args=[slug])
+        else:
+            url = reverse('posts:group_list', args=[slug])
+        results.append({'type': kind, 'label': label, 'url': url})
+    return results
+
+
+def _advance(kind, item=None, entry=None):
+    key = KINDS[kind][0]
+    with _lock:
+        index = _state.indexes.get(kind)
+        # индекс был актуален, только если версию с тех пор никто не
+        # сдвигал; иначе он отстал и будет построен заново
+        current = (index is not None
+                   and feed_cache.get_version(key) == _state.versions[kind])
+        version = feed_cache.new_version(key)
+        if not current:
+            _state.indexes.pop(kind, None)
+            return
+        if entry is not None:
+            index.add(*entry)
+        elif item is not None:
+            index.remove(item)
+        _state.versions[kind] = version
+
+
+def _update(item, entry=None):
+    """Меняет элемент в своём индексе и сдвигает версию его вида.
+
+    По версии пользователей сбрасываются и кешированные поиски авторов,
+    по версии групп — групп. Как и bump_version, версия сдвигается ещё
+    раз после коммита.
+    """
+    kind = item[0]
+    _advance(kind, item, entry)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _advance(kind))
+
+
+def user_changed(user):
+    if user.is_active:
+        _update(('author', user.pk), _author(user))
+    else:
+        _update(('author', user.pk))
+
+
+def user_removed(user):
+    _update(('author', user.pk))
+
+
+def group_changed(group):
+    if group.pending_deletion:
+        _update(('group', group.pk))
+    else:
+        _update(('group', group.pk), _group(group))
+
+
+def group_removed(group):
+    _update(('group', group.pk))
+
+
+def reset():
+    """Забывает индекс; следующий поиск построит его заново."""
+    with _lock:
+        _state.indexes.clear()
+        _state.versions.clear()
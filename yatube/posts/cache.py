@@ -0,0 +1,216 @@
+"""Кеширование лент с инвалидацией через ключи версий.
+
+Версия входит в ключ кешированного фрагмента, поэтому после записи
+старые фрагменты просто перестают запрашиваться и доживают до TTL.
+
+Версия меняется дважды: сразу, чтобы сама транзакция не читала старые
+фрагменты, и после коммита — иначе читатель, пересобравший фрагмент под
+новой версией до коммита, закешировал бы старые строки на весь TTL.
+Новая версия — это свежая метка времени, а не incr: incr файлового кеша
+не атомарен, и параллельные писатели теряли бы увеличения.
+
+get_or_compute защищает горячие ключи от stampede: пересчитывает один
+воркер (single-flight), остальные отдают устаревшую копию в окне
+stale-while-revalidate, а вероятностное раннее истечение (XFetch)
+размазывает пересчёты во времени.
+"""
+import math
+import random
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.shortcuts import get_object_or_404
+
+from core.routers import replica_timeout
+
+from .models import Group
+from .paginators import encode_cursor
+
+User = get_user_model()
+
+FEED_VERSION_KEY = 'posts:version:feed'
+GROUPS_VERSION_KEY = 'posts:version:groups'
+USERS_VERSION_KEY = 'posts:version:users'
+
+
+def _initial_version():
+    # не 1: после вытеснения ключа версии старые фрагменты не оживут
+    return time.time_ns()
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def new_version(key):
+    """Сразу записывает новую версию и возвращает её."""
+    version = _initial_version()
+    cache.set(key, version, None)
+    return version
+
+
+def bump_version(key):
+    new_version(key)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: new_version(key))
+
+
+def feed_version():
+    return get_version(FEED_VERSION_KEY)
+
+
+def bump_feed_version():
+    bump_version(FEED_VERSION_KEY)
+
+
+def group_generation(group_id):
+    return get_version(f'posts:version:group:{group_id}')
+
+
+def bump_group_generation(group_id):
+    if group_id is not None:
+        bump_version(f'posts:version:group:{group_id}')
+
+
+def author_generation(author_id):
+    return get_version(f'posts:version:author:{author_id}')
+
+
+def bump_author_generation(author_id):
+    bump_version(f'posts:version:author:{author_id}')
+
+
+def _cached_lookup(version_key, name, value, fetch):
+    key = f'posts:lookup:{name}:{get_version(version_key)}:{value}'
+    obj = cache.get(key)
+    if obj is None:
+        obj = fetch()
+        cache.set(key, obj, replica_timeout(settings.LOOKUP_CACHE_TIMEOUT))
+    return obj
+
+
+def get_group_or_404(slug):
+    return _cached_lookup(
+        GROUPS_VERSION_KEY, 'group', slug,
+        lambda: get_object_or_404(
+            Group, slug=slug, pending_deletion=False))
+
+
+# только то, что нужно страницам автора: хеш пароля и email в кеш
+# не попадают
+AUTHOR_FIELDS = ('pk', 'username', 'first_name', 'last_name', 'is_active')
+
+
+def get_author_or_404(username):
+    return _cached_lookup(
+        USERS_VERSION_KEY, 'author', username,
+        lambda: get_object_or_404(
+            User.objects.only(*AUTHOR_FIELDS).exclude(
+                stats__pending_deletion=True),
+            username=username))
+
+
+def page_key(page_obj):
+    """Часть ключа кеша, однозначно задающая страницу ленты."""
+    if getattr(page_obj, 'is_cursor', False):
+        if page_obj.after is not None:
+            return f'after:{encode_cursor(page_obj.after)}'
+        if page_obj.before is not None:
+            return f'before:{encode_cursor(page_obj.before)}'
+        return 'first'
+    return f'page:{page_obj.number}'
+
+
+def cache_context(page_obj, version):
+    """Переменные контекста для {% cache %} вокруг страницы ленты."""
+    return {
+        'cache_timeout': settings.FEED_CACHE_TIMEOUT,
+        'cache_version': version,
+        'cache_page_key': page_key(page_obj),
+    }
+
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def cache_stats():
+    """Счётчики процесса: hits, misses, stale, lock_waits."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def _recompute(key, compute, timeout):
+    started = time.monotonic()
+    value = compute()
+    delta = time.monotonic() - started
+    stale = settings.FEED_CACHE_STALE_TIMEOUT
+    # физически запись живёт дольше логического срока на окно stale
+    cache.set(key, (value, time.time() + timeout, delta), timeout + stale)
+    return value
+
+
+def _wait_for(key, lock_key):
+    _count('lock_waits')
+    deadline = time.monotonic() + settings.FEED_CACHE_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(settings.FEED_CACHE_LOCK_POLL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+        if cache.get(lock_key) is None:
+            break
+    return None
+
+
+def get_or_compute(key, compute, timeout):
+    """Значение из кеша или результат compute() с защитой от stampede."""
+    lock_key = f'posts:lock:{key}'
+    entry = cache.get(key)
+    if entry is not None:
+        value, expires_at, delta = entry
+        now = time.time()
+        early = -delta * settings.FEED_CACHE_EARLY_BETA * math.log(
+            1 - random.random())
+        if now + early < expires_at:
+            _count('hits')
+            return value
+        if cache.add(lock_key, 1, settings.FEED_CACHE_LOCK_TIMEOUT):
+            _count('misses')
+            try:
+                return _recompute(key, compute, timeout)
+            finally:
+                cache.delete(lock_key)
+        # пересчитывает другой воркер — отдаём то, что есть
+        _count('hits' if now < expires_at else 'stale')
+        return value
+
+    _count('misses')
+    if cache.add(lock_key, 1, settings.FEED_CACHE_LOCK_TIMEOUT):
+        try:
+            return _recompute(key, compute, timeout)
+        finally:
+            cache.delete(lock_key)
+    entry = _wait_for(key, lock_key)
+    if entry is not None:
+        return entry[0]
+    return compute()
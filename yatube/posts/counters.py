@@ -0,0 +1,178 @@
+"""Денормализованные счётчики постов, комментариев и подписок.
+
+Счётчики меняются атомарным UPDATE ... SET x = x ± 1 из сигналов,
+а возможный дрейф чинит команда reconcile_counters.
+
+Число постов в лентах для пагинации берётся из этих счётчиков (группа,
+автор) или из ограниченного COUNT с оценкой (общая лента) и кешируется
+под версией ленты, так что после записи сразу пересчитывается.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Max, Min
+
+from core.routers import replica_timeout
+
+from . import cache as feed_cache
+from .models import Comment, Follow, Group, Post, UserStats
+
+User = get_user_model()
+
+
+def bump(model, pk, field, delta):
+    if pk is None:
+        return
+    queryset = model.objects.filter(pk=pk)
+    if delta < 0:
+        # не уходим в минус, если счётчик уже разошёлся с реальностью
+        queryset = queryset.filter(**{f'{field}__gte': -delta})
+    queryset.update(**{field: F(field) + delta})
+
+
+def stats_for(user):
+    """Счётчики пользователя; отсутствующую строку создаёт по факту."""
+    try:
+        return user.stats
+    except UserStats.DoesNotExist:
+        stats, created = UserStats.objects.get_or_create(user=user)
+        if created and _fill_user_stats([stats]):
+            stats.save()
+        return stats
+
+
+def estimate_count(queryset):
+    """Число строк без полного прохода по таблице.
+
+    До POSTS_COUNT_EXACT_LIMIT считает точно COUNT по подзапросу с LIMIT,
+    выше — оценивает по диапазону первичных ключей (два чтения индекса).
+    """
+    limit = settings.POSTS_COUNT_EXACT_LIMIT
+    queryset = queryset.order_by()
+    count = queryset[:limit + 1].count()
+    if count <= limit:
+        return count
+    bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+    return bounds['high'] - bounds['low'] + 1
+
+
+def _cached_count(key, fetch):
+    count = cache.get(key)
+    if count is None:
+        count = fetch()
+        cache.set(key, count, replica_timeout(settings.POSTS_COUNT_TIMEOUT))
+    return count
+
+
+def posts_total():
+    """Число постов в общей ленте."""
+    return _cached_count(
+        f'posts:count:feed:{feed_cache.feed_version()}',
+        lambda: estimate_count(Post.objects.visible()))
+
+
+def group_posts_total(group):
+    """Число постов группы по поддерживаемому счётчику."""
+    return _cached_count(
+        f'posts:count:group:{group.pk}:'
+        f'{feed_cache.group_generation(group.pk)}',
+        lambda: Group.objects.filter(pk=group.pk).values_list(
+            'posts_count', flat=True).first() or 0)
+
+
+def _counts(queryset, field, ids):
+    return dict(
+        queryset.filter(**{f'{field}__in': ids}).order_by().values(
+            field).annotate(total=Count('pk')).values_list(field, 'total')
+    )
+
+
+def _fill_user_stats(stats_list):
+    ids = [stats.user_id for stats in stats_list]
+    posts = _counts(Post.objects, 'author_id', ids)
+    followers = _counts(Follow.objects, 'author_id', ids)
+    following = _counts(Follow.objects, 'user_id', ids)
+    changed = []
+    for stats in stats_list:
+        actual = (
+            posts.get(stats.user_id, 0),
+            followers.get(stats.user_id, 0),
+            following.get(stats.user_id, 0),
+        )
+        current = (
+            stats.posts_count, stats.followers_count, stats.following_count)
+        if actual != current:
+            (stats.posts_count, stats.followers_count,
+             stats.following_count) = actual
+            changed.append(stats)
+    return changed
+
+
+def _batches(queryset, batch_size, ids=None):
+    # ids — сверить только эти строки, а не всю таблицу
+    if ids is not None:
+        ids = sorted(ids)
+        for start in range(0, len(ids), batch_size):
+            yield ids[start:start + batch_size]
+        return
+    last_pk = 0
+    while True:
+        ids = list(queryset.filter(pk__gt=last_pk).order_by(
+            'pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return
+        yield ids
+        last_pk = ids[-1]
+
+
+def reconcile_users(batch_size, ids=None):
+    repaired = 0
+    for ids in _batches(User.objects, batch_size, ids):
+        with transaction.atomic():
+            existing = {
+                stats.user_id: stats
+                for stats in UserStats.objects.select_for_update().filter(
+                    user_id__in=ids)
+            }
+            missing = [
+                UserStats(user_id=pk) for pk in ids if pk not in existing]
+            UserStats.objects.bulk_create(missing)
+            changed = _fill_user_stats(list(existing.values()) + missing)
+            UserStats.objects.bulk_update(changed, [
+                'posts_count', 'followers_count', 'following_count'])
+        repaired += len(changed)
+    return repaired
+
+
+def _reconcile_field(model, field, related, related_field, batch_size,
+                     ids=None):
+    repaired = 0
+    for ids in _batches(model.objects, batch_size, ids):
+        with transaction.atomic():
+            actual = _counts(related, related_field, ids)
+            changed = defaultdict(list)
+            for pk, current in model.objects.select_for_update().filter(
+                    pk__in=ids).values_list('pk', field):
+                total = actual.get(pk, 0)
+                if current != total:
+                    changed[total].append(pk)
+            # UPDATE на каждое значение: bulk_update строит CASE на
+            # каждую строку, и на больших пачках это заметно медленнее
+            for total, pks in changed.items():
+                model.objects.filter(pk__in=pks).update(**{field: total})
+        repaired += sum(len(pks) for pks in changed.values())
+    return repaired
+
+
+def reconcile_posts(batch_size, ids=None):
+    return _reconcile_field(
+        Post, 'comments_count', Comment.objects, 'post_id', batch_size, ids)
+
+
+def reconcile_groups(batch_size, ids=None):
+    return _reconcile_field(
+        Group, 'posts_count', Post.objects.visible(), 'group_id',
+        batch_size, ids)
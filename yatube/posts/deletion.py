@@ -0,0 +1,177 @@
+"""Отложенное удаление пользователей и групп.
+
+Удаление автора с миллионами подписок или группы с огромной лентой одним
+каскадом держит запись в базе минутами. Поэтому schedule_* только скрывает
+объект (пользователь деактивируется, он и группа помечаются
+pending_deletion) и ставит DeletionJob, а run_job удаляет зависимые
+строки пачками — каждая в своей короткой транзакции, через обычный
+delete(), чтобы сигналы поддерживали счётчики и ленты. Шаги
+идемпотентны: прерванное задание продолжается с того места, где
+остановилось.
+"""
+import logging
+import time
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from . import cache as feed_cache
+from . import counters
+from .models import (Comment, DeletionJob, FeedEntry, Follow, Group, Post,
+                     UserStats)
+
+User = get_user_model()
+
+logger = logging.getLogger(__name__)
+
+
+def _schedule(kind, obj, total):
+    job = DeletionJob.objects.filter(
+        kind=kind, object_id=obj.pk, status__in=DeletionJob.ACTIVE).first()
+    if job is None:
+        job = DeletionJob.objects.create(
+            kind=kind, object_id=obj.pk, label=str(obj)[:200], total=total)
+    return job
+
+
+@transaction.atomic
+def schedule_user_deletion(user):
+    """Скрывает пользователя со всем его содержимым и ставит задание."""
+    user.is_active = False
+    user.save(update_fields=['is_active'])
+    counters.stats_for(user)
+    if UserStats.objects.filter(
+            user=user, pending_deletion=False).update(pending_deletion=True):
+        _hide_from_groups(user)
+    total = (
+        Post.objects.filter(author=user).exclude(group=None).count()
+        + Comment.objects.filter(author=user).count()
+        + Follow.objects.filter(Q(user=user) | Q(author=user)).count()
+        + Post.objects.filter(author=user).count()
+    )
+    return _schedule(DeletionJob.USER, user, total)
+
+
+def _hide_from_groups(user):
+    # посты скрыты visible(), поэтому сразу убираем их из счётчиков
+    # групп; сами посты отвязываются первым шагом задания
+    posts = Post.objects.filter(author=user).exclude(group=None)
+    for group_id, total in posts.order_by().values_list('group_id').annotate(
+            total=Count('pk')):
+        counters.bump(Group, group_id, 'posts_count', -total)
+        feed_cache.bump_group_generation(group_id)
+    feed_cache.bump_feed_version()
+
+
+@transaction.atomic
+def schedule_group_deletion(group):
+    """Скрывает группу и ставит задание на отвязку её постов."""
+    group.pending_deletion = True
+    group.save(update_fields=['pending_deletion'])
+    return _schedule(DeletionJob.GROUP, group, group.posts_count)
+
+
+def _delete_batch(queryset, batch_size):
+    pks = list(
+        queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+    if pks:
+        queryset.model.objects.filter(pk__in=pks).delete()
+    return len(pks)
+
+
+def _detach_batch(queryset, batch_size):
+    batch = list(queryset.order_by('pk').values_list(
+        'pk', 'author_id')[:batch_size])
+    if batch:
+        # update() в обход сигналов и счётчиков групп: группа или автор
+        # уже скрыты, и счётчик их постов больше не учитывает
+        Post.objects.filter(pk__in=[pk for pk, _ in batch]).update(
+            group=None)
+        # update() не шлёт сигналов: сбрасываем фрагменты профилей
+        for author_id in {author_id for _, author_id in batch}:
+            feed_cache.bump_author_generation(author_id)
+    return len(batch)
+
+
+def _user_steps(user_id):
+    # сначала то, что иначе удалилось бы каскадом одним запросом; посты
+    # удаляются раньше подписок, чтобы отписки не переносили их в ленты
+    return (
+        ('groups', _detach_batch,
+         Post.objects.filter(author_id=user_id).exclude(group=None)),
+        ('post_feed', _delete_batch,
+         FeedEntry.objects.filter(post__author_id=user_id)),
+        ('post_comments', _delete_batch,
+         Comment.objects.filter(post__author_id=user_id)),
+        ('posts', _delete_batch,
+         Post.objects.filter(author_id=user_id)),
+        ('comments', _delete_batch,
+         Comment.objects.filter(author_id=user_id)),
+        ('follows', _delete_batch,
+         Follow.objects.filter(Q(user_id=user_id) | Q(author_id=user_id))),
+        ('feed', _delete_batch,
+         FeedEntry.objects.filter(user_id=user_id)),
+    )
+
+
+def _group_steps(group_id):
+    return (
+        ('posts', _detach_batch, Post.objects.filter(group_id=group_id)),
+    )
+
+
+def _finish_user(user_id):
+    User.objects.filter(pk=user_id).delete()
+
+
+def _finish_group(group_id):
+    Group.objects.filter(pk=group_id).delete()
+    feed_cache.bump_feed_version()
+
+
+KINDS = {
+    DeletionJob.USER: (_user_steps, _finish_user),
+    DeletionJob.GROUP: (_group_steps, _finish_group),
+}
+
+
+def run_job(job, batch_size=500, pause=0):
+    """Выполняет задание до конца; между пачками спит pause секунд."""
+    steps, finish = KINDS[job.kind]
+    job.status = DeletionJob.RUNNING
+    job.save(update_fields=['status'])
+    try:
+        for step, action, queryset in steps(job.object_id):
+            while True:
+                with transaction.atomic():
+                    done = action(queryset, batch_size)
+                    job.step = step
+                    job.processed += done
+                    job.save(update_fields=['step', 'processed'])
+                if done < batch_size:
+                    break
+                if pause:
+                    time.sleep(pause)
+        with transaction.atomic():
+            finish(job.object_id)
+            job.status = DeletionJob.DONE
+            job.step = ''
+            job.finished = timezone.now()
+            job.save(update_fields=['status', 'step', 'finished'])
+    except Exception as error:
+        logger.exception('Удаление %s не завершено', job)
+        job.status = DeletionJob.FAILED
+        job.error = repr(error)
+        job.save(update_fields=['status', 'error'])
+    return job
+
+
+def process(batch_size=500, pause=0):
+    """Выполняет все ожидающие и прерванные задания, возвращает их число."""
+    processed = 0
+    for job in DeletionJob.objects.filter(status__in=DeletionJob.ACTIVE):
+        run_job(job, batch_size, pause)
+        processed += 1
+    return processed
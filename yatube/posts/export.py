@@ -0,0 +1,74 @@
+"""Потоковая выгрузка постов, комментариев и подписок.
+
+Записи имеют тот же вид, что читает import_content, поэтому выгрузку
+можно загрузить обратно. Строки читаются через iterator(chunk_size),
+а ответ отдаётся по мере чтения, так что память не зависит от объёма
+аккаунта.
+"""
+import csv
+import json
+
+from django.conf import settings
+
+from .models import Comment, Follow, Post
+
+FORMATS = ('jsonl', 'csv')
+CSV_COLUMNS = (
+    'type', 'id', 'post', 'user', 'author', 'group', 'text', 'date')
+
+
+def _rows(queryset, *fields):
+    return queryset.order_by('pk').values_list(*fields).iterator(
+        chunk_size=settings.EXPORT_CHUNK_SIZE)
+
+
+def records(user=None):
+    """Записи пользователя или, если он не указан, всего сайта."""
+    posts = Post.objects.all()
+    comments = Comment.objects.all()
+    follows = Follow.objects.all()
+    if user is not None:
+        posts = posts.filter(author=user)
+        comments = comments.filter(author=user)
+        follows = follows.filter(user=user)
+    for pk, author, group, text, pub_date in _rows(
+            posts, 'pk', 'author__username', 'group__slug', 'text',
+            'pub_date'):
+        yield {'type': 'post', 'id': pk, 'author': author, 'group': group,
+               'text': text, 'pub_date': pub_date.isoformat()}
+    for pk, post, author, text, created in _rows(
+            comments, 'pk', 'post_id', 'author__username', 'text',
+            'created'):
+        yield {'type': 'comment', 'id': pk, 'post': post, 'author': author,
+               'text': text, 'created': created.isoformat()}
+    for follower, author in _rows(
+            follows, 'user__username', 'author__username'):
+        yield {'type': 'follow', 'user': follower, 'author': author}
+
+
+class _Echo:
+    # csv.writer пишет в файл, а нам нужна строка для ответа
+    def write(self, value):
+        return value
+
+
+def as_jsonl(records):
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def as_csv(records):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for record in records:
+        record = dict(record, date=record.get('pub_date', record.get(
+            'created')))
+        yield writer.writerow(
+            [record.get(column) for column in CSV_COLUMNS])
+
+
+def render(records, output_format):
+    """Строки выгрузки в формате output_format: 'jsonl' или 'csv'."""
+    if output_format == 'csv':
+        return as_csv(records)
+    return as_jsonl(records)
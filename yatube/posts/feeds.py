@@ -0,0 +1,409 @@
+"""Материализованная лента подписок (гибрид push/pull).
+
+Пост обычного автора раскладывается по лентам подписчиков в момент
+публикации (push), а чтение ленты — это диапазон по индексу
+FeedEntry(user, -pub_date). Посты авторов с UserStats.fanout_pulled не
+раскладываются: при чтении каждый такой автор даёт срез своего индекса
+(author, -pub_date), срезы читаются одним запросом (pull) и сливаются с
+материализованной лентой по дате.
+
+Автор переводится в pull, когда подписчиков становится больше
+FEED_FANOUT_FOLLOWER_LIMIT, а обратно — только опустившись до
+FEED_FANOUT_DEMOTE_LIMIT. Обратный перевод переносит посты автора в ленты
+всех подписчиков, поэтому он идёт в фоне, пачками; пока перенос не
+закончен, посты автора по-прежнему подмешиваются при чтении. В ленты
+переносятся только FEED_BACKFILL_POSTS последних постов автора.
+"""
+import heapq
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
+
+from core import background
+
+from .models import FeedEntry, Follow, Post, UserStats
+
+User = get_user_model()
+
+FEED_ORDERING = ('-feed_pub_date', '-feed_post_id')
+CELEBRITIES_CACHE_KEY = 'posts:feed:celebrities'
+# SQLite ограничивает число частей UNION (SQLITE_MAX_COMPOUND_SELECT)
+PULLED_UNION_SIZE = 100
+
+
+def celebrities():
+    """Множество id авторов, чьи посты не раскладываются по лентам.
+
+    Берётся по индексу UserStats.fanout_pulled, кешируется и
+    сбрасывается только при переводе автора.
+    """
+    ids = cache.get(CELEBRITIES_CACHE_KEY)
+    if ids is None:
+        ids = frozenset(UserStats.objects.filter(
+            fanout_pulled=True).values_list('user_id', flat=True))
+        cache.set(CELEBRITIES_CACHE_KEY, ids,
+                  settings.FEED_CELEBRITIES_CACHE_TIMEOUT)
+    return ids
+
+
+def _fanout_state(author_id):
+    return UserStats.objects.filter(user_id=author_id).values_list(
+        'followers_count', 'fanout_pulled', 'pending_deletion',
+    ).first() or (0, False, False)
+
+
+def follow_added(user_id, author_id):
+    """Переводит автора в pull, если он перешёл порог, иначе переносит
+    его посты в ленту нового подписчика."""
+    count, pulled, pending = _fanout_state(author_id)
+    if pending:
+        return
+    if not pulled and count > settings.FEED_FANOUT_FOLLOWER_LIMIT:
+        UserStats.objects.filter(user_id=author_id).update(fanout_pulled=True)
+        cache.delete(CELEBRITIES_CACHE_KEY)
+        pulled = True
+    if not pulled:
+        _copy_posts(user_id, author_id)
+
+
+def follow_removed(user_id, author_id):
+    """Убирает посты автора из ленты читателя; опустившегося до
+    FEED_FANOUT_DEMOTE_LIMIT автора после коммита возвращает в push."""
+    prune(user_id, author_id)
+    count, pulled, pending = _fanout_state(author_id)
+    # удаляемого автора не переводим: его подписки снимает задание
+    # удаления, и перенос постов в ленты был бы впустую
+    demote_limit = settings.FEED_FANOUT_DEMOTE_LIMIT
+    if pulled and not pending and count <= demote_limit:
+        transaction.on_commit(lambda: background.submit(demote, author_id))
+
+
+def authors_changed(author_ids, batch_size=1000):
+    """Сверяет fanout_pulled с числом подписчиков после изменений в обход
+    сигналов (импорт); обратный перевод выполняется сразу."""
+    for batch in _id_batches(author_ids, batch_size):
+        stats = UserStats.objects.filter(
+            user_id__in=batch, pending_deletion=False)
+        stats.filter(
+            fanout_pulled=False,
+            followers_count__gt=settings.FEED_FANOUT_FOLLOWER_LIMIT,
+        ).update(fanout_pulled=True)
+        demoted = list(stats.filter(
+            fanout_pulled=True,
+            followers_count__lte=settings.FEED_FANOUT_DEMOTE_LIMIT,
+        ).values_list('user_id', flat=True))
+        for author_id in demoted:
+            demote(author_id)
+    cache.delete(CELEBRITIES_CACHE_KEY)
+
+
+def readers(author_ids, batch_size=1000):
+    """id читателей, подписанных хотя бы на одного из авторов."""
+    found = set()
+    for batch in _id_batches(author_ids, batch_size):
+        found.update(Follow.objects.filter(
+            author_id__in=batch).values_list('user_id', flat=True))
+    return found
+
+
+def _bulk_insert(entries):
+    batch_size = settings.FEED_BATCH_SIZE
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            FeedEntry.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    if batch:
+        FeedEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def fan_out_post(post):
+    """Добавляет пост в ленты всех подписчиков автора."""
+    if post.author_id in celebrities():
+        return
+    followers = Follow.objects.filter(
+        author_id=post.author_id
+    ).values_list('user_id', flat=True)
+    _bulk_insert(
+        FeedEntry(user_id=user_id, post_id=post.pk, pub_date=post.pub_date)
+        for user_id in followers.iterator(chunk_size=settings.FEED_BATCH_SIZE)
+    )
+
+
+def posts_added(since):
+    """Раскладывает посты, добавленные в обход сигналов (импорт).
+
+    since — {id автора: дата самого раннего из его новых постов};
+    переносятся посты автора не старше этой даты.
+    """
+    pulled = celebrities()
+    for author_id, pub_date in since.items():
+        if author_id not in pulled:
+            _fill(Follow.objects.filter(author_id=author_id),
+                  Post.objects.filter(
+                      author_id=author_id, pub_date__gte=pub_date))
+
+
+def backfill(user_id, author_id):
+    """Переносит в ленту читателя уже опубликованные посты автора."""
+    if author_id not in celebrities():
+        _copy_posts(user_id, author_id)
+
+
+def _recent(posts):
+    # диапазон индекса (author, -pub_date), а не вся история автора
+    return posts.order_by('-pub_date', '-id').values_list(
+        'id', 'pub_date')[:settings.FEED_BACKFILL_POSTS]
+
+
+def _copy_posts(user_id, author_id):
+    posts = _recent(Post.objects.filter(author_id=author_id))
+    _bulk_insert(
+        FeedEntry(user_id=user_id, post_id=post_id, pub_date=pub_date)
+        for post_id, pub_date in posts
+    )
+
+
+def _fill(follows, posts):
+    """Раскладывает последние FEED_BACKFILL_POSTS постов по лентам
+    подписчиков пачками примерно по FEED_BATCH_SIZE строк, каждая
+    пачка — в своей транзакции."""
+    rows = list(_recent(posts))
+    if not rows:
+        return
+    readers = max(1, settings.FEED_BATCH_SIZE // len(rows))
+    follows = follows.order_by('pk').values_list('pk', 'user_id')
+    last_pk = 0
+    while True:
+        batch = list(follows.filter(pk__gt=last_pk)[:readers])
+        if not batch:
+            return
+        last_pk = batch[-1][0]
+        with transaction.atomic():
+            _bulk_insert(
+                FeedEntry(user_id=user_id, post_id=post_id, pub_date=pub_date)
+                for _, user_id in batch
+                for post_id, pub_date in rows
+            )
+
+
+def demote(author_id):
+    """Возвращает автора к раскладке по лентам; выполняется в фоне.
+
+    Посты переносятся, пока автор ещё подмешивается при чтении, и только
+    потом снимается fanout_pulled. Второй проход добирает посты и
+    подписки, появившиеся за время переноса: их раскладка пропускалась.
+    """
+    stats = UserStats.objects.filter(
+        user_id=author_id, fanout_pulled=True, pending_deletion=False,
+        followers_count__lte=settings.FEED_FANOUT_DEMOTE_LIMIT)
+    if not stats.exists():
+        return
+    follows = Follow.objects.filter(author_id=author_id)
+    posts = Post.objects.filter(author_id=author_id)
+    last_follow = follows.order_by('-pk').values_list(
+        'pk', flat=True).first() or 0
+    last_post = posts.order_by('-pk').values_list(
+        'pk', flat=True).first() or 0
+    old_follows = follows.filter(pk__lte=last_follow)
+    _fill(old_follows, posts.filter(pk__lte=last_post))
+    # за время переноса автор мог снова набрать подписчиков
+    if not stats.update(fanout_pulled=False):
+        return
+    cache.delete(CELEBRITIES_CACHE_KEY)
+    _fill(old_follows, posts.filter(pk__gt=last_post))
+    _fill(follows.filter(pk__gt=last_follow), posts)
+
+
+def prune(user_id, author_id):
+    """Убирает из ленты читателя посты автора после отписки."""
+    FeedEntry.objects.filter(
+        user_id=user_id, post__author_id=author_id).delete()
+
+
+def _id_batches(ids, batch_size):
+    ids = sorted(ids)
+    for start in range(0, len(ids), batch_size):
+        yield ids[start:start + batch_size]
+
+
+def _reader_batches(user_ids, batch_size):
+    if user_ids is not None:
+        yield from _id_batches(user_ids, batch_size)
+        return
+    users = User.objects.order_by('pk').values_list('pk', flat=True)
+    last_pk = 0
+    while True:
+        batch = list(users.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return
+        last_pk = batch[-1]
+        yield batch
+
+
+def rebuild(user_ids=None, batch_size=100):
+    """Пересобирает ленты указанных (или всех) читателей с нуля.
+
+    Каждая пачка из batch_size читателей пересобирается в своей
+    транзакции: запись не держится на всё время пересборки, а прерванную
+    команду можно просто запустить снова.
+    """
+    for batch in _reader_batches(user_ids, batch_size):
+        with transaction.atomic():
+            FeedEntry.objects.filter(user_id__in=batch).delete()
+            for user_id, author_id in Follow.objects.filter(
+                user_id__in=batch
+            ).values_list('user_id', 'author_id').iterator():
+                backfill(user_id, author_id)
+
+
+def _sort_key(ordering):
+    names = [name.lstrip('-') for name in ordering]
+    descending = {name.startswith('-') for name in ordering}
+    if len(descending) != 1:
+        raise ValueError('MergedFeed требует единое направление сортировки')
+    return (lambda obj: tuple(getattr(obj, name) for name in names),
+            descending.pop())
+
+
+class PulledPosts:
+    """Посты подмешиваемых авторов как источник MergedFeed.
+
+    Срез [:n] читает не больше n постов каждого автора — диапазон индекса
+    (author, -pub_date) в подзапросе — и объединяет их через UNION ALL,
+    так что ни сортировки всех постов авторов, ни временного B-дерева
+    нет; прочитанное упорядочивается в памяти.
+    """
+
+    def __init__(self, author_ids, filters=(), ordering=FEED_ORDERING):
+        self.author_ids = sorted(author_ids)
+        self.filters = tuple(filters)
+        self.ordering = tuple(ordering)
+        self.model = Post
+
+    def _posts(self):
+        return Post.objects.visible().annotate(
+            feed_pub_date=F('pub_date'), feed_post_id=F('id'))
+
+    def filter(self, *args, **kwargs):
+        return PulledPosts(
+            self.author_ids, self.filters + (Q(*args, **kwargs),),
+            self.ordering)
+
+    def order_by(self, *ordering):
+        return PulledPosts(
+            self.author_ids, self.filters, ordering or self.ordering)
+
+    def values(self, *fields):
+        # для подсчёта порядок и срезы по авторам не нужны
+        return self._posts().filter(
+            *self.filters, author_id__in=self.author_ids
+        ).order_by().values(*fields)
+
+    def count(self):
+        return self.values('pk').count()
+
+    def union(self, stop, author_ids=None):
+        """Запрос UNION ALL срезов [:stop] по каждому из авторов."""
+        if author_ids is None:
+            author_ids = self.author_ids
+        parts = [
+            self._posts().filter(pk__in=self._posts().filter(
+                *self.filters, author_id=author_id
+            ).order_by(*self.ordering).values('id')[:stop]).select_related(
+                'author', 'group').order_by()
+            for author_id in author_ids
+        ]
+        return parts[0].union(*parts[1:], all=True)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.start or index.stop is None:
+            raise ValueError('PulledPosts поддерживает только срезы [:n]')
+        posts = []
+        for start in range(0, len(self.author_ids), PULLED_UNION_SIZE):
+            posts.extend(self.union(
+                index.stop,
+                self.author_ids[start:start + PULLED_UNION_SIZE]))
+        key, reverse = _sort_key(self.ordering)
+        posts.sort(key=key, reverse=reverse)
+        return posts[:index.stop]
+
+
+class MergedFeed:
+    """k-way слияние нескольких querysets, отсортированных одним ключом.
+
+    Поддерживает ровно то, что нужно Paginator и CursorPaginator:
+    filter(), order_by(), count() и срезы. Срез [a:b] читает из каждого
+    источника не больше b строк.
+    """
+
+    ordered = True
+
+    def __init__(self, sources, ordering):
+        self.sources = list(sources)
+        self.ordering = tuple(ordering)
+        self.model = self.sources[0].model
+        self.query = self.sources[0].query
+
+    def _clone(self, sources, ordering=None):
+        return MergedFeed(sources, ordering or self.ordering)
+
+    def filter(self, *args, **kwargs):
+        return self._clone(s.filter(*args, **kwargs) for s in self.sources)
+
+    def order_by(self, *ordering):
+        return self._clone(
+            (s.order_by(*ordering) for s in self.sources), ordering)
+
+    def count(self):
+        return sum(source.count() for source in self.sources)
+
+    def _merge(self, stop):
+        key, reverse = _sort_key(self.ordering)
+        return heapq.merge(
+            *(source[:stop] for source in self.sources),
+            key=key, reverse=reverse)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step is not None or index.stop is None:
+                raise ValueError('MergedFeed поддерживает только срезы [a:b]')
+            start = index.start or 0
+            return list(self._merge(index.stop))[start:]
+        return self[index:index + 1][0]
+
+
+def follow_feed(user):
+    """Посты из ленты подписок: материализованная часть плюс посты
+    подмешиваемых авторов, слитые по дате публикации."""
+    pulled_authors = list(Follow.objects.filter(
+        user=user, author__stats__fanout_pulled=True
+    ).values_list('author_id', flat=True))
+    pushed = Post.objects.visible().filter(
+        feed_entries__user=user
+    ).exclude(
+        author__stats__fanout_pulled=True
+    ).annotate(
+        feed_pub_date=F('feed_entries__pub_date'),
+        feed_post_id=F('feed_entries__post_id'),
+    ).select_related('author', 'group').order_by(*FEED_ORDERING)
+    sources = [pushed]
+    if pulled_authors:
+        sources.append(PulledPosts(pulled_authors))
+    return MergedFeed(sources, FEED_ORDERING)
+
+
+def bounded_count(feed):
+    """Число постов ленты, не больше POSTS_COUNT_EXACT_LIMIT.
+
+    Все источники считаются одним запросом — UNION ALL их id с LIMIT,
+    так что COUNT не проходит ни материализованную ленту, ни посты
+    популярных авторов целиком. Дальние страницы доступны курсором.
+    """
+    ids = [source.order_by().values('pk') for source in feed.sources]
+    return ids[0].union(*ids[1:], all=True)[
+        :settings.POSTS_COUNT_EXACT_LIMIT].count()
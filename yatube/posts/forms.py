@@ -1,6 +1,6 @@
 from django.forms import ModelForm
 
-from .models import Comment, Post
+from .models import Comment, Group, Post
 
 
 class PostForm(ModelForm):
@@ -19,6 +19,12 @@ class PostForm(ModelForm):
             'image': ('Добавьте картинку')
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # группы, ожидающие удаления, выбрать уже нельзя
+        self.fields['group'].queryset = Group.objects.filter(
+            pending_deletion=False)
+
 
 class CommentForm(ModelForm):
     class Meta:
@@ -0,0 +1,84 @@
+"""Сведения о загруженных картинках постов и дедупликация файлов.
+
+Размеры, вес и SHA-256 картинки считаются один раз при загрузке и
+хранятся в посте, так что открывать файл ради них больше не нужно.
+По хешу одинаковая картинка, загруженная повторно, ссылается на уже
+сохранённый файл, а значит и на его миниатюры: sorl ищет их по имени
+исходника.
+
+Файл называется по хешу и раскладывается по вложенным каталогам из его
+первых символов (posts/ab/cd/abcd….jpg), чтобы ни в одном каталоге не
+копились миллионы файлов. Старые файлы из плоского posts/ переносит
+команда shard_media.
+"""
+import hashlib
+import os
+import posixpath
+import re
+
+from django.core.files.images import get_image_dimensions
+
+METADATA_FIELDS = ('image_width', 'image_height', 'image_size', 'image_hash')
+# уровни вложенности и число символов хеша на уровень
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+# имя файла в разложенной схеме относительно upload_to
+SHARDED_NAME = re.compile(
+    r'(?:[0-9a-f]{%d}/){%d}[0-9a-f]{64}(?:\.\w+)?$'
+    % (SHARD_WIDTH, SHARD_LEVELS))
+
+
+def sharded_name(digest, filename):
+    """ab/cd/<хеш>.<расширение>: имя файла относительно upload_to."""
+    extension = os.path.splitext(filename)[1].lower()
+    shards = [
+        digest[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH]
+        for level in range(SHARD_LEVELS)
+    ]
+    return posixpath.join(*shards, digest + extension)
+
+
+def is_sharded(name):
+    return SHARDED_NAME.search(name) is not None
+
+
+def describe(file):
+    """Ширина, высота, размер и хеш картинки в виде полей Post."""
+    digest = hashlib.sha256()
+    size = 0
+    file.seek(0)
+    for chunk in file.chunks():
+        digest.update(chunk)
+        size += len(chunk)
+    width, height = get_image_dimensions(file)
+    file.seek(0)
+    return {
+        'image_width': width,
+        'image_height': height,
+        'image_size': size,
+        'image_hash': digest.hexdigest(),
+    }
+
+
+def prepare(post):
+    """Заполняет сведения о новой картинке поста до сохранения файла.
+
+    Если такой файл уже есть, пост получает ссылку на него, и FileField
+    не сохраняет копию.
+    """
+    image = post.image
+    if not image:
+        post.image_width = post.image_height = post.image_size = None
+        post.image_hash = ''
+        return
+    if image._committed:
+        # файл уже в хранилище и сведения о нём не менялись
+        return
+    for field, value in describe(image).items():
+        setattr(post, field, value)
+    image.name = sharded_name(post.image_hash, image.name)
+    name = image.field.generate_filename(post, image.name)
+    # имя задаётся хешем, поэтому дубль находится без запроса к базе;
+    # копия файла из плоского posts/ сольётся с ним при shard_media
+    if image.storage.exists(name):
+        post.image = name
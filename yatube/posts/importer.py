@@ -0,0 +1,281 @@
+"""Потоковый импорт постов, комментариев и подписок из JSONL.
+
+Каждая строка — JSON-объект с полем type:
+
+    {"type": "post", "id": 10, "author": "leo", "group": "classics",
+     "text": "...", "pub_date": "2020-01-01T10:00:00+00:00"}
+    {"type": "comment", "id": 7, "post": 10, "author": "anna",
+     "text": "...", "created": "2020-01-02T10:00:00+00:00"}
+    {"type": "follow", "user": "anna", "author": "leo"}
+
+id необязательны; явные id делают повторный запуск идемпотентным, а
+комментарии ссылаются на посты по id. Строки копятся пачками и
+вставляются bulk_create, каждая пачка в своей транзакции; уже
+существующие посты, комментарии и подписки не вставляются и в stats не
+считаются. Авторов и группы ищут одним запросом на пачку, найденные id
+хранятся в ограниченном LRU.
+
+bulk_create обходит сигналы, поэтому после каждой пачки сверяются
+счётчики затронутых ею строк, её посты и подписки раскладываются по
+лентам и сдвигаются версии кеша. Ничего не копится до конца импорта, и
+память не растёт с размером файла. Поисковый индекс обновляют триггеры.
+"""
+import json
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import cache as feed_cache
+from . import counters, feeds
+from .models import Comment, Follow, Group, Post
+
+User = get_user_model()
+
+REQUIRED = {
+    'post': ('author', 'text'),
+    'comment': ('post', 'author', 'text'),
+    'follow': ('user', 'author'),
+}
+INTEGER_FIELDS = ('id', 'post')
+MAX_ERRORS = 20
+
+
+class LookupMap:
+    """LRU «значение поля → id», который дозаполняется одним запросом."""
+
+    def __init__(self, queryset, field, size):
+        self.queryset = queryset
+        self.field = field
+        self.size = size
+        self.ids = OrderedDict()
+
+    def resolve(self, values):
+        missing = [value for value in values if value not in self.ids]
+        if missing:
+            self.ids.update(self.queryset.filter(
+                **{f'{self.field}__in': missing}
+            ).values_list(self.field, 'id'))
+        found = {}
+        for value in values:
+            if value in self.ids:
+                self.ids.move_to_end(value)
+                found[value] = self.ids[value]
+        while len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+        return found
+
+
+@contextmanager
+def _imported_dates():
+    # auto_now_add перезаписал бы даты из файла текущим временем
+    fields = [Post._meta.get_field('pub_date'),
+              Comment._meta.get_field('created')]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class Importer:
+    def __init__(self, batch_size=1000, lookup_size=100000, progress=None,
+                 rebuild=True):
+        self.batch_size = batch_size
+        self.progress = progress
+        # False — не сверять счётчики и не раскладывать по лентам
+        self.rebuild = rebuild
+        self.authors = LookupMap(
+            User.objects.all(), 'username', lookup_size)
+        self.groups = LookupMap(Group.objects.all(), 'slug', lookup_size)
+        self.pending = {kind: [] for kind in REQUIRED}
+        self.stats = Counter()
+        self.errors = []
+        self.started = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def skip(self, number, reason):
+        self.stats['skipped'] += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(f'строка {number}: {reason}')
+
+    def feed(self, lines):
+        """Разбирает строки JSONL и вставляет их по мере набора пачек."""
+        for number, line in enumerate(lines, 1):
+            self.stats['lines'] += 1
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                kind = record['type']
+                missing = [name for name in REQUIRED[kind]
+                           if record.get(name) in (None, '')]
+            except (ValueError, KeyError, TypeError):
+                self.skip(number, 'не JSON-объект с известным type')
+                continue
+            if missing:
+                self.skip(number, f'нет полей {", ".join(missing)}')
+                continue
+            if any(not isinstance(record.get(name, 0), int)
+                   for name in INTEGER_FIELDS):
+                self.skip(number, 'id должны быть целыми числами')
+                continue
+            pending = self.pending[kind]
+            pending.append((number, record))
+            if len(pending) >= self.batch_size:
+                self.flush(kind)
+
+    def flush(self, kind=None):
+        kinds = [kind] if kind else list(REQUIRED)
+        if kinds == ['comment']:
+            # комментарии ссылаются на посты, которые ещё могут ждать
+            kinds.insert(0, 'post')
+        for kind in kinds:
+            records, self.pending[kind] = self.pending[kind], []
+            if records:
+                getattr(self, f'_insert_{kind}s')(records)
+                if self.progress:
+                    self.progress(self)
+
+    def _date(self, number, value):
+        if value is None:
+            return timezone.now()
+        try:
+            date = parse_datetime(str(value))
+        except ValueError:
+            # формат верный, но даты нет: 2020-13-01
+            date = None
+        if date is None:
+            self.skip(number, f'неверная дата {value!r}')
+        elif settings.USE_TZ and timezone.is_naive(date):
+            date = timezone.make_aware(date)
+        return date
+
+    def _new(self, model, records):
+        # записи с id, которые уже есть в базе или повторяются в пачке
+        ids = {r['id'] for _, r in records if r.get('id') is not None}
+        seen = set(model.objects.filter(pk__in=ids).values_list(
+            'pk', flat=True))
+        for number, record in records:
+            pk = record.get('id')
+            if pk is not None:
+                if pk in seen:
+                    continue
+                seen.add(pk)
+            yield number, record
+
+    def _refresh(self, users=(), groups=(), posts=()):
+        # производные данные пачки восстанавливаются сразу после неё
+        if self.rebuild:
+            counters.reconcile_users(self.batch_size, ids=users)
+            counters.reconcile_posts(self.batch_size, ids=posts)
+            counters.reconcile_groups(self.batch_size, ids=groups)
+            feeds.authors_changed(users, self.batch_size)
+        feed_cache.bump_feed_version()
+        for group_id in groups:
+            feed_cache.bump_group_generation(group_id)
+        for user_id in users:
+            feed_cache.bump_author_generation(user_id)
+
+    def _insert_posts(self, records):
+        authors = self.authors.resolve({r['author'] for _, r in records})
+        groups = self.groups.resolve(
+            {r['group'] for _, r in records if r.get('group')})
+        posts = []
+        for number, record in self._new(Post, records):
+            author_id = authors.get(record['author'])
+            group_id = groups.get(record.get('group'))
+            if author_id is None:
+                self.skip(number, f'нет автора {record["author"]!r}')
+            elif record.get('group') and group_id is None:
+                self.skip(number, f'нет группы {record["group"]!r}')
+            else:
+                pub_date = self._date(number, record.get('pub_date'))
+                if pub_date is None:
+                    continue
+                posts.append(Post(
+                    id=record.get('id'), author_id=author_id,
+                    group_id=group_id, text=str(record['text']),
+                    pub_date=pub_date,
+                ))
+        with transaction.atomic(), _imported_dates():
+            Post.objects.bulk_create(posts, ignore_conflicts=True)
+        self.stats['post'] += len(posts)
+        since = {}
+        for post in posts:
+            since[post.author_id] = min(
+                post.pub_date, since.get(post.author_id, post.pub_date))
+        self._refresh(
+            users=set(since),
+            groups={post.group_id for post in posts} - {None})
+        if self.rebuild:
+            feeds.posts_added(since)
+
+    def _insert_comments(self, records):
+        authors = self.authors.resolve({r['author'] for _, r in records})
+        posts = set(Post.objects.filter(
+            pk__in={r['post'] for _, r in records}
+        ).values_list('pk', flat=True))
+        comments = []
+        for number, record in self._new(Comment, records):
+            author_id = authors.get(record['author'])
+            if author_id is None:
+                self.skip(number, f'нет автора {record["author"]!r}')
+            elif record['post'] not in posts:
+                self.skip(number, f'нет поста {record["post"]!r}')
+            else:
+                created = self._date(number, record.get('created'))
+                if created is None:
+                    continue
+                comments.append(Comment(
+                    id=record.get('id'), post_id=record['post'],
+                    author_id=author_id, text=str(record['text']),
+                    created=created,
+                ))
+        with transaction.atomic(), _imported_dates():
+            Comment.objects.bulk_create(comments, ignore_conflicts=True)
+        self.stats['comment'] += len(comments)
+        self._refresh(posts={comment.post_id for comment in comments})
+
+    def _insert_follows(self, records):
+        users = self.authors.resolve(
+            {r[name] for _, r in records for name in ('user', 'author')})
+        pairs = {}
+        for number, record in records:
+            user_id = users.get(record['user'])
+            author_id = users.get(record['author'])
+            if user_id is None or author_id is None:
+                self.skip(number, 'нет пользователя или автора')
+            elif user_id == author_id:
+                self.skip(number, 'подписка на себя')
+            else:
+                pairs[user_id, author_id] = Follow(
+                    user_id=user_id, author_id=author_id)
+        existing = Follow.objects.filter(
+            user_id__in={user_id for user_id, _ in pairs},
+            author_id__in={author_id for _, author_id in pairs},
+        ).values_list('user_id', 'author_id')
+        for pair in existing:
+            pairs.pop(pair, None)
+        with transaction.atomic():
+            Follow.objects.bulk_create(
+                pairs.values(), ignore_conflicts=True)
+        self.stats['follow'] += len(pairs)
+        self._refresh(users={pk for pair in pairs for pk in pair})
+        if self.rebuild:
+            for user_id, author_id in pairs:
+                feeds.backfill(user_id, author_id)
+
+    def finish(self):
+        """Дописывает хвосты пачек."""
+        self.flush()
+        return self.stats
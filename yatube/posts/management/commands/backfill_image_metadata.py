@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from posts import cache as feed_cache
+from posts import images
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = ('Заполняет размеры, вес и хеш картинок старых постов и '
+            'переводит одинаковые картинки на один файл')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=200,
+            help='Сколько постов обновлять в одной транзакции',
+        )
+
+    def _describe(self, name):
+        storage = Post._meta.get_field('image').storage
+        try:
+            with storage.open(name, 'rb') as file:
+                return images.describe(file)
+        except OSError:
+            return None
+
+    def _update_batch(self, posts):
+        updated = shared = 0
+        with transaction.atomic():
+            for pk, name in posts:
+                fields = self._describe(name)
+                if fields is None:
+                    continue
+                original = Post.objects.filter(
+                    image_hash=fields['image_hash']
+                ).exclude(image='').values_list('image', flat=True).first()
+                if original and original != name:
+                    fields['image'] = original
+                    shared += 1
+                Post.objects.filter(pk=pk).update(**fields)
+                updated += 1
+        return updated, shared
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        queryset = Post.objects.exclude(image='').filter(
+            image_hash='').order_by('pk').values_list('pk', 'image')
+        last_pk = 0
+        updated = shared = missing = 0
+        while True:
+            posts = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not posts:
+                break
+            last_pk = posts[-1][0]
+            batch_updated, batch_shared = self._update_batch(posts)
+            updated += batch_updated
+            shared += batch_shared
+            missing += len(posts) - batch_updated
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Обработано до поста {last_pk}')
+        if shared:
+            feed_cache.bump_feed_version()
+        self.stdout.write(
+            f'Картинок описано: {updated}, переведено на общий файл: '
+            f'{shared}, файлов не найдено: {missing}')
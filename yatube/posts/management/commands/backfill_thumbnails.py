@@ -0,0 +1,83 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.background import pool
+from posts import cache as feed_cache
+from posts import thumbnails
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = ('Строит недостающие варианты миниатюр (ширины и форматы) '
+            'для картинок уже опубликованных постов')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Сколько процессов строят миниатюры, 0 — в этом процессе',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Сколько картинок проверять за раз',
+        )
+
+    def _missing(self, names):
+        missing = set()
+        for size in settings.POST_THUMBNAILS:
+            for name, picture in thumbnails.resolve(names, size).items():
+                if picture is None or not picture['complete']:
+                    missing.add(name)
+        return sorted(missing)
+
+    def _batches(self, batch_size):
+        images = Post.objects.exclude(image='').order_by('pk').values_list(
+            'image', flat=True).iterator(chunk_size=batch_size)
+        batch = set()
+        for name in images:
+            batch.add(name)
+            if len(batch) == batch_size:
+                yield batch
+                batch = set()
+        if batch:
+            yield batch
+
+    def _bump(self, names):
+        """Сбрасывает фрагменты профилей и групп с заглушками этих картинок."""
+        pairs = set(Post.objects.filter(image__in=names).values_list(
+            'author_id', 'group_id'))
+        for author_id in {author_id for author_id, _ in pairs}:
+            feed_cache.bump_author_generation(author_id)
+        for group_id in {group_id for _, group_id in pairs} - {None}:
+            feed_cache.bump_group_generation(group_id)
+
+    def _run(self, generate, batch_size):
+        checked = built = failed = 0
+        for batch in self._batches(batch_size):
+            missing = self._missing(batch)
+            results = list(generate(thumbnails.generate_safely, missing))
+            self._bump([
+                name for name, done in zip(missing, results) if done])
+            checked += len(batch)
+            built += sum(results)
+            failed += len(results) - sum(results)
+            if self.verbosity > 1:
+                self.stdout.write(
+                    f'Проверено {checked}, построено {built}')
+        return checked, built, failed
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        batch_size = options['batch_size']
+        if options['workers']:
+            with pool(options['workers']) as executor:
+                checked, built, failed = self._run(executor.map, batch_size)
+        else:
+            checked, built, failed = self._run(map, batch_size)
+        if built:
+            # в закешированных фрагментах лент могли остаться заглушки
+            feed_cache.bump_feed_version()
+        self.stdout.write(
+            f'Картинок проверено: {checked}, дополнено: {built}, '
+            f'с ошибками: {failed}')
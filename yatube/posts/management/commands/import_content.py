@@ -0,0 +1,62 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from posts.importer import Importer
+
+
+class Command(BaseCommand):
+    help = 'Импортирует посты, комментарии и подписки из файлов JSONL'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help="Файлы JSONL, '-' — стандартный ввод",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Сколько строк вставлять в одной транзакции',
+        )
+        parser.add_argument(
+            '--lookup-size', type=int, default=100000,
+            help='Сколько авторов и групп держать в кеше поиска',
+        )
+        parser.add_argument(
+            '--skip-rebuild', action='store_true',
+            help='Не сверять счётчики и не раскладывать посты по лентам',
+        )
+
+    def handle(self, *args, **options):
+        importer = Importer(
+            batch_size=options['batch_size'],
+            lookup_size=options['lookup_size'],
+            progress=self.progress if options['verbosity'] > 1 else None,
+            rebuild=not options['skip_rebuild'],
+        )
+        for path in options['paths']:
+            if path == '-':
+                importer.feed(sys.stdin)
+            else:
+                with open(path, encoding='utf-8') as lines:
+                    importer.feed(lines)
+        importer.flush()
+        imported = importer.elapsed()
+        stats = importer.finish()
+        for error in importer.errors:
+            self.stderr.write(error)
+        rows = stats['post'] + stats['comment'] + stats['follow']
+        self.stdout.write(self.style.SUCCESS(
+            f'Постов: {stats["post"]}, комментариев: {stats["comment"]}, '
+            f'подписок: {stats["follow"]}, пропущено строк: '
+            f'{stats["skipped"]}. Вставка {imported:.1f} с '
+            f'({rows / max(imported, 1e-9):.0f} строк/с), всего '
+            f'{importer.elapsed():.1f} с'
+        ))
+
+    def progress(self, importer):
+        stats = importer.stats
+        rows = stats['post'] + stats['comment'] + stats['follow']
+        self.stdout.write(
+            f'{stats["lines"]} строк, {rows} вставлено, '
+            f'{rows / max(importer.elapsed(), 1e-9):.0f} строк/с'
+        )
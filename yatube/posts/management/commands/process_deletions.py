@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from posts import deletion
+
+
+class Command(BaseCommand):
+    help = ('Выполняет отложенные удаления пользователей и групп пачками. '
+            'Запускайте не больше одного воркера.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Сколько строк удалять в одной транзакции',
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0,
+            help='Пауза между пачками в секундах, чтобы пропустить '
+                 'других писателей',
+        )
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Не завершаться, а ждать новых заданий',
+        )
+        parser.add_argument(
+            '--poll', type=float, default=5,
+            help='Как часто проверять новые задания в режиме --loop',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = deletion.process(
+                options['batch_size'], options['pause'])
+            if processed or not options['loop']:
+                self.stdout.write(f'Выполнено заданий: {processed}')
+            if not options['loop']:
+                return
+            time.sleep(options['poll'])
@@ -0,0 +1,29 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from posts import feeds
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает материализованные ленты подписок'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'usernames', nargs='*',
+            help='Пересобрать только ленты этих пользователей',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Сколько лент пересобирать в одной транзакции',
+        )
+
+    def handle(self, *args, **options):
+        user_ids = None
+        if options['usernames']:
+            user_ids = list(User.objects.filter(
+                username__in=options['usernames']
+            ).values_list('id', flat=True))
+        feeds.rebuild(user_ids, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Ленты подписок пересобраны'))
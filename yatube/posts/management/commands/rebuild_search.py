@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from posts import search
+
+
+class Command(BaseCommand):
+    help = 'Строит полнотекстовый индекс постов заново'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--optimize', action='store_true',
+            help='Слить сегменты индекса после перестроения',
+        )
+
+    def handle(self, *args, **options):
+        search.rebuild_index(optimize=options['optimize'])
+        self.stdout.write('Поисковый индекс перестроен')
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from posts import counters
+
+
+class Command(BaseCommand):
+    help = 'Сверяет денормализованные счётчики с данными и чинит дрейф'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Сколько строк проверять в одной транзакции',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for name, reconcile in (
+            ('пользователей', counters.reconcile_users),
+            ('постов', counters.reconcile_posts),
+            ('групп', counters.reconcile_groups),
+        ):
+            repaired = reconcile(batch_size)
+            self.stdout.write(f'Исправлено счётчиков {name}: {repaired}')
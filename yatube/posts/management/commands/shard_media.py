@@ -0,0 +1,112 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from sorl.thumbnail import default
+from sorl.thumbnail.images import ImageFile
+
+from posts import cache as feed_cache
+from posts import images, thumbnails
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = ('Переносит картинки постов из плоского каталога в разложенную '
+            'по хешу схему. Можно прервать и запустить снова: продолжит '
+            'с оставшихся.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Сколько постов переключать в одной транзакции',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Процессы для миниатюр новых имён, 0 — в этом процессе',
+        )
+        parser.add_argument(
+            '--delete-old', action='store_true',
+            help='Удалять старый файл и его миниатюры после переключения',
+        )
+
+    def _copy(self, name, digest):
+        field = Post._meta.get_field('image')
+        storage = field.storage
+        new_name = field.generate_filename(
+            None, images.sharded_name(digest, name))
+        if not storage.exists(new_name):
+            with storage.open(name, 'rb') as file:
+                new_name = storage.save(new_name, file)
+        return new_name
+
+    def _metadata(self, name, digest):
+        if digest:
+            return {}
+        storage = Post._meta.get_field('image').storage
+        with storage.open(name, 'rb') as file:
+            return images.describe(file)
+
+    def _move_batch(self, batch, generate, delete_old):
+        """Копирует файлы, строит миниатюры и переключает посты."""
+        moves = {}
+        missing = 0
+        for name, digest in batch.items():
+            try:
+                metadata = self._metadata(name, digest)
+                digest = digest or metadata['image_hash']
+                moves[name] = (self._copy(name, digest), metadata)
+            except OSError:
+                missing += 1
+        # посты переключаются на уже готовые миниатюры, без заглушек
+        list(generate(
+            thumbnails.generate_safely,
+            [new_name for new_name, _ in moves.values()]))
+        pairs = set()
+        with transaction.atomic():
+            for name, (new_name, metadata) in moves.items():
+                posts = Post.objects.filter(image=name)
+                pairs.update(posts.values_list('author_id', 'group_id'))
+                posts.update(image=new_name, **metadata)
+        for author_id in {author_id for author_id, _ in pairs}:
+            feed_cache.bump_author_generation(author_id)
+        for group_id in {group_id for _, group_id in pairs} - {None}:
+            feed_cache.bump_group_generation(group_id)
+        if moves:
+            feed_cache.bump_feed_version()
+        if delete_old:
+            for name in moves:
+                default.kvstore.delete(ImageFile(name))
+                Post._meta.get_field('image').storage.delete(name)
+        return len(moves), missing
+
+    def _run(self, generate, batch_size, delete_old):
+        queryset = Post.objects.exclude(image='').exclude(
+            image__regex=images.SHARDED_NAME.pattern
+        ).order_by('pk').values_list('pk', 'image', 'image_hash')
+        last_pk = 0
+        moved = missing = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            batch = {name: digest for _, name, digest in rows}
+            batch_moved, batch_missing = self._move_batch(
+                batch, generate, delete_old)
+            moved += batch_moved
+            missing += batch_missing
+            if self.verbosity > 1:
+                self.stdout.write(
+                    f'Обработано до поста {last_pk}, перенесено {moved}')
+        return moved, missing
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        arguments = (options['batch_size'], options['delete_old'])
+        if options['workers']:
+            with thumbnails.pool(options['workers']) as executor:
+                moved, missing = self._run(executor.map, *arguments)
+        else:
+            moved, missing = self._run(map, *arguments)
+        self.stdout.write(
+            f'Файлов перенесено: {moved}, не найдено: {missing}')
@@ -0,0 +1,99 @@
+# Generated by Django 2.2.16 on 2026-10-17 05:55
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+
+
+BATCH_SIZE = 1000
+
+
+def _batches(model):
+    last_pk = 0
+    while True:
+        ids = list(model.objects.filter(pk__gt=last_pk).order_by(
+            'pk').values_list('pk', flat=True)[:BATCH_SIZE])
+        if not ids:
+            return
+        yield ids
+        last_pk = ids[-1]
+
+
+def _counts(queryset, field, ids):
+    # один сгруппированный COUNT на пачку вместо запроса на строку
+    return dict(
+        queryset.filter(**{f'{field}__in': ids}).order_by().values(
+            field).annotate(total=Count('pk')).values_list(field, 'total')
+    )
+
+
+def _fill_field(model, field, related, related_field):
+    for ids in _batches(model):
+        changed = defaultdict(list)
+        for pk, total in _counts(related.objects, related_field, ids).items():
+            changed[total].append(pk)
+        # новое поле уже 0, обновляются только ненулевые — UPDATE на
+        # каждое значение, а не на каждую строку
+        for total, pks in changed.items():
+            model.objects.filter(pk__in=pks).update(**{field: total})
+
+
+def fill_counters(apps, schema_editor):
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    Group = apps.get_model('posts', 'Group')
+    Post = apps.get_model('posts', 'Post')
+    Comment = apps.get_model('posts', 'Comment')
+    Follow = apps.get_model('posts', 'Follow')
+    UserStats = apps.get_model('posts', 'UserStats')
+    for ids in _batches(User):
+        posts = _counts(Post.objects, 'author_id', ids)
+        followers = _counts(Follow.objects, 'author_id', ids)
+        following = _counts(Follow.objects, 'user_id', ids)
+        UserStats.objects.bulk_create([
+            UserStats(
+                user_id=pk,
+                posts_count=posts.get(pk, 0),
+                followers_count=followers.get(pk, 0),
+                following_count=following.get(pk, 0),
+            ) for pk in ids
+        ])
+    _fill_field(Group, 'posts_count', Post, 'group_id')
+    _fill_field(Post, 'comments_count', Comment, 'post_id')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0011_update_proxy_permissions'),
+        ('posts', '0007_feedentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('posts_count', models.PositiveIntegerField(default=0, verbose_name='Постов')),
+                ('followers_count', models.PositiveIntegerField(db_index=True, default=0, verbose_name='Подписчиков')),
+                ('following_count', models.PositiveIntegerField(default=0, verbose_name='Подписок')),
+            ],
+            options={
+                'verbose_name': 'Счётчики пользователя',
+                'verbose_name_plural': 'Счётчики пользователей',
+            },
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='posts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество постов'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество комментариев'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.16 on 2026-10-17 06:50
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_pulled(apps, schema_editor):
+    UserStats = apps.get_model('posts', 'UserStats')
+    UserStats.objects.filter(
+        followers_count__gt=settings.FEED_FANOUT_FOLLOWER_LIMIT
+    ).update(fanout_pulled=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0012_post_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstats',
+            name='fanout_pulled',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='Подмешивается при чтении'),
+        ),
+        migrations.RunPython(mark_pulled, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.16 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+def mark_pending(apps, schema_editor):
+    DeletionJob = apps.get_model('posts', 'DeletionJob')
+    UserStats = apps.get_model('posts', 'UserStats')
+    pending = DeletionJob.objects.filter(
+        kind='user', status__in=('pending', 'running')
+    ).values('object_id')
+    UserStats.objects.filter(user_id__in=pending).update(
+        pending_deletion=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0013_userstats_fanout_pulled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstats',
+            name='pending_deletion',
+            field=models.BooleanField(db_index=True, default=False, editable=False, verbose_name='Ожидает удаления'),
+        ),
+        migrations.RunPython(mark_pending, migrations.RunPython.noop),
+    ]
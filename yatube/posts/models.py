@@ -8,11 +8,25 @@ class Group(models.Model):
     title = models.CharField(max_length=200)
     slug = models.SlugField(unique=True)
     description = models.TextField()
+    posts_count = models.PositiveIntegerField(
+        'Количество постов', default=0, editable=False)
+    # группа скрыта и ждёт удаления воркером process_deletions
+    pending_deletion = models.BooleanField(
+        'Ожидает удаления', default=False, editable=False)
 
     def __str__(self):
         return self.title
 
 
+class PostQuerySet(models.QuerySet):
+    def visible(self):
+        """Посты без авторов, ожидающих удаления."""
+        # NOT IN по индексу pending_deletion, без соединения с
+        # пользователями: ленты по-прежнему читаются диапазоном индекса
+        return self.exclude(author_id__in=UserStats.objects.filter(
+            pending_deletion=True).values('user_id'))
+
+
 class Post(models.Model):
     text = models.TextField('Текст поста')
     pub_date = models.DateTimeField(auto_now_add=True)
@@ -37,15 +51,44 @@ class Post(models.Model):
         upload_to='posts/',
         blank=True
     )
+    # заполняются при загрузке (posts.images), чтобы не открывать файл
+    image_width = models.PositiveIntegerField(
+        'Ширина картинки', null=True, blank=True, editable=False)
+    image_height = models.PositiveIntegerField(
+        'Высота картинки', null=True, blank=True, editable=False)
+    image_size = models.PositiveIntegerField(
+        'Размер картинки в байтах', null=True, blank=True, editable=False)
+    image_hash = models.CharField(
+        'SHA-256 картинки', max_length=64, blank=True, editable=False,
+        db_index=True)
+    comments_count = models.PositiveIntegerField(
+        'Количество комментариев', default=0, editable=False)
+
+    objects = PostQuerySet.as_manager()
 
     def __str__(self):
         # выводим текст поста
         return self.text[:15]
 
     class Meta:
-        ordering = ['-pub_date']
+        ordering = ['-pub_date', '-id']
         verbose_name = 'Пост'
         verbose_name_plural = 'Посты'
+        # ленты читаются диапазоном индекса в порядке сортировки
+        indexes = [
+            models.Index(
+                fields=['-pub_date', '-id'],
+                name='post_pub_date_idx'
+            ),
+            models.Index(
+                fields=['author', '-pub_date', '-id'],
+                name='post_author_pub_date_idx'
+            ),
+            models.Index(
+                fields=['group', '-pub_date', '-id'],
+                name='post_group_pub_date_idx'
+            ),
+        ]
 
 
 class Comment(models.Model):
@@ -79,6 +122,12 @@ class Comment(models.Model):
         ordering = [
             '-created',
         ]
+        indexes = [
+            models.Index(
+                fields=['post', '-created'],
+                name='comment_post_created_idx'
+            )
+        ]
 
     def __str__(self):
         return self.text[:15]
@@ -107,3 +156,137 @@ class Follow(models.Model):
                 name='unique_following'
             )
         ]
+        indexes = [
+            models.Index(
+                fields=['author', 'user'],
+                name='follow_author_user_idx'
+            )
+        ]
+
+
+class UserStats(models.Model):
+    """Поддерживаемые счётчики пользователя, чтобы не делать COUNT."""
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='stats',
+        verbose_name='Пользователь',
+    )
+    posts_count = models.PositiveIntegerField('Постов', default=0)
+    followers_count = models.PositiveIntegerField(
+        'Подписчиков', default=0, db_index=True)
+    following_count = models.PositiveIntegerField('Подписок', default=0)
+    # посты автора не раскладываются по лентам, а подмешиваются при чтении
+    fanout_pulled = models.BooleanField(
+        'Подмешивается при чтении', default=False, db_index=True)
+    # автор скрыт и ждёт удаления воркером process_deletions; отдельно
+    # от is_active, чтобы деактивация в админке не прятала посты
+    pending_deletion = models.BooleanField(
+        'Ожидает удаления', default=False, editable=False, db_index=True)
+
+    class Meta:
+        verbose_name = 'Счётчики пользователя'
+        verbose_name_plural = 'Счётчики пользователей'
+
+    def __str__(self):
+        return str(self.user)
+
+
+class FeedEntry(models.Model):
+    """Материализованная лента подписок: строка на пару (читатель, пост).
+
+    pub_date продублирована из поста, чтобы лента читалась одним
+    проходом по индексу (user, -pub_date, -post) без сортировки.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Читатель',
+    )
+    post = models.ForeignKey(
+        Post,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Пост',
+    )
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        ordering = ['-pub_date', '-post']
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Записи ленты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'post'],
+                name='unique_feed_entry'
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=['user', '-pub_date', '-post'],
+                name='feed_user_pub_date_idx'
+            )
+        ]
+
+
+class DeletionJob(models.Model):
+    """Отложенное удаление пользователя или группы.
+
+    Объект сразу скрывается, а зависимые строки удаляет пачками
+    команда process_deletions, отмечая здесь прогресс.
+    """
+    USER = 'user'
+    GROUP = 'group'
+    KINDS = (
+        (USER, 'Пользователь'),
+        (GROUP, 'Группа'),
+    )
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Ожидает'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Готово'),
+        (FAILED, 'Ошибка'),
+    )
+    ACTIVE = (PENDING, RUNNING)
+
+    kind = models.CharField('Что удаляется', max_length=10, choices=KINDS)
+    object_id = models.PositiveIntegerField('id объекта')
+    label = models.CharField('Объект', max_length=200)
+    status = models.CharField(
+        'Состояние', max_length=10, choices=STATUSES, default=PENDING,
+        db_index=True)
+    step = models.CharField('Шаг', max_length=50, blank=True)
+    processed = models.PositiveIntegerField('Обработано строк', default=0)
+    total = models.PositiveIntegerField('Всего строк (оценка)', default=0)
+    error = models.TextField('Ошибка', blank=True)
+    created = models.DateTimeField('Создано', auto_now_add=True)
+    finished = models.DateTimeField('Завершено', null=True, blank=True)
+
+    class Meta:
+        ordering = ['created']
+        verbose_name = 'Отложенное удаление'
+        verbose_name_plural = 'Отложенные удаления'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'object_id'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='unique_active_deletion'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} {self.label}'
+
+    @property
+    def progress(self):
+        if self.status == self.DONE:
+            return 100
+        if not self.total:
+            return 0
+        return min(99, self.processed * 100 // self.total)
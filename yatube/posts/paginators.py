@@ -0,0 +1,213 @@
+import base64
+import binascii
+import json
+from collections.abc import Sequence
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+
+def _default(value):
+    # DjangoJSONEncoder обрезает микросекунды, а ключ должен быть точным
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(values):
+    """Упаковывает значения ключа сортировки в непрозрачный токен."""
+    raw = json.dumps(list(values), default=_default)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Распаковывает токен; для битого токена возвращает None."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw.decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if not isinstance(values, list):
+        return None
+    return values
+
+
+def elided_page_range(page, on_each_side=3, on_ends=2):
+    """Номера страниц для навигации: края и окрестность текущей.
+
+    Повторяет Paginator.get_elided_page_range из Django 3.2: пропуски
+    обозначаются None, а длина не зависит от общего числа страниц.
+    """
+    number = page.number
+    num_pages = page.paginator.num_pages
+    if num_pages <= (on_each_side + on_ends) * 2:
+        yield from range(1, num_pages + 1)
+        return
+    if number > 1 + on_each_side + on_ends + 1:
+        yield from range(1, on_ends + 1)
+        yield None
+        yield from range(number - on_each_side, number + 1)
+    else:
+        yield from range(1, number + 1)
+    if number < num_pages - on_each_side - on_ends - 1:
+        yield from range(number + 1, number + on_each_side + 1)
+        yield None
+        yield from range(num_pages - on_ends + 1, num_pages + 1)
+    else:
+        yield from range(number + 1, num_pages + 1)
+
+
+class CountedPaginator(Paginator):
+    """Paginator, который берёт число объектов из готового счётчика,
+    а не из COUNT(*) по object_list.
+
+    count — число или функция без аргументов, вызываемая только тогда,
+    когда номер страницы действительно нужно проверить.
+    """
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self._count = count
+
+    @cached_property
+    def count(self):
+        if callable(self._count):
+            return self._count()
+        return self._count
+
+
+class CursorPaginator:
+    """Keyset-пагинация: страница выбирается условием по ключу
+    сортировки, а не OFFSET, поэтому стоимость не зависит от глубины.
+
+    object_list должен поддерживать filter(), order_by() и срезы.
+    """
+
+    def __init__(self, object_list, per_page, ordering=('-pub_date', '-id')):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.ordering = tuple(ordering)
+        self.fields = [name.lstrip('-') for name in self.ordering]
+
+    def get_page(self, after=None, before=None):
+        if after:
+            return CursorPage(self, after=self._to_python(after))
+        if before:
+            return CursorPage(self, before=self._to_python(before))
+        return CursorPage(self)
+
+    def cursor_for(self, obj):
+        return encode_cursor(getattr(obj, name) for name in self.fields)
+
+    def _to_python(self, token):
+        values = decode_cursor(token)
+        if values is None or len(values) != len(self.fields):
+            return None
+        try:
+            return [
+                self._field(name).to_python(value)
+                for name, value in zip(self.fields, values)
+            ]
+        except ValidationError:
+            return None
+
+    def _field(self, name):
+        annotations = self.object_list.query.annotations
+        if name in annotations:
+            return annotations[name].output_field
+        return self.object_list.model._meta.get_field(name)
+
+    def _keyset_filter(self, values, forward):
+        # (a, b) < (x, y)  <=>  a < x OR (a = x AND b < y)
+        condition = Q()
+        for position, ordering in enumerate(self.ordering):
+            descending = ordering.startswith('-')
+            lookup = 'lt' if descending == forward else 'gt'
+            name = self.fields[position]
+            step = Q(**{f'{name}__{lookup}': values[position]})
+            for prev_name, prev_value in zip(
+                    self.fields[:position], values[:position]):
+                step &= Q(**{prev_name: prev_value})
+            condition |= step
+        return condition
+
+    def _reversed_ordering(self):
+        return [
+            name[1:] if name.startswith('-') else f'-{name}'
+            for name in self.ordering
+        ]
+
+    def fetch(self, after=None, before=None):
+        """Возвращает (объекты, есть_ли_ещё_в_направлении_выборки)."""
+        queryset = self.object_list
+        if before is not None:
+            queryset = queryset.filter(
+                self._keyset_filter(before, forward=False)
+            ).order_by(*self._reversed_ordering())
+        else:
+            if after is not None:
+                queryset = queryset.filter(
+                    self._keyset_filter(after, forward=True))
+            queryset = queryset.order_by(*self.ordering)
+        items = list(queryset[:self.per_page + 1])
+        has_more = len(items) > self.per_page
+        items = items[:self.per_page]
+        if before is not None:
+            items.reverse()
+        return items, has_more
+
+
+class CursorPage(Sequence):
+    """Страница курсорной пагинации, совместимая с шаблонами,
+    которые работают с django.core.paginator.Page."""
+
+    is_cursor = True
+
+    def __init__(self, paginator, after=None, before=None):
+        self.paginator = paginator
+        self.after = after
+        self.before = before
+
+    @cached_property
+    def _fetched(self):
+        return self.paginator.fetch(after=self.after, before=self.before)
+
+    @property
+    def object_list(self):
+        return self._fetched[0]
+
+    def __repr__(self):
+        return f'<Cursor page of {len(self)} items>'
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        if self.before is not None:
+            return bool(self.object_list)
+        return self._fetched[1]
+
+    def has_previous(self):
+        if self.before is not None:
+            return self._fetched[1]
+        return self.after is not None and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    @property
+    def next_cursor(self):
+        if not self.has_next():
+            return None
+        return self.paginator.cursor_for(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if not self.has_previous():
+            return None
+        return self.paginator.cursor_for(self.object_list[0])
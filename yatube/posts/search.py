@@ -0,0 +1,81 @@
+"""Полнотекстовый поиск по постам на SQLite FTS5.
+
+Индекс posts_post_fts (миграция 0010_post_search) хранит только токены и
+обновляется триггерами на posts_post. Запрос пользователя не попадает в
+MATCH как есть: из него берутся слова, каждое заключается в кавычки,
+поэтому операторы FTS5 в запросе не приводят к ошибке.
+
+SQLite меняет схему, пересоздавая таблицу, и триггеры posts_post при этом
+пропадают. Миграции, меняющие Post, создают их заново своим SQL (как
+0012_post_image_metadata); сам индекс не страдает, id постов сохраняются.
+"""
+import re
+
+from django.db import connection
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+
+from .models import Post
+
+# rank FTS5 — это bm25 со знаком минус: лучшие совпадения идут первыми
+SEARCH_ORDERING = ('search_rank', 'id')
+MAX_TERMS = 10
+
+_WORD = re.compile(r'\w+')
+
+
+def match_expression(query):
+    """Выражение для MATCH из слов запроса; последнее слово — префикс.
+
+    Возвращает None, если в запросе нет ни одного слова.
+    """
+    words = _WORD.findall(query)[:MAX_TERMS]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search_posts(query):
+    """Посты, содержащие все слова запроса, по убыванию релевантности."""
+    posts = Post.objects.visible().annotate(
+        search_rank=RawSQL(
+            'posts_post_fts.rank', (), output_field=FloatField()),
+    ).select_related('author', 'group').order_by(*SEARCH_ORDERING)
+    match = match_expression(query)
+    if match is None:
+        return posts.none()
+    return posts.extra(
+        tables=['posts_post_fts'],
+        where=[
+            'posts_post_fts.rowid = posts_post.id',
+            'posts_post_fts MATCH %s',
+        ],
+        params=[match],
+    )
+
+
+def filter_matching(queryset, query):
+    """Оставляет в queryset постов только подходящие под запрос."""
+    match = match_expression(query)
+    if match is None:
+        return queryset.none()
+    return queryset.extra(
+        where=[
+            'posts_post.id IN (SELECT rowid FROM posts_post_fts '
+            'WHERE posts_post_fts MATCH %s)',
+        ],
+        params=[match],
+    )
+
+
+def rebuild_index(optimize=False):
+    """Перестраивает индекс по posts_post и при желании сжимает его."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO posts_post_fts(posts_post_fts) VALUES ('rebuild')")
+        if optimize:
+            cursor.execute(
+                "INSERT INTO posts_post_fts(posts_post_fts) "
+                "VALUES ('optimize')")
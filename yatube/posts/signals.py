@@ -0,0 +1,124 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import (post_delete, post_init, post_save,
+                                      pre_save)
+from django.dispatch import receiver
+
+from . import autocomplete
+from . import cache as feed_cache
+from . import feeds
+from . import images
+from . import thumbnails
+from .counters import bump
+from .models import Comment, Follow, Group, Post, UserStats
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, raw=False, update_fields=None,
+               **kwargs):
+    if raw:
+        return
+    if created:
+        UserStats.objects.get_or_create(user=instance)
+    elif update_fields is not None and set(update_fields) == {'last_login'}:
+        # вход пользователя не меняет того, что видно в лентах
+        return
+    else:
+        # у нового пользователя нет ни постов, ни закешированных страниц
+        feed_cache.bump_author_generation(instance.pk)
+        feed_cache.bump_feed_version()
+    # поиск по username и автодополнение должны увидеть нового автора:
+    # autocomplete сдвигает и версию пользователей
+    autocomplete.user_changed(instance)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    feed_cache.bump_author_generation(instance.pk)
+    feed_cache.bump_feed_version()
+    autocomplete.user_removed(instance)
+
+
+@receiver(post_init, sender=Post)
+def remember_group(sender, instance, **kwargs):
+    # исходная группа нужна, чтобы перенести счётчик при смене группы
+    instance._loaded_group_id = instance.group_id
+    # по новой картинке после сохранения строятся миниатюры
+    instance._loaded_image = str(instance.__dict__.get('image') or '')
+
+
+@receiver(pre_save, sender=Post)
+def post_saving(sender, instance, raw=False, **kwargs):
+    if not raw:
+        images.prepare(instance)
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        bump(UserStats, instance.author_id, 'posts_count', 1)
+        bump(Group, instance.group_id, 'posts_count', 1)
+        feeds.fan_out_post(instance)
+    elif instance._loaded_group_id != instance.group_id:
+        bump(Group, instance._loaded_group_id, 'posts_count', -1)
+        bump(Group, instance.group_id, 'posts_count', 1)
+        feed_cache.bump_group_generation(instance._loaded_group_id)
+    instance._loaded_group_id = instance.group_id
+    if instance.image and instance.image.name != instance._loaded_image:
+        thumbnails.schedule(instance)
+    instance._loaded_image = instance.image.name or ''
+    feed_cache.bump_feed_version()
+    feed_cache.bump_group_generation(instance.group_id)
+    feed_cache.bump_author_generation(instance.author_id)
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    bump(UserStats, instance.author_id, 'posts_count', -1)
+    bump(Group, instance._loaded_group_id, 'posts_count', -1)
+    feed_cache.bump_feed_version()
+    feed_cache.bump_group_generation(instance._loaded_group_id)
+    feed_cache.bump_author_generation(instance.author_id)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def group_changed(sender, instance, signal, raw=False, **kwargs):
+    if raw:
+        return
+    feed_cache.bump_group_generation(instance.pk)
+    feed_cache.bump_feed_version()
+    # вместе с индексом autocomplete сдвигает версию групп
+    if signal is post_delete:
+        autocomplete.group_removed(instance)
+    else:
+        autocomplete.group_changed(instance)
+
+
+@receiver(post_save, sender=Comment)
+def comment_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        bump(Post, instance.post_id, 'comments_count', 1)
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    bump(Post, instance.post_id, 'comments_count', -1)
+
+
+@receiver(post_save, sender=Follow)
+def follow_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        bump(UserStats, instance.author_id, 'followers_count', 1)
+        bump(UserStats, instance.user_id, 'following_count', 1)
+        feeds.follow_added(instance.user_id, instance.author_id)
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    bump(UserStats, instance.author_id, 'followers_count', -1)
+    bump(UserStats, instance.user_id, 'following_count', -1)
+    feeds.follow_removed(instance.user_id, instance.author_id)
@@ -0,0 +1,47 @@
+from django import template
+from django.core.cache.utils import make_template_fragment_key
+
+from core.routers import replica_timeout
+from posts.cache import get_or_compute
+
+register = template.Library()
+
+
+class FeedCacheNode(template.Node):
+    def __init__(self, nodelist, timeout, fragment_name, vary_on):
+        self.nodelist = nodelist
+        self.timeout = timeout
+        self.fragment_name = fragment_name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        timeout = int(self.timeout.resolve(context))
+        vary_on = [var.resolve(context) for var in self.vary_on]
+        key = make_template_fragment_key(self.fragment_name, vary_on)
+        # фрагмент строится с реплики, поэтому живёт не дольше, чем
+        # она может отставать
+        return get_or_compute(
+            key, lambda: self.nodelist.render(context),
+            replica_timeout(timeout))
+
+
+@register.tag
+def feed_cache(parser, token):
+    """Как {% cache %}, но с защитой от stampede и stale-while-revalidate.
+
+        {% feed_cache timeout fragment_name [var1 var2 ...] %}
+            ...
+        {% endfeed_cache %}
+    """
+    nodelist = parser.parse(('endfeed_cache',))
+    parser.delete_first_token()
+    tokens = token.split_contents()
+    if len(tokens) < 3:
+        raise template.TemplateSyntaxError(
+            f'{tokens[0]!r} tag requires at least 2 arguments.')
+    return FeedCacheNode(
+        nodelist,
+        parser.compile_filter(tokens[1]),
+        tokens[2],
+        [parser.compile_filter(bit) for bit in tokens[3:]],
+    )
@@ -0,0 +1,10 @@
+from django import template
+
+from posts.paginators import elided_page_range
+
+register = template.Library()
+
+
+@register.filter
+def page_window(page_obj):
+    return list(elided_page_range(page_obj))
@@ -0,0 +1,39 @@
+from django import template
+from django.conf import settings
+
+from posts import thumbnails
+
+register = template.Library()
+
+
+def _page_thumbnails(context, size):
+    # миниатюры всей страницы ищутся одной пачкой при первом теге
+    page_obj = context.get('page_obj')
+    if page_obj is None:
+        return {}
+    resolved = getattr(page_obj, '_thumbnails', None)
+    if resolved is None:
+        resolved = page_obj._thumbnails = {}
+    if size not in resolved:
+        resolved[size] = thumbnails.resolve(
+            [post.image for post in page_obj.object_list], size)
+    return resolved[size]
+
+
+@register.inclusion_tag('includes/post_image.html', takes_context=True)
+def post_image(context, post, size='card'):
+    """<picture> с вариантами картинки поста или заглушка, пока их строят."""
+    result = {'picture': None, 'image': post.image}
+    if not post.image:
+        return result
+    pictures = _page_thumbnails(context, size)
+    if post.image.name not in pictures:
+        pictures = thumbnails.resolve([post.image], size)
+    result['picture'] = pictures[post.image.name]
+    if result['picture'] is None:
+        # картинки, загруженные до фоновой генерации, догоняем при показе
+        thumbnails.schedule_missing(post)
+    geometry, _ = settings.POST_THUMBNAILS[size]
+    result['width'], _, result['height'] = geometry.partition('x')
+    result['sizes'] = settings.POST_IMAGE_SIZES
+    return result
@@ -0,0 +1,231 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from core.cache import TwoTierCache
+from posts.cache import (bump_version, cache_stats, get_or_compute,
+                         get_version, reset_cache_stats)
+
+
+@override_settings(FEED_CACHE_STALE_TIMEOUT=60, FEED_CACHE_EARLY_BETA=0,
+                   FEED_CACHE_LOCK_TIMEOUT=1, FEED_CACHE_LOCK_POLL=0.01)
+class TestGetOrCompute(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_cache_stats()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return f'value {self.calls}'
+
+    def expire(self, key):
+        value, _, delta = cache.get(key)
+        cache.set(key, (value, time.time() - 1, delta), 60)
+
+    def test_hit_and_miss(self):
+        """Первый запрос считает значение, второй берёт из кеша"""
+        self.assertEqual(get_or_compute('key', self.compute, 10), 'value 1')
+        self.assertEqual(get_or_compute('key', self.compute, 10), 'value 1')
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache_stats(), {'misses': 1, 'hits': 1})
+
+    def test_stale_served_while_other_worker_recomputes(self):
+        """Пока ключ пересчитывает другой воркер, отдаётся старая копия"""
+        get_or_compute('key', self.compute, 10)
+        self.expire('key')
+        cache.add('posts:lock:key', 1, 10)
+        self.assertEqual(get_or_compute('key', self.compute, 10), 'value 1')
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache_stats()['stale'], 1)
+
+    def test_expired_value_recomputed_once(self):
+        """Истёкшее значение пересчитывает воркер, взявший блокировку"""
+        get_or_compute('key', self.compute, 10)
+        self.expire('key')
+        self.assertEqual(get_or_compute('key', self.compute, 10), 'value 2')
+        self.assertEqual(get_or_compute('key', self.compute, 10), 'value 2')
+        self.assertEqual(self.calls, 2)
+        self.assertIsNone(cache.get('posts:lock:key'))
+
+    def test_miss_waits_for_lock_holder(self):
+        """При промахе под чужой блокировкой воркер ждёт результата"""
+        cache.add('posts:lock:key', 1, 10)
+
+        def finish_elsewhere(seconds):
+            cache.set('key', ('computed elsewhere', time.time() + 10, 0), 10)
+
+        with mock.patch('posts.cache.time.sleep', finish_elsewhere):
+            value = get_or_compute('key', self.compute, 10)
+        self.assertEqual(value, 'computed elsewhere')
+        self.assertEqual(self.calls, 0)
+        self.assertEqual(cache_stats()['lock_waits'], 1)
+
+    @override_settings(FEED_CACHE_EARLY_BETA=1e9)
+    def test_early_expiration(self):
+        """XFetch может пересчитать значение до истечения срока"""
+        cache.set('key', ('old', time.time() + 10, 1), 10)
+        self.assertEqual(get_or_compute('key', self.compute, 10), 'value 1')
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'two-tier-l2',
+    },
+})
+class TestTwoTierCache(TestCase):
+    def make_cache(self, location, max_bytes=1024 * 1024):
+        return TwoTierCache(location, {'OPTIONS': {
+            'L2': 'shared',
+            'L1_TIMEOUT': 60,
+            'L1_MAX_BYTES': max_bytes,
+            'L2_ONLY_PREFIXES': ('posts:version:',),
+        }})
+
+    def setUp(self):
+        self.first = self.make_cache('process-1')
+        self.second = self.make_cache('process-2')
+        self.first.clear()
+        self.second.clear()
+
+    def test_l1_serves_without_l2(self):
+        """Значение читается из L1, даже если в L2 его уже нет"""
+        self.first.set('key', 'value')
+        caches['shared'].clear()
+        self.assertEqual(self.first.get('key'), 'value')
+        self.assertIsNone(self.second.get('key'))
+
+    def test_version_keys_bypass_l1(self):
+        """Ключи версий всегда читаются из общего L2"""
+        self.first.set('posts:version:feed', 1, None)
+        self.assertEqual(self.second.get('posts:version:feed'), 1)
+        self.second.incr('posts:version:feed')
+        self.assertEqual(self.first.get('posts:version:feed'), 2)
+
+    def test_l1_is_bounded_lru(self):
+        """При превышении объёма L1 вытесняются давно читанные ключи"""
+        small = self.make_cache('process-3', max_bytes=300)
+        small.set('old', 'x' * 100)
+        small.set('hot', 'x' * 100)
+        small.get('old')
+        small.set('new', 'x' * 100)
+        caches['shared'].clear()
+        self.assertEqual(small.get('old'), 'x' * 100)
+        self.assertEqual(small.get('new'), 'x' * 100)
+        self.assertIsNone(small.get('hot'))
+
+    def test_get_many_reads_l2_once_for_l1_misses(self):
+        """get_many берёт из L2 одним вызовом только промахи L1"""
+        self.first.set('local', 1)
+        self.second.set('remote', 2)
+        self.second.set('posts:version:feed', 3)
+        with mock.patch.object(
+                caches['shared'], 'get_many',
+                wraps=caches['shared'].get_many) as get_many:
+            found = self.first.get_many(
+                ['local', 'remote', 'posts:version:feed', 'missing'])
+        self.assertEqual(
+            found, {'local': 1, 'remote': 2, 'posts:version:feed': 3})
+        get_many.assert_called_once()
+        self.assertEqual(len(get_many.call_args[0][0]), 3)
+        caches['shared'].clear()
+        self.assertEqual(self.first.get('remote'), 2)
+
+
+TEMP_CACHE_DIR = tempfile.mkdtemp()
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': TEMP_CACHE_DIR,
+    },
+})
+class TestFileCacheAdd(TestCase):
+    '''add() поверх FileBasedCache атомарен между процессами'''
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_CACHE_DIR, ignore_errors=True)
+
+    def setUp(self):
+        self.first, self.second = (
+            TwoTierCache(location, {'OPTIONS': {'L2': 'shared'}})
+            for location in ('process-1', 'process-2'))
+        self.first.clear()
+
+    def test_add_is_atomic_between_processes(self):
+        """Из одновременных add одного ключа успешен ровно один"""
+        has_key = FileBasedCache.has_key
+
+        def slow_has_key(backend, *args, **kwargs):
+            found = has_key(backend, *args, **kwargs)
+            time.sleep(0.05)
+            return found
+
+        results = []
+        with mock.patch.object(FileBasedCache, 'has_key', slow_has_key):
+            threads = [
+                threading.Thread(target=lambda cache=cache: results.append(
+                    cache.add('posts:lock:key', 1, 10)))
+                for cache in (self.first, self.second) * 2
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(sorted(results), [False, False, False, True])
+
+    def test_abandoned_add_lock(self):
+        """Замок упавшего процесса не блокирует add навсегда"""
+        shared = caches['shared']
+        lock = shared._key_to_file(self.first.make_key('key')) + '.lock'
+        os.makedirs(os.path.dirname(lock), exist_ok=True)
+        open(lock, 'w').close()
+        self.assertFalse(self.first.add('key', 1))
+        os.utime(lock, (time.time() - 60, time.time() - 60))
+        self.assertTrue(self.first.add('key', 1))
+        self.assertFalse(os.path.exists(lock))
+
+
+class TestBumpVersion(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_bumped_again_after_commit(self):
+        """Фрагмент, собранный до коммита, после коммита не читается"""
+        key = 'posts:version:test'
+        with transaction.atomic():
+            bump_version(key)
+            during = get_version(key)
+        self.assertNotEqual(get_version(key), during)
+
+    def test_rollback_keeps_immediate_bump(self):
+        key = 'posts:version:test'
+        before = get_version(key)
+        with mock.patch.object(cache, 'incr') as incr:
+            try:
+                with transaction.atomic():
+                    bump_version(key)
+                    during = get_version(key)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        incr.assert_not_called()
+        self.assertNotEqual(during, before)
+        self.assertEqual(get_version(key), during)
@@ -1,6 +1,20 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+from unittest import mock
 
-from posts.models import Group, Post, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+
+from posts import counters, deletion, feeds
+from posts.importer import LookupMap
+from posts.models import (Comment, DeletionJob, FeedEntry, Follow, Group,
+                          Post, User, UserStats)
+from posts.search import search_posts
 
 
 class TestPostModels(TestCase):
@@ -24,3 +38,359 @@ class TestPostModels(TestCase):
         post = self.post
         self.assertEqual(str(self.post), post.text[:15])
         self.assertEqual(str(self.group), group.title)
+
+
+class TestCounters(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author')
+        cls.reader = User.objects.create_user(username='reader')
+        cls.group = Group.objects.create(
+            title='Group', slug='group', description='Description')
+        cls.other_group = Group.objects.create(
+            title='Other', slug='other', description='Description')
+
+    def assertCounters(self, posts, followers, following, group, other):
+        self.author.stats.refresh_from_db()
+        self.reader.stats.refresh_from_db()
+        self.group.refresh_from_db()
+        self.other_group.refresh_from_db()
+        self.assertEqual(self.author.stats.posts_count, posts)
+        self.assertEqual(self.author.stats.followers_count, followers)
+        self.assertEqual(self.reader.stats.following_count, following)
+        self.assertEqual(self.group.posts_count, group)
+        self.assertEqual(self.other_group.posts_count, other)
+
+    def test_counters_follow_changes(self):
+        """Счётчики обновляются при создании и удалении объектов."""
+        post = Post.objects.create(
+            author=self.author, text='Text', group=self.group)
+        Follow.objects.create(user=self.reader, author=self.author)
+        self.assertCounters(1, 1, 1, 1, 0)
+
+        post.group = self.other_group
+        post.save()
+        self.assertCounters(1, 1, 1, 0, 1)
+
+        comment = Comment.objects.create(
+            post=post, author=self.reader, text='Comment')
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 1)
+        comment.delete()
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 0)
+
+        Follow.objects.filter(user=self.reader).delete()
+        post.delete()
+        self.assertCounters(0, 0, 0, 0, 0)
+
+    def test_reconcile_counters_repairs_drift(self):
+        """reconcile_counters чинит разошедшиеся счётчики."""
+        post = Post.objects.create(
+            author=self.author, text='Text', group=self.group)
+        Comment.objects.create(post=post, author=self.reader, text='Text')
+        Follow.objects.create(user=self.reader, author=self.author)
+        UserStats.objects.update(
+            posts_count=7, followers_count=7, following_count=7)
+        UserStats.objects.filter(user=self.reader).delete()
+        Group.objects.update(posts_count=7)
+        Post.objects.update(comments_count=7)
+
+        call_command('reconcile_counters', batch_size=1, stdout=StringIO())
+
+        self.author.refresh_from_db()
+        self.reader.refresh_from_db()
+        self.assertCounters(1, 1, 1, 1, 0)
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 1)
+
+
+class TestIndexes(TestCase):
+    '''Запросы лент читают индекс в порядке сортировки, без filesort'''
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author')
+        cls.reader = User.objects.create_user(username='reader')
+        cls.group = Group.objects.create(
+            title='Group', slug='group', description='Description')
+        cls.post = Post.objects.create(
+            text='Post', author=cls.author, group=cls.group)
+        Follow.objects.create(user=cls.reader, author=cls.author)
+        cls.celebrity = User.objects.create_user(username='celebrity')
+        UserStats.objects.filter(user=cls.celebrity).update(
+            fanout_pulled=True)
+        Follow.objects.create(user=cls.reader, author=cls.celebrity)
+
+    def assertUsesIndex(self, queryset):
+        plan = queryset.explain()
+        self.assertNotIn('TEMP B-TREE', plan)
+        for line in plan.splitlines():
+            if 'SCAN' in line:
+                self.assertIn('USING', line, plan)
+
+    def test_feed_queries_use_indexes(self):
+        querysets = [
+            Post.objects.visible().select_related('author', 'group')[:10],
+            Post.objects.filter(author=self.author)[:10],
+            Post.objects.filter(group=self.group)[:10],
+            self.post.comments.all()[:10],
+            Follow.objects.filter(author=self.author),
+            Follow.objects.filter(user=self.reader, author=self.author),
+        ]
+        # лента подписок: материализованная часть и срезы подмешиваемых
+        pushed, pulled = feeds.follow_feed(self.reader).sources
+        querysets += [pushed[:11], pulled.union(11)]
+        for queryset in querysets:
+            with self.subTest(query=str(queryset.query)):
+                self.assertUsesIndex(queryset)
+
+
+class TestSqliteTuning(TestCase):
+    '''PRAGMA из SQLITE_PRAGMAS выполняются на соединении Django'''
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_pragmas_applied(self):
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        self.assertEqual(self.pragma('cache_size'), -64 * 1024)
+        self.assertEqual(self.pragma('temp_store'), 2)
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_sqlite', duration=0.1, rows=100,
+                     readers=1, writers=1, stdout=out)
+        self.assertIn('SQLITE_PRAGMAS', out.getvalue())
+
+
+class TestImportContent(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='leo')
+        cls.reader = User.objects.create_user(username='anna')
+        cls.group = Group.objects.create(
+            title='Классика', slug='classics', description='Description')
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def run_import(self, records, **options):
+        path = os.path.join(self.directory, 'content.jsonl')
+        with open(path, 'w', encoding='utf-8') as jsonl:
+            for record in records:
+                line = record if isinstance(record, str) else json.dumps(
+                    record, ensure_ascii=False)
+                jsonl.write(line + '\n')
+        out, err = StringIO(), StringIO()
+        call_command('import_content', path, batch_size=2,
+                     stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_import(self):
+        records = [
+            {'type': 'follow', 'user': 'anna', 'author': 'leo'},
+            {'type': 'post', 'id': 500, 'author': 'leo', 'group': 'classics',
+             'text': 'Война и мир', 'pub_date': '1869-01-01T00:00:00+00:00'},
+            {'type': 'comment', 'id': 900, 'post': 500, 'author': 'anna',
+             'text': 'Длинно', 'created': '1870-01-01T00:00:00'},
+            {'type': 'post', 'id': 501, 'author': 'leo', 'text': 'Анна'},
+            {'type': 'post', 'author': 'nobody', 'text': 'Пропустить'},
+            {'type': 'comment', 'post': 404, 'author': 'anna', 'text': '?'},
+            {'type': 'follow', 'user': 'leo', 'author': 'leo'},
+            {'type': 'post', 'author': 'leo'},
+            'not json',
+        ]
+        out, err = self.run_import(records)
+        self.assertIn('Постов: 2, комментариев: 1, подписок: 1', out)
+        self.assertIn('пропущено строк: 5', out)
+        self.assertIn("строка 5: нет автора 'nobody'", err)
+
+        post = Post.objects.get(pk=500)
+        self.assertEqual(post.group, self.group)
+        self.assertEqual(post.pub_date.year, 1869)
+        self.assertEqual(post.comments_count, 1)
+        self.assertEqual(Comment.objects.get(pk=900).created.year, 1870)
+        self.assertEqual(
+            UserStats.objects.get(user=self.author).posts_count, 2)
+        self.assertEqual(Group.objects.get(pk=self.group.pk).posts_count, 1)
+        self.assertEqual(
+            FeedEntry.objects.filter(user=self.reader).count(), 2)
+        self.assertEqual(list(search_posts('войн')), [post])
+
+        self.run_import(records)
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(Comment.objects.count(), 1)
+        self.assertEqual(Follow.objects.count(), 1)
+
+    def test_invalid_date_is_skipped(self):
+        records = [
+            {'type': 'post', 'author': 'leo', 'text': 'Тринадцатый месяц',
+             'pub_date': '2020-13-01T00:00:00'},
+            {'type': 'post', 'author': 'leo', 'text': 'Обычный пост'},
+        ]
+        out, err = self.run_import(records)
+        self.assertIn('Постов: 1', out)
+        self.assertIn("строка 1: неверная дата '2020-13-01T00:00:00'", err)
+
+    def test_feeds_updated_per_batch(self):
+        bystander = User.objects.create_user(username='bob')
+        Follow.objects.create(user=bystander, author=self.reader)
+        Follow.objects.create(user=self.reader, author=self.author)
+        with mock.patch('posts.feeds.rebuild') as rebuild:
+            self.run_import(
+                [{'type': 'post', 'author': 'leo', 'text': 'Новый'}])
+        rebuild.assert_not_called()
+        self.assertTrue(FeedEntry.objects.filter(
+            user=self.reader, post__text='Новый').exists())
+        self.assertFalse(FeedEntry.objects.filter(user=bystander).exists())
+
+    def test_counts_only_inserted_rows(self):
+        Post.objects.create(id=500, author=self.author, text='Уже есть')
+        Follow.objects.create(user=self.reader, author=self.author)
+        records = [
+            {'type': 'post', 'id': 500, 'author': 'leo', 'text': 'Повтор'},
+            {'type': 'post', 'id': 501, 'author': 'leo', 'text': 'Новый'},
+            {'type': 'post', 'id': 501, 'author': 'leo', 'text': 'Дубль'},
+            {'type': 'follow', 'user': 'anna', 'author': 'leo'},
+            {'type': 'follow', 'user': 'leo', 'author': 'anna'},
+            {'type': 'follow', 'user': 'leo', 'author': 'anna'},
+        ]
+        out, err = self.run_import(records)
+        self.assertIn('Постов: 1, комментариев: 0, подписок: 1', out)
+        self.assertEqual(Post.objects.get(pk=500).text, 'Уже есть')
+        self.assertEqual(
+            UserStats.objects.get(user=self.author).following_count, 1)
+
+    def test_export_round_trip(self):
+        post = Post.objects.create(
+            text='Туда и обратно', author=self.author, group=self.group)
+        Comment.objects.create(post=post, author=self.reader, text='Да')
+        Follow.objects.create(user=self.reader, author=self.author)
+        path = os.path.join(self.directory, 'export.jsonl')
+        call_command('export_content', output=path)
+        Post.objects.all().delete()
+        Follow.objects.all().delete()
+        call_command('import_content', path, stdout=StringIO())
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(post.group, self.group)
+        self.assertEqual(post.comments.get().author, self.reader)
+        self.assertTrue(Follow.objects.filter(
+            user=self.reader, author=self.author).exists())
+        out = StringIO()
+        call_command('export_content', 'anna', format='csv', stdout=out)
+        self.assertEqual(
+            [line.split(',')[0] for line in out.getvalue().splitlines()],
+            ['type', 'comment', 'follow'])
+
+    def test_lookup_map_is_bounded(self):
+        lookup = LookupMap(User.objects.all(), 'username', size=1)
+        self.assertEqual(lookup.resolve({'leo'}), {'leo': self.author.pk})
+        self.assertEqual(lookup.resolve({'anna', 'ghost'}),
+                         {'anna': self.reader.pk})
+        self.assertEqual(len(lookup.ids), 1)
+
+
+class TestDeletion(TestCase):
+    '''Удаление пользователей и групп пачками в фоне'''
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='leaving')
+        cls.reader = User.objects.create_user(username='reader')
+        cls.group = Group.objects.create(
+            title='Group', slug='group', description='Description')
+        Follow.objects.create(user=cls.reader, author=cls.author)
+        Follow.objects.create(user=cls.author, author=cls.reader)
+        cls.posts = [
+            Post.objects.create(
+                text=f'Post {number}', author=cls.author, group=cls.group)
+            for number in range(5)
+        ]
+        cls.kept = Post.objects.create(
+            text='Kept', author=cls.reader, group=cls.group)
+        Comment.objects.create(post=cls.kept, author=cls.author, text='A')
+        Comment.objects.create(post=cls.posts[0], author=cls.reader, text='B')
+
+    def test_user_deleted_in_batches(self):
+        job = deletion.schedule_user_deletion(
+            User.objects.get(pk=self.author.pk))
+        self.assertFalse(User.objects.get(pk=self.author.pk).is_active)
+        self.assertEqual(job.total, 13)
+        self.assertEqual(Post.objects.visible().count(), 1)
+        call_command('process_deletions', batch_size=2, stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, DeletionJob.DONE)
+        self.assertEqual(job.progress, 100)
+        self.assertFalse(User.objects.filter(pk=self.author.pk).exists())
+        self.assertEqual(list(Post.objects.all()), [self.kept])
+        self.assertFalse(Comment.objects.exists())
+        self.assertFalse(Follow.objects.exists())
+        self.assertFalse(FeedEntry.objects.exists())
+        # счётчики поправлены сигналами, а не пересчётом
+        stats = UserStats.objects.get(user=self.reader)
+        self.assertEqual(
+            (stats.followers_count, stats.following_count), (0, 0))
+        self.assertEqual(Group.objects.get().posts_count, 1)
+        self.assertEqual(Post.objects.get().comments_count, 0)
+
+    def test_counters_match_visible(self):
+        user = User.objects.get(pk=self.author.pk)
+        deletion.schedule_user_deletion(user)
+        deletion.schedule_user_deletion(user)
+        self.assertEqual(Group.objects.get().posts_count, 1)
+        self.assertEqual(counters.reconcile_groups(100), 0)
+        self.assertEqual(
+            counters.estimate_count(Post.objects.visible()), 1)
+
+    def test_deactivated_author_stays_visible(self):
+        User.objects.filter(pk=self.author.pk).update(is_active=False)
+        self.assertEqual(Post.objects.visible().count(), 6)
+        self.assertEqual(counters.reconcile_groups(100), 0)
+
+    @override_settings(BACKGROUND_WORKERS=0)
+    def test_pulled_author_not_demoted(self):
+        UserStats.objects.filter(user=self.author).update(fanout_pulled=True)
+        deletion.schedule_user_deletion(User.objects.get(pk=self.author.pk))
+        with mock.patch('posts.feeds.demote') as demote, \
+                mock.patch('posts.feeds.transaction.on_commit',
+                           side_effect=lambda func: func()):
+            deletion.process(batch_size=2)
+        demote.assert_not_called()
+        self.assertFalse(FeedEntry.objects.exists())
+
+    def test_group_posts_detached(self):
+        deletion.schedule_group_deletion(Group.objects.get(pk=self.group.pk))
+        self.assertTrue(Group.objects.get().pending_deletion)
+        deletion.process(batch_size=2)
+        self.assertFalse(Group.objects.exists())
+        self.assertEqual(Post.objects.count(), 6)
+        self.assertFalse(Post.objects.filter(group__isnull=False).exists())
+        job = DeletionJob.objects.get()
+        self.assertEqual((job.processed, job.total), (6, 6))
+
+    def test_schedule_is_idempotent(self):
+        group = Group.objects.get(pk=self.group.pk)
+        first = deletion.schedule_group_deletion(group)
+        self.assertEqual(deletion.schedule_group_deletion(group), first)
+
+    def test_interrupted_job_resumes(self):
+        job = deletion.schedule_user_deletion(
+            User.objects.get(pk=self.author.pk))
+        failing = mock.Mock(side_effect=RuntimeError('boom'))
+        steps, _ = deletion.KINDS[DeletionJob.USER]
+        with mock.patch.dict(
+                deletion.KINDS, {DeletionJob.USER: (steps, failing)}):
+            deletion.run_job(job, batch_size=2)
+        job.refresh_from_db()
+        self.assertEqual(job.status, DeletionJob.FAILED)
+        self.assertIn('boom', job.error)
+        # пачки до сбоя уже зафиксированы, повтор доделывает остальное
+        self.assertFalse(Post.objects.filter(author=self.author).exists())
+        job = deletion.schedule_user_deletion(
+            User.objects.get(pk=self.author.pk))
+        deletion.run_job(job)
+        self.assertEqual(job.status, DeletionJob.DONE)
+        self.assertFalse(User.objects.filter(pk=self.author.pk).exists())
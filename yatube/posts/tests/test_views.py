@@ -1,14 +1,40 @@
+import csv
+import hashlib
+import json
+import os
 import shutil
+import sqlite3
 import tempfile
+import time
+from io import StringIO
+from unittest import mock
 
 from django import forms
 from django.conf import settings
 from django.core.cache import cache
+from django.core.management import call_command
+from django.core.paginator import Paginator
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import Client, TestCase, override_settings
+from django.db import connection, connections
+from django.test import (Client, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from posts.models import Follow, Group, Post, User
+from core.queries import QueryBudgetExceeded
+from core.testing import QueryBudgetMixin
+from posts import autocomplete
+from posts import cache as feed_cache
+from posts import counters
+from posts import deletion
+from posts import feeds
+from posts import thumbnails
+from posts import views
+from posts.models import (Comment, FeedEntry, Follow, Group, Post, User,
+                          UserStats)
+from posts.autocomplete import PrefixIndex
+from posts.paginators import elided_page_range
 
 POSTS_COUNT = 57
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
@@ -201,12 +227,74 @@ class TestViews(TestCase):
         response_1 = self.authorized_client.get(reverse(self.index_page))
         response_before_del = response_1.context['page_obj'][0]
         self.assertEqual(post, response_before_del)
-        post.delete()
+        # изменение в обход сигналов не видно: страница взята из кеша
+        Post.objects.filter(pk=post.pk).update(text='Changed silently')
         response_2 = self.authorized_client.get(reverse(self.index_page))
         self.assertEqual(response_1.content, response_2.content)
-        cache.clear()
+        # удаление поста поднимает версию ленты и сбрасывает кеш
+        post.delete()
         response_3 = self.authorized_client.get(reverse(self.index_page))
         self.assertNotEqual(response_1.content, response_3.content)
+        self.assertNotContains(response_3, 'Testing text')
+
+    def test_cache_is_page_aware(self):
+        """Разные страницы ленты кешируются под разными ключами"""
+        Post.objects.bulk_create(
+            Post(text=f'Paged post {number}', author=self.user1)
+            for number in range(settings.POSTS_PER_PAGE)
+        )
+        first = self.guest_client.get(reverse(self.index_page))
+        second = self.guest_client.get(reverse(self.index_page) + '?page=2')
+        self.assertNotEqual(first.content, second.content)
+        self.assertContains(second, 'Test text for user1 group1')
+        self.assertNotContains(first, 'Test text for user1 group1')
+
+    def test_group_and_profile_cache_generations(self):
+        """Группа и профиль берутся из кеша до изменения поста,
+        группы или автора"""
+        pages = {
+            reverse(self.group_list_page,
+                    kwargs={'slug': self.group1.slug}): self.group1,
+            reverse(self.profile_page,
+                    kwargs={'username': self.user1}): self.user1,
+        }
+        for page in pages:
+            with self.subTest(page=page):
+                response = self.guest_client.get(page)
+                self.assertContains(response, 'Test text for user1 group1')
+                Post.objects.filter(author=self.user1).update(
+                    text='Changed silently')
+                response = self.guest_client.get(page)
+                self.assertContains(response, 'Test text for user1 group1')
+                post = Post.objects.get(author=self.user1)
+                post.save()
+                response = self.guest_client.get(page)
+                self.assertContains(response, 'Changed silently')
+                post.text = 'Test text for user1 group1'
+                post.save()
+
+        profile = reverse(self.profile_page, kwargs={'username': self.user1})
+        self.guest_client.get(profile)
+        self.user1.first_name = 'Renamed'
+        self.user1.save()
+        self.assertContains(self.guest_client.get(profile), 'Renamed')
+
+    def test_cached_group_and_author_lookups(self):
+        """Поиск группы и автора кешируется и сбрасывается при изменении"""
+        group = Group.objects.create(
+            title='Lookup group', slug='lookup', description='Description')
+        page = reverse(self.group_list_page, kwargs={'slug': 'renamed'})
+        self.assertEqual(self.guest_client.get(page).status_code, 404)
+        group.slug = 'renamed'
+        group.save()
+        self.assertEqual(self.guest_client.get(page).status_code, 200)
+        feed_cache.get_author_or_404(self.user1.username)
+        with self.assertNumQueries(0):
+            feed_cache.get_group_or_404('renamed')
+            author = feed_cache.get_author_or_404(self.user1.username)
+        # в кеше только публичные поля автора
+        self.assertNotIn('password', author.__dict__)
+        self.assertNotIn('email', author.__dict__)
 
 
 class TestPaginator(TestCase):
@@ -245,6 +333,8 @@ class TestPaginator(TestCase):
             text=f'Test post number {post}',
             author=cls.user,
             group=cls.group,) for post in range(POSTS_COUNT))
+        # bulk_create обходит сигналы, счётчики чинятся как после импорта
+        call_command('reconcile_counters', stdout=StringIO())
 
     def setUp(self):
         cache.clear()
@@ -275,6 +365,51 @@ class TestPaginator(TestCase):
                 self.assertEqual(len(response_obj2.context['page_obj']),
                                  self.amount_of_post_last_page)
 
+    @override_settings(POSTS_PAGINATION='cursor')
+    def test_cursor_pagination_walks_whole_feed(self):
+        '''Курсорная пагинация проходит ленту без пропусков и повторов'''
+        for page in self.pages:
+            with self.subTest(page=page):
+                seen = []
+                response = self.authorized_client.get(page)
+                page_obj = response.context['page_obj']
+                self.assertTrue(page_obj.is_cursor)
+                seen.extend(page_obj)
+                while page_obj.has_next():
+                    response = self.authorized_client.get(
+                        page + f'?after={page_obj.next_cursor}')
+                    page_obj = response.context['page_obj']
+                    self.assertLessEqual(len(page_obj),
+                                         settings.POSTS_PER_PAGE)
+                    seen.extend(page_obj)
+                self.assertEqual(len(seen), POSTS_COUNT)
+                self.assertEqual(len(set(seen)), POSTS_COUNT)
+                self.assertEqual(
+                    seen, list(Post.objects.order_by('-pub_date', '-id')))
+
+    @override_settings(POSTS_PAGINATION='cursor')
+    def test_cursor_pagination_before(self):
+        '''Токен before возвращает предыдущую страницу'''
+        first = self.authorized_client.get(
+            reverse('posts:index')).context['page_obj']
+        second = self.authorized_client.get(
+            reverse('posts:index') + f'?after={first.next_cursor}'
+        ).context['page_obj']
+        back = self.authorized_client.get(
+            reverse('posts:index') + f'?before={second.previous_cursor}'
+        ).context['page_obj']
+        self.assertEqual(list(back), list(first))
+        self.assertFalse(back.has_previous())
+        self.assertTrue(back.has_next())
+
+    def test_cursor_pagination_invalid_token(self):
+        '''Битый токен открывает первую страницу'''
+        response = self.authorized_client.get(
+            reverse('posts:index') + '?after=not-a-cursor')
+        self.assertEqual(len(response.context['page_obj']),
+                         settings.POSTS_PER_PAGE)
+        self.assertFalse(response.context['page_obj'].has_previous())
+
 
 class FollowingTest(TestCase):
     '''Тест подписок на автора поста'''
@@ -330,3 +465,918 @@ class FollowingTest(TestCase):
         response_obj_2 = self.user2_client.get(page)
         test_post2 = response_obj_2.context['page_obj']
         self.assertNotIn(post, test_post2)
+
+    def test_follow_backfills_and_unfollow_prunes_feed(self):
+        '''Подписка переносит старые посты в ленту, отписка убирает их'''
+        page = reverse('posts:follow_index')
+        self.user2_client.post(reverse(
+            'posts:profile_follow', kwargs={'username': self.user1}))
+        self.assertIn(
+            self.post, self.user2_client.get(page).context['page_obj'])
+        self.user2_client.post(reverse(
+            'posts:profile_unfollow', kwargs={'username': self.user1}))
+        self.assertNotIn(
+            self.post, self.user2_client.get(page).context['page_obj'])
+        self.assertFalse(FeedEntry.objects.filter(user=self.user2).exists())
+
+    def test_rebuild_feeds_command(self):
+        '''Команда rebuild_feeds восстанавливает ленты подписок'''
+        Follow.objects.create(user=self.user2, author=self.user1)
+        FeedEntry.objects.all().delete()
+        call_command('rebuild_feeds')
+        self.assertTrue(FeedEntry.objects.filter(
+            user=self.user2, post=self.post).exists())
+
+    def test_rebuild_feeds_in_batches(self):
+        '''Пересборка пачками восстанавливает ленты всех читателей'''
+        Follow.objects.create(user=self.user2, author=self.user1)
+        Follow.objects.create(user=self.user3, author=self.user1)
+        FeedEntry.objects.all().delete()
+        feeds.rebuild(batch_size=1)
+        self.assertEqual(FeedEntry.objects.filter(post=self.post).count(), 2)
+
+    @override_settings(FEED_FANOUT_FOLLOWER_LIMIT=1,
+                       FEED_FANOUT_DEMOTE_LIMIT=1)
+    def test_popular_author_posts_are_pulled_and_merged(self):
+        '''Посты популярного автора не раскладываются по лентам,
+        но попадают в ленту подписки в порядке публикации'''
+        Follow.objects.create(user=self.user1, author=self.user3)
+        Follow.objects.create(user=self.user2, author=self.user3)
+        Follow.objects.create(user=self.user2, author=self.user1)
+        posts = []
+        for number in range(6):
+            author = self.user3 if number % 2 else self.user1
+            posts.append(Post.objects.create(
+                author=author, text=f'Merged post {number}'))
+        self.assertFalse(FeedEntry.objects.filter(
+            post__author=self.user3).exists())
+        expected = [self.post] + posts
+        expected.reverse()
+        page = reverse('posts:follow_index')
+        self.assertEqual(
+            list(self.user2_client.get(page).context['page_obj']),
+            expected)
+        with self.settings(POSTS_PAGINATION='cursor', POSTS_PER_PAGE=4):
+            first = self.user2_client.get(page).context['page_obj']
+            second = self.user2_client.get(
+                page + f'?after={first.next_cursor}').context['page_obj']
+            self.assertEqual(list(first) + list(second), expected)
+        # автор опустился ниже порога: пока фоновый перенос не прошёл,
+        # его посты подмешиваются, после — лежат в ленте подписчика
+        Follow.objects.filter(user=self.user1, author=self.user3).delete()
+        self.assertEqual(
+            list(self.user2_client.get(page).context['page_obj']),
+            expected)
+        feeds.demote(self.user3.pk)
+        self.assertFalse(
+            UserStats.objects.get(user=self.user3).fanout_pulled)
+        self.assertEqual(FeedEntry.objects.filter(
+            user=self.user2, post__author=self.user3).count(), 3)
+        self.assertEqual(
+            list(self.user2_client.get(page).context['page_obj']),
+            expected)
+
+    @override_settings(FEED_BACKFILL_POSTS=2, FEED_BATCH_SIZE=3)
+    def test_demote_copies_recent_window(self):
+        '''Возврат к раскладке переносит только последние посты автора
+        пачками ограниченного размера'''
+        Follow.objects.create(user=self.user2, author=self.user3)
+        Follow.objects.create(user=self.user1, author=self.user3)
+        posts = [
+            Post.objects.create(author=self.user3, text=f'Old post {number}')
+            for number in range(4)
+        ]
+        UserStats.objects.filter(user=self.user3).update(fanout_pulled=True)
+        FeedEntry.objects.filter(post__author=self.user3).delete()
+        with mock.patch.object(
+                FeedEntry.objects, 'bulk_create',
+                wraps=FeedEntry.objects.bulk_create) as bulk_create:
+            feeds.demote(self.user3.pk)
+        self.assertEqual(
+            [len(call.args[0]) for call in bulk_create.call_args_list],
+            [2, 2])
+        self.assertEqual(
+            set(FeedEntry.objects.filter(
+                user=self.user2).values_list('post_id', flat=True)),
+            {posts[2].pk, posts[3].pk})
+
+    @override_settings(FEED_FANOUT_FOLLOWER_LIMIT=0)
+    def test_pulled_authors_read_by_slices(self):
+        '''Посты подмешиваемых авторов читаются срезами по автору
+        одним запросом'''
+        Follow.objects.create(user=self.user2, author=self.user1)
+        Follow.objects.create(user=self.user2, author=self.user3)
+        posts = [
+            Post.objects.create(
+                author=author, text=f'Sliced post {number}')
+            for number in range(3)
+            for author in (self.user1, self.user3)
+        ]
+        posts.reverse()
+        feed = feeds.follow_feed(self.user2)
+        with self.assertNumQueries(1) as queries:
+            self.assertEqual(feed.sources[1][:3], posts[:3])
+        self.assertEqual(queries.captured_queries[0]['sql'].count(
+            'LIMIT 3'), 2)
+        self.assertEqual(feed[:8], posts + [self.post])
+        self.assertEqual(feeds.bounded_count(feed), 7)
+
+    @override_settings(POSTS_COUNT_EXACT_LIMIT=2)
+    def test_follow_feed_count_is_bounded(self):
+        '''Число постов ленты подписок считается не дальше предела'''
+        Follow.objects.create(user=self.user2, author=self.user1)
+        Post.objects.create(author=self.user1, text='Second post')
+        Post.objects.create(author=self.user1, text='Third post')
+        feed = feeds.follow_feed(self.user2)
+        self.assertEqual(feeds.bounded_count(feed), 2)
+        self.assertEqual(len(feed[:10]), 3)
+
+
+class TestQueryBudgets(QueryBudgetMixin, TestCase):
+    '''Представления укладываются в объявленный бюджет SQL-запросов'''
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='reader')
+        cls.author = User.objects.create(username='writer')
+        cls.group = Group.objects.create(
+            title='Budget group', slug='budget', description='Description')
+        Follow.objects.create(user=cls.user, author=cls.author)
+        for number in range(settings.POSTS_PER_PAGE + 1):
+            cls.post = Post.objects.create(
+                text=f'Budget post {number}',
+                author=cls.author if number % 2 else cls.user,
+                group=cls.group,
+            )
+            Comment.objects.create(
+                post=cls.post, author=cls.user, text='Comment')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_get_views_within_budget(self):
+        pages = [
+            reverse('posts:index'),
+            reverse('posts:group_list', kwargs={'slug': self.group.slug}),
+            reverse('posts:profile', kwargs={'username': self.author}),
+            reverse('posts:post_detail', kwargs={'post_id': self.post.pk}),
+            reverse('posts:follow_index'),
+            reverse('posts:post_create'),
+            reverse('posts:post_edit', kwargs={'post_id': self.post.pk}),
+        ]
+        for page in pages:
+            with self.subTest(page=page):
+                self.assertWithinQueryBudget(self.client.get(page))
+
+    def test_post_views_within_budget(self):
+        requests = [
+            (reverse('posts:post_create'), {'text': 'New post'}),
+            (reverse('posts:post_edit', kwargs={'post_id': self.post.pk}),
+             {'text': 'Edited post'}),
+            (reverse('posts:add_comment', kwargs={'post_id': self.post.pk}),
+             {'text': 'New comment'}),
+            (reverse('posts:profile_unfollow',
+                     kwargs={'username': self.author}), {}),
+            (reverse('posts:profile_follow',
+                     kwargs={'username': self.author}), {}),
+        ]
+        for page, data in requests:
+            with self.subTest(page=page):
+                self.assertWithinQueryBudget(self.client.post(page, data))
+
+    @override_settings(DEBUG=True)
+    def test_query_stats_headers(self):
+        response = self.client.get(reverse('posts:index'))
+        self.assertEqual(response['X-Query-Count'],
+                         str(response.wsgi_request.query_stats['count']))
+        self.assertIn('X-Query-Time-Ms', response)
+        self.assertIn('X-Query-Duplicates', response)
+
+    def test_strict_budget_raises(self):
+        with self.strict_query_budget(), \
+                mock.patch.object(views.index, 'query_budget', 0), \
+                self.assertRaises(QueryBudgetExceeded):
+            self.client.get(reverse('posts:index'))
+
+
+class TestFeedQueries(TestCase):
+    '''Число запросов ленты не зависит от размера страницы'''
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = User.objects.create(username='feed_reader')
+        cls.author = User.objects.create(username='feed_author')
+        cls.group = Group.objects.create(
+            title='Feed group', slug='feed', description='Description')
+        for number in range(10):
+            author = User.objects.create(username=f'feed_author_{number}')
+            group = Group.objects.create(
+                title=f'Group {number}', slug=f'feed_{number}',
+                description='Description')
+            Follow.objects.create(user=cls.reader, author=author)
+            Post.objects.create(
+                text=f'Post {number}', author=author, group=group)
+            Post.objects.create(
+                text=f'Own post {number}', author=cls.author, group=cls.group)
+        cls.post = Post.objects.create(text='Commented', author=cls.author)
+        for number in range(10):
+            Comment.objects.create(
+                post=cls.post, text='Comment',
+                author=User.objects.get(username=f'feed_author_{number}'))
+
+    def setUp(self):
+        self.client.force_login(self.reader)
+
+    def count_queries(self, url, per_page):
+        cache.clear()
+        with override_settings(POSTS_PER_PAGE=per_page), \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_feeds_constant_queries(self):
+        pages = [
+            reverse('posts:index'),
+            reverse('posts:group_list', kwargs={'slug': self.group.slug}),
+            reverse('posts:profile', kwargs={'username': self.author}),
+            reverse('posts:follow_index'),
+        ]
+        for page in pages:
+            with self.subTest(page=page):
+                self.assertEqual(self.count_queries(page, 2),
+                                 self.count_queries(page, 10))
+
+    def test_post_detail_comment_authors(self):
+        url = reverse('posts:post_detail', kwargs={'post_id': self.post.pk})
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(len(response.context['comments']), 10)
+        # десять разных авторов комментариев не добавляют запросов
+        self.assertLessEqual(len(queries), views.post_detail.query_budget)
+
+
+class TestPostCounts(TestCase):
+    '''Пагинация лент не делает COUNT(*) по таблице постов'''
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create(username='count_author')
+        cls.group = Group.objects.create(
+            title='Count group', slug='count', description='Description')
+        for number in range(13):
+            Post.objects.create(
+                text=f'Post {number}', author=cls.author, group=cls.group)
+
+    def setUp(self):
+        cache.clear()
+
+    def get_counts(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        counts = [query['sql'] for query in queries
+                  if 'COUNT(' in query['sql']]
+        return response.context['page_obj'].paginator.count, counts
+
+    def test_feeds_use_maintained_counts(self):
+        pages = [
+            reverse('posts:group_list', kwargs={'slug': self.group.slug}),
+            reverse('posts:profile', kwargs={'username': self.author}),
+        ]
+        for page in pages:
+            with self.subTest(page=page):
+                count, counts = self.get_counts(page)
+                self.assertEqual(count, 13)
+                self.assertEqual(counts, [])
+
+    def test_index_count_is_bounded_and_cached(self):
+        count, counts = self.get_counts(reverse('posts:index'))
+        self.assertEqual(count, 13)
+        self.assertEqual(len(counts), 1)
+        self.assertIn('LIMIT', counts[0])
+        count, counts = self.get_counts(reverse('posts:index'))
+        self.assertEqual(counts, [])
+        Post.objects.create(text='New post', author=self.author)
+        count, counts = self.get_counts(reverse('posts:index'))
+        self.assertEqual(count, 14)
+
+    @override_settings(POSTS_COUNT_EXACT_LIMIT=5)
+    def test_estimate_above_threshold(self):
+        Post.objects.filter(text='Post 5').delete()
+        self.assertEqual(counters.estimate_count(Post.objects.all()), 13)
+        self.assertEqual(
+            counters.estimate_count(Post.objects.filter(text='Post 1')), 1)
+
+
+class TestPageWindow(TestCase):
+    '''Навигация выводит окно страниц, а не все номера'''
+    def test_elided_page_range(self):
+        paginator = Paginator(range(1_000_000), 10)
+        cases = {
+            1: [1, 2, 3, 4, None, 99_999, 100_000],
+            50: [1, 2, None, 47, 48, 49, 50, 51, 52, 53, None,
+                 99_999, 100_000],
+            100_000: [1, 2, None, 99_997, 99_998, 99_999, 100_000],
+        }
+        for number, expected in cases.items():
+            with self.subTest(number=number):
+                self.assertEqual(
+                    list(elided_page_range(paginator.page(number))),
+                    expected)
+        self.assertEqual(
+            list(elided_page_range(Paginator(range(50), 10).page(3))),
+            [1, 2, 3, 4, 5])
+
+    def test_paginator_include_is_windowed(self):
+        user = User.objects.create(username='window')
+        Post.objects.bulk_create(
+            Post(text=f'Post {number}', author=user) for number in range(40))
+        cache.clear()
+        with override_settings(POSTS_PER_PAGE=1):
+            response = self.client.get(
+                reverse('posts:index'), {'page': 20})
+        content = response.content.decode()
+        self.assertIn('?page=17"', content)
+        self.assertIn('?page=40', content)
+        self.assertNotIn('?page=10"', content)
+        self.assertEqual(content.count('&hellip;'), 2)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class TestReplicaRouting(TransactionTestCase):
+    '''Чтение с реплики и read-your-writes после записи'''
+    databases = {'default', 'replica'}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_dir = tempfile.mkdtemp()
+        connections.databases['replica'] = {
+            **connections.databases['default'],
+            'NAME': os.path.join(cls.replica_dir, 'replica.sqlite3'),
+        }
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.databases['replica']
+        shutil.rmtree(cls.replica_dir, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create(username='replica_author')
+        self.sync_replica()
+        self.post = Post.objects.create(
+            text='Lagging post', author=self.author)
+
+    def sync_replica(self):
+        '''Репликация: копия основной базы в файл реплики'''
+        connections['replica'].close()
+        connections['default'].ensure_connection()
+        target = sqlite3.connect(connections.databases['replica']['NAME'])
+        connections['default'].connection.backup(target)
+        target.close()
+
+    def test_reads_go_to_replica(self):
+        url = reverse('posts:post_detail', kwargs={'post_id': self.post.pk})
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.sync_replica()
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_read_your_writes_after_post(self):
+        self.client.force_login(self.author)
+        response = self.client.post(
+            reverse('posts:post_create'), {'text': 'Fresh post'})
+        self.assertIn('pin_primary', response.cookies)
+        post = Post.objects.get(text='Fresh post')
+        url = reverse('posts:post_detail', kwargs={'post_id': post.pk})
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(Client().get(url).status_code, 404)
+
+    @override_settings(REPLICA_PIN_SECONDS=1)
+    def test_cached_feed_from_replica_expires(self):
+        '''Фрагмент и счётчик с реплики живут не дольше её отставания'''
+        url = reverse('posts:index')
+        self.assertNotContains(self.client.get(url), 'Lagging post')
+        self.sync_replica()
+        self.assertNotContains(self.client.get(url), 'Lagging post')
+        time.sleep(1.1)
+        self.assertContains(self.client.get(url), 'Lagging post')
+
+
+class TestSearch(TestCase):
+    '''Полнотекстовый поиск по постам'''
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            username='searcher', email='searcher@example.com',
+            password='password')
+        cls.best = Post.objects.create(text='Кот кот кот', author=cls.user)
+        cls.other = Post.objects.create(
+            text='Кот и собака гуляют во дворе весь день', author=cls.user)
+        for number in range(5):
+            Post.objects.create(text=f'Про погоду {number}', author=cls.user)
+
+    def search(self, query, **params):
+        response = self.client.get(
+            reverse('posts:search'), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_results_ranked(self):
+        page_obj = self.search('кот').context['page_obj']
+        self.assertEqual(list(page_obj), [self.best, self.other])
+
+    def test_prefix_and_syntax(self):
+        page_obj = self.search('соба').context['page_obj']
+        self.assertEqual(list(page_obj), [self.other])
+        for query in ('"AND (', 'NOT', '***', 'кот OR'):
+            with self.subTest(query=query):
+                self.search(query)
+
+    def test_empty_query(self):
+        self.assertIsNone(self.search('').context['page_obj'])
+        self.assertEqual(len(self.search('!!!').context['page_obj']), 0)
+
+    @override_settings(POSTS_PER_PAGE=2)
+    def test_cursor_pages_keep_query(self):
+        response = self.search('погоду')
+        found = list(response.context['page_obj'])
+        while response.context['page_obj'].has_next():
+            page_obj = response.context['page_obj']
+            self.assertContains(
+                response, f'?q=%D0%BF%D0%BE%D0%B3%D0%BE%D0%B4%D1%83&'
+                f'after={page_obj.next_cursor}')
+            response = self.search('погоду', after=page_obj.next_cursor)
+            found += list(response.context['page_obj'])
+        self.assertEqual(len(found), 5)
+        self.assertEqual(len(set(found)), 5)
+
+    def test_index_follows_changes(self):
+        other = Post.objects.get(pk=self.other.pk)
+        other.text = 'Только собака'
+        other.save()
+        self.assertEqual(list(self.search('кот').context['page_obj']),
+                         [self.best])
+        Post.objects.filter(pk=self.best.pk).delete()
+        self.assertEqual(len(self.search('кот').context['page_obj']), 0)
+        Post.objects.bulk_create([Post(text='Новый кот', author=self.user)])
+        self.assertEqual(len(self.search('кот').context['page_obj']), 1)
+
+    def test_rebuild_search(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO posts_post_fts(posts_post_fts) "
+                "VALUES ('delete-all')")
+        self.assertEqual(len(self.search('кот').context['page_obj']), 0)
+        call_command('rebuild_search', optimize=True, stdout=StringIO())
+        self.assertEqual(len(self.search('кот').context['page_obj']), 2)
+
+    def test_admin_search(self):
+        self.client.force_login(self.user)
+        response = self.client.get(
+            reverse('admin:posts_post_changelist'), {'q': 'кот'})
+        self.assertEqual(
+            set(response.context['cl'].result_list), {self.best, self.other})
+
+
+class TestAutocomplete(TestCase):
+    '''Подсказки авторов и групп из индекса в памяти'''
+    @classmethod
+    def setUpTestData(cls):
+        cls.writer = User.objects.create(
+            username='tolstoy', first_name='Лев', last_name='Толстой')
+        cls.reader = User.objects.create(username='tolkien')
+        cls.group = Group.objects.create(
+            title='Русская классика', slug='classics', description='-')
+
+    def setUp(self):
+        cache.clear()
+        autocomplete.reset()
+
+    def complete(self, query, **params):
+        response = self.client.get(
+            reverse('posts:autocomplete'), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [result['label'] for result in response.json()['results']]
+
+    def test_prefix_matches(self):
+        self.assertEqual(
+            self.complete('tol'), ['tolkien', 'Лев Толстой (tolstoy)'])
+        self.assertEqual(self.complete('толс'), ['Лев Толстой (tolstoy)'])
+        self.assertEqual(self.complete('КЛАСС'), ['Русская классика'])
+        self.assertEqual(self.complete('tol', limit=1), ['tolkien'])
+        self.assertEqual(self.complete(' '), [])
+        response = self.client.get(
+            reverse('posts:autocomplete'), {'q': 'classics'})
+        self.assertEqual(response.json()['results'][0]['url'],
+                         reverse('posts:group_list', args=['classics']))
+
+    def test_no_queries_after_load(self):
+        self.complete('t')
+        with self.assertNumQueries(0):
+            autocomplete.search('tol', 10)
+
+    def test_signals_update_index(self):
+        self.complete('t')
+        group = Group.objects.get(pk=self.group.pk)
+        group.title = 'Поэзия'
+        group.save()
+        self.assertEqual(self.complete('клас'), [])
+        self.assertEqual(self.complete('поэ'), ['Поэзия'])
+        User.objects.create(username='tolstaya')
+        self.assertIn('tolstaya', self.complete('tolst'))
+        User.objects.filter(pk=self.reader.pk).get().delete()
+        self.assertNotIn('tolkien', self.complete('tol'))
+        group.delete()
+        self.assertEqual(self.complete('поэ'), [])
+
+    def test_new_user_keeps_feed_caches(self):
+        feed_version = feed_cache.feed_version()
+        User.objects.create(username='tolstaya')
+        self.assertEqual(feed_cache.feed_version(), feed_version)
+        self.assertIn('tolstaya', self.complete('tolst'))
+
+    def test_pending_deletion_groups_hidden(self):
+        self.complete('t')
+        deletion.schedule_group_deletion(
+            Group.objects.get(pk=self.group.pk))
+        self.assertEqual(self.complete('клас'), [])
+        autocomplete.reset()
+        self.assertEqual(self.complete('клас'), [])
+
+    @override_settings(AUTOCOMPLETE_REFRESH=0)
+    def test_changes_from_other_processes(self):
+        self.complete('t')
+        # update() обходит сигналы, как запись в другом процессе
+        User.objects.filter(pk=self.reader.pk).update(username='tolkien2')
+        feed_cache.bump_version(feed_cache.USERS_VERSION_KEY)
+        self.assertEqual(self.complete('tolk'), ['tolkien2'])
+
+    @override_settings(AUTOCOMPLETE_REFRESH=0)
+    def test_reload_per_kind(self):
+        self.complete('t')
+        # своё изменение не перестраивает индекс
+        User.objects.create(username='tolstaya')
+        with self.assertNumQueries(0):
+            autocomplete.search('tolst', 10)
+        # чужое — перестраивает только индекс своего вида
+        feed_cache.bump_version(feed_cache.GROUPS_VERSION_KEY)
+        with self.assertNumQueries(1):
+            autocomplete.search('tolst', 10)
+
+    def test_foreign_change_not_swallowed(self):
+        self.complete('t')
+        User.objects.filter(pk=self.reader.pk).update(username='tolkien2')
+        feed_cache.bump_version(feed_cache.USERS_VERSION_KEY)
+        User.objects.create(username='tolstaya')
+        self.assertEqual(
+            self.complete('tol'),
+            ['tolkien2', 'tolstaya', 'Лев Толстой (tolstoy)'])
+
+    def test_search_speed(self):
+        index = PrefixIndex(
+            (('author', number), (f'user{number}', f'user{number}'),
+             {f'user{number}'})
+            for number in range(20000)
+        )
+        started = time.perf_counter()
+        for number in range(1000):
+            index.search(f'user{number}', 10)
+        self.assertLess((time.perf_counter() - started) / 1000, 0.001)
+
+
+class TestExport(TestCase):
+    '''Потоковая выгрузка данных пользователя'''
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='exporter')
+        cls.author = User.objects.create(username='exported')
+        cls.group = Group.objects.create(
+            title='Export', slug='export', description='Description')
+        cls.post = Post.objects.create(
+            text='Мой пост, с запятой', author=cls.user, group=cls.group)
+        cls.other = Post.objects.create(text='Чужой пост', author=cls.author)
+        Comment.objects.create(post=cls.other, author=cls.user, text='Ок')
+        Comment.objects.create(post=cls.post, author=cls.author, text='Нет')
+        Follow.objects.create(user=cls.user, author=cls.author)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def export(self, **params):
+        response = self.client.get(reverse('posts:export'), params)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_jsonl(self):
+        response, content = self.export()
+        self.assertIn('yatube-exporter.jsonl', response['Content-Disposition'])
+        records = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([record['type'] for record in records],
+                         ['post', 'comment', 'follow'])
+        self.assertEqual(records[0]['group'], 'export')
+        self.assertEqual(records[1]['post'], self.other.pk)
+        self.assertEqual(records[2]['author'], 'exported')
+
+    def test_csv(self):
+        response, content = self.export(format='csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(StringIO(content)))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['text'], 'Мой пост, с запятой')
+        self.assertEqual(rows[1]['type'], 'comment')
+
+    def test_requires_login(self):
+        response = Client().get(reverse('posts:export'))
+        self.assertEqual(response.status_code, 302)
+
+
+class TestPendingDeletion(TestCase):
+    '''Объекты, ожидающие удаления, сразу пропадают с сайта'''
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create(username='leaving')
+        cls.reader = User.objects.create(username='reader')
+        cls.group = Group.objects.create(
+            title='Group', slug='group', description='Description')
+        cls.post = Post.objects.create(
+            text='Hidden', author=cls.author, group=cls.group)
+        cls.kept = Post.objects.create(
+            text='Kept', author=cls.reader, group=cls.group)
+        Comment.objects.create(post=cls.kept, author=cls.author, text='Gone')
+        Follow.objects.create(user=cls.reader, author=cls.author)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.reader)
+
+    def test_user_hidden(self):
+        self.client.get(reverse('posts:index'))
+        deletion.schedule_user_deletion(User.objects.get(pk=self.author.pk))
+        response = self.client.get(reverse('posts:index'))
+        self.assertEqual(list(response.context['page_obj']), [self.kept])
+        self.assertEqual(response.context['page_obj'].paginator.count, 1)
+        response = self.client.get(reverse('posts:group_list', args=['group']))
+        self.assertEqual(response.context['page_obj'].paginator.count, 1)
+        for url in (
+            reverse('posts:profile', args=[self.author.username]),
+            reverse('posts:post_detail', args=[self.post.pk]),
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+        response = self.client.get(
+            reverse('posts:post_detail', args=[self.kept.pk]))
+        self.assertFalse(response.context['comments'])
+        response = self.client.get(reverse('posts:follow_index'))
+        self.assertFalse(list(response.context['page_obj']))
+        response = self.client.get(reverse('posts:search'), {'q': 'hidden'})
+        self.assertFalse(list(response.context['page_obj']))
+
+    def test_group_hidden(self):
+        self.client.get(reverse('posts:group_list', args=['group']))
+        deletion.schedule_group_deletion(Group.objects.get(pk=self.group.pk))
+        response = self.client.get(reverse('posts:group_list', args=['group']))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('posts:post_create'))
+        self.assertFalse(response.context['form'].fields['group'].queryset)
+        # ссылки на группу не ведут на 404
+        for url in (
+            reverse('posts:index'),
+            reverse('posts:post_detail', args=[self.kept.pk]),
+        ):
+            with self.subTest(url=url):
+                self.assertNotContains(
+                    self.client.get(url),
+                    reverse('posts:group_list', args=['group']))
+
+    def test_deactivated_author_visible(self):
+        User.objects.filter(pk=self.author.pk).update(is_active=False)
+        response = self.client.get(reverse('posts:index'))
+        self.assertEqual(len(response.context['page_obj']), 2)
+        response = self.client.get(
+            reverse('posts:profile', args=[self.author.username]))
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, THUMBNAIL_WORKERS=0)
+class TestThumbnails(TransactionTestCase):
+    '''Миниатюры строятся после сохранения поста, а не при показе'''
+    small_gif = (
+        b'\x47\x49\x46\x38\x39\x61\x02\x00'
+        b'\x01\x00\x80\x00\x00\x00\x00\x00'
+        b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
+        b'\x00\x00\x00\x2C\x00\x00\x00\x00'
+        b'\x02\x00\x01\x00\x00\x02\x02\x0C'
+        b'\x0A\x00\x3B'
+    )
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='photographer')
+        self.client.force_login(self.user)
+
+    def upload(self, name):
+        return SimpleUploadedFile(name, self.small_gif, 'image/gif')
+
+    # THUMBNAIL_WORKERS=0: миниатюры строятся прямо в запросе, и их
+    # запросы к kvstore не относятся к бюджету представления
+    @override_settings(QUERY_BUDGET_STRICT=False)
+    def test_generated_on_create_and_edit(self):
+        self.client.post(reverse('posts:post_create'), {
+            'text': 'С картинкой', 'image': self.upload('first.gif')})
+        post = Post.objects.get()
+        thumbnail = thumbnails.ready_thumbnail(post.image)
+        self.assertIsNotNone(thumbnail)
+        response = self.client.get(reverse('posts:index'))
+        self.assertContains(response, f'src="{thumbnail.url}"')
+        self.client.post(reverse('posts:post_edit', args=[post.pk]), {
+            'text': 'Новая картинка', 'image': self.upload('second.gif')})
+        post.refresh_from_db()
+        self.assertIsNotNone(thumbnails.ready_thumbnail(post.image))
+
+    def test_placeholder_until_ready(self):
+        post = Post(text='Ждёт', author=self.user)
+        post.image.save('pending.gif', ContentFile(self.small_gif),
+                        save=False)
+        with mock.patch.object(thumbnails, 'schedule') as schedule:
+            post.save()
+            response = self.client.get(reverse('posts:index'))
+        self.assertNotContains(response, 'card-img my-2" src')
+        self.assertContains(response, 'Картинка обрабатывается')
+        # показ заглушки ставит генерацию для старых картинок
+        self.assertEqual(schedule.call_count, 2)
+        # но не при каждом показе: битая картинка не гоняет PIL по кругу
+        with mock.patch.object(thumbnails, 'schedule') as schedule:
+            thumbnails.schedule_missing(post)
+        schedule.assert_not_called()
+
+    def kvstore_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        return [query['sql'] for query in queries
+                if 'thumbnail_kvstore' in query['sql']]
+
+    def test_page_resolved_in_one_batch(self):
+        for number in range(3):
+            post = Post(text=f'Пост {number}', author=self.user)
+            post.image.save(f'batch{number}.gif',
+                            ContentFile(self.small_gif))
+        url = reverse('posts:index')
+        cache.clear()
+        thumbnails._urls.clear()
+        self.assertEqual(len(self.kvstore_queries(url)), 1)
+        # дальше URL берутся из LRU процесса, без kvstore и его кеша
+        cache.clear()
+        self.assertEqual(self.kvstore_queries(url), [])
+        response = self.client.get(url)
+        self.assertEqual(
+            response.content.decode().count('card-img my-2" src'), 3)
+
+    @override_settings(POST_IMAGE_WIDTHS=(480, 960), POST_IMAGE_FORMATS=(
+        'WEBP',))
+    def test_responsive_variants(self):
+        post = Post(text='Адаптивная', author=self.user)
+        post.image.save('responsive.gif', ContentFile(self.small_gif))
+        picture = thumbnails.resolve([post.image])[post.image.name]
+        self.assertTrue(picture['complete'])
+        self.assertEqual(picture['srcset'].count('w, '), 1)
+        self.assertIn(' 480w', picture['srcset'])
+        [source] = picture['sources']
+        self.assertEqual(source['type'], 'image/webp')
+        self.assertEqual(source['srcset'].count('.webp'), 2)
+        response = self.client.get(reverse('posts:index'))
+        self.assertContains(response, '<source type="image/webp"')
+        self.assertContains(response, f'srcset="{picture["srcset"]}"')
+
+    def test_backfill(self):
+        group = Group.objects.create(
+            title='Backfill', slug='backfill', description='Description')
+        post = Post(text='Старая', author=self.user, group=group)
+        with mock.patch.object(thumbnails, 'schedule'):
+            post.image.save('old.gif', ContentFile(self.small_gif))
+        self.assertIsNone(thumbnails.resolve([post.image])[post.image.name])
+        author_generation = feed_cache.author_generation(self.user.pk)
+        group_generation = feed_cache.group_generation(group.pk)
+        out = StringIO()
+        call_command('backfill_thumbnails', workers=0, stdout=out)
+        self.assertIn('дополнено: 1', out.getvalue())
+        self.assertNotEqual(
+            feed_cache.author_generation(self.user.pk), author_generation)
+        self.assertNotEqual(
+            feed_cache.group_generation(group.pk), group_generation)
+        picture = thumbnails.resolve([post.image])[post.image.name]
+        self.assertTrue(picture['complete'])
+        out = StringIO()
+        call_command('backfill_thumbnails', workers=0, stdout=out)
+        self.assertIn('дополнено: 0', out.getvalue())
+
+    @override_settings(THUMBNAIL_WORKERS=2)
+    def test_submitted_to_pool_once(self):
+        executor = mock.Mock()
+        with mock.patch(
+                'core.background._get_executor', return_value=executor):
+            thumbnails._submit('posts/a.gif', self.user.pk, None)
+            thumbnails._submit('posts/a.gif', self.user.pk, None)
+        executor.submit.assert_called_once_with(
+            thumbnails._generate, 'posts/a.gif', self.user.pk, None)
+        callback = executor.submit.return_value.add_done_callback
+        callback.call_args[0][0](None)
+        self.assertNotIn('posts/a.gif', thumbnails._pending)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class TestImageMetadata(TestCase):
+    '''Сведения о картинке сохраняются при загрузке, дубли не копируются'''
+    gif = TestThumbnails.small_gif
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.user = User.objects.create(username='uploader')
+        self.client.force_login(self.user)
+
+    def create(self, name, content):
+        self.client.post(reverse('posts:post_create'), {
+            'text': name,
+            'image': SimpleUploadedFile(name, content, 'image/gif'),
+        })
+        return Post.objects.get(text=name)
+
+    def test_metadata_saved(self):
+        post = self.create('meta.gif', self.gif)
+        digest = hashlib.sha256(self.gif).hexdigest()
+        self.assertEqual((post.image_width, post.image_height), (2, 1))
+        self.assertEqual(post.image_size, len(self.gif))
+        self.assertEqual(post.image_hash, digest)
+        self.assertEqual(
+            post.image.name, f'posts/{digest[:2]}/{digest[2:4]}/{digest}.gif')
+        self.client.post(reverse('posts:post_edit', args=[post.pk]), {
+            'text': 'Без картинки', 'image-clear': 'on'})
+        post.refresh_from_db()
+        self.assertEqual(post.image_hash, '')
+        self.assertIsNone(post.image_size)
+
+    def test_duplicates_share_file(self):
+        first = self.create('first.gif', self.gif)
+        second = self.create('duplicate.gif', self.gif)
+        self.assertEqual(second.image.name, first.image.name)
+        self.assertFalse(os.path.exists(
+            os.path.join(TEMP_MEDIA_ROOT, 'posts', 'duplicate.gif')))
+        other = self.create('other.gif', self.gif + b'\x00')
+        self.assertNotEqual(other.image.name, first.image.name)
+
+    def test_backfill(self):
+        storage = Post._meta.get_field('image').storage
+        first = storage.save('posts/legacy.gif', ContentFile(self.gif))
+        copy = storage.save('posts/legacy-copy.gif', ContentFile(self.gif))
+        Post.objects.bulk_create([
+            Post(text='Старый', author=self.user, image=first),
+            Post(text='Копия', author=self.user, image=copy),
+            Post(text='Потерян', author=self.user, image='posts/lost.gif'),
+        ])
+        out = StringIO()
+        call_command('backfill_image_metadata', batch_size=1, stdout=out)
+        self.assertIn('описано: 2, переведено на общий файл: 1, '
+                      'файлов не найдено: 1', out.getvalue())
+        self.assertEqual(Post.objects.get(text='Копия').image.name, first)
+        self.assertEqual(Post.objects.get(text='Старый').image_width, 2)
+
+    def test_shard_media(self):
+        storage = Post._meta.get_field('image').storage
+        flat = storage.save('posts/flat.gif', ContentFile(self.gif))
+        group = Group.objects.create(
+            title='Shard', slug='shard', description='Description')
+        Post.objects.bulk_create([
+            Post(text='Плоский', author=self.user, image=flat, group=group),
+            Post(text='Тоже', author=self.user, image=flat),
+            Post(text='Потерян', author=self.user, image='posts/lost.gif'),
+        ])
+        group_generation = feed_cache.group_generation(group.pk)
+        out = StringIO()
+        call_command('shard_media', workers=0, batch_size=2,
+                     delete_old=True, stdout=out)
+        self.assertIn('перенесено: 1, не найдено: 1', out.getvalue())
+        self.assertNotEqual(
+            feed_cache.group_generation(group.pk), group_generation)
+        digest = hashlib.sha256(self.gif).hexdigest()
+        name = f'posts/{digest[:2]}/{digest[2:4]}/{digest}.gif'
+        self.assertEqual(
+            set(Post.objects.exclude(text='Потерян').values_list(
+                'image', 'image_hash')), {(name, digest)})
+        self.assertTrue(storage.exists(name))
+        self.assertFalse(storage.exists(flat))
+        # миниатюры готовы к моменту переключения
+        self.assertIsNotNone(thumbnails.resolve([name])[name])
+        out = StringIO()
+        call_command('shard_media', workers=0, stdout=out)
+        self.assertIn('перенесено: 0', out.getvalue())
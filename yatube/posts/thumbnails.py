@@ -0,0 +1,284 @@
+"""Миниатюры картинок постов, сгенерированные заранее.
+
+{% thumbnail %} из sorl строит миниатюру при первом показе, и работу PIL
+оплачивает запрос пользователя. Здесь все размеры из POST_THUMBNAILS
+строятся в пуле процессов после сохранения поста, а {% post_image %}
+только заглядывает в kvstore sorl и, пока миниатюры нет, показывает
+заглушку. Когда миниатюры готовы, воркер сбрасывает версии закешированных
+фрагментов лент, чтобы заглушка не задержалась в кеше.
+
+Каждый размер строится в нескольких ширинах (POST_IMAGE_WIDTHS) и
+форматах (основной плюс POST_IMAGE_FORMATS), чтобы шаблон отдал <picture>
+со srcset и браузер сам выбрал вариант под экран.
+
+resolve находит варианты всей страницы разом: один get_many к кешу
+kvstore и один запрос к его таблице для промахов. Готовая миниатюра уже
+не меняется, поэтому полный набор URL запоминается в LRU процесса.
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from sorl.thumbnail import default
+from sorl.thumbnail.base import ThumbnailBackend
+from sorl.thumbnail.conf import defaults as default_settings
+from sorl.thumbnail.conf import settings as thumbnail_settings
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.kvstores.cached_db_kvstore import EMPTY_VALUE
+from sorl.thumbnail.kvstores.cached_db_kvstore import \
+    KVStore as CachedDbKVStore
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from core import background
+
+from . import cache as feed_cache
+
+logger = logging.getLogger(__name__)
+
+
+class PostThumbnailBackend(ThumbnailBackend):
+    def _options(self, source, options):
+        # те же умолчания, что в ThumbnailBackend.get_thumbnail: от них
+        # зависит имя файла миниатюры
+        options = dict(options)
+        if thumbnail_settings.THUMBNAIL_PRESERVE_FORMAT:
+            options.setdefault('format', self._get_format(source))
+        for key, value in self.default_options.items():
+            options.setdefault(key, value)
+        for key, attr in self.extra_options:
+            value = getattr(thumbnail_settings, attr)
+            if value != getattr(default_settings, attr):
+                options.setdefault(key, value)
+        return options
+
+    def thumbnail_file(self, file_, geometry_string, **options):
+        """ImageFile будущей миниатюры: имя без обращения к хранилищу."""
+        source = ImageFile(file_)
+        name = self._get_thumbnail_filename(
+            source, geometry_string, self._options(source, options))
+        return ImageFile(name, default.storage)
+
+    def get_ready_thumbnail(self, file_, geometry_string, **options):
+        """Готовая миниатюра из kvstore или None; ничего не генерирует."""
+        return default.kvstore.get(
+            self.thumbnail_file(file_, geometry_string, **options))
+
+
+backend = PostThumbnailBackend()
+
+
+MIME_TYPES = {
+    'AVIF': 'image/avif',
+    'GIF': 'image/gif',
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+}
+
+
+def variants(size='card'):
+    """Варианты размера: (ширина, формат или None, геометрия, опции).
+
+    Первый — основной: геометрия и формат из POST_THUMBNAILS как есть.
+    Остальные ширины сохраняют его пропорции.
+    """
+    geometry, options = settings.POST_THUMBNAILS[size]
+    width, height = (int(side) for side in geometry.split('x'))
+    widths = [width] + sorted(set(settings.POST_IMAGE_WIDTHS) - {width})
+    result = []
+    for image_format in (None, *settings.POST_IMAGE_FORMATS):
+        for variant_width in widths:
+            variant_options = dict(options)
+            if image_format is not None:
+                variant_options['format'] = image_format
+            variant_height = round(height * variant_width / width)
+            result.append((
+                variant_width, image_format,
+                f'{variant_width}x{variant_height}', variant_options))
+    return result
+
+
+def ready_thumbnail(image, size='card'):
+    geometry, options = settings.POST_THUMBNAILS[size]
+    return backend.get_ready_thumbnail(image, geometry, **options)
+
+
+_urls = OrderedDict()
+_urls_lock = threading.Lock()
+
+
+def _remember(key, url):
+    with _urls_lock:
+        _urls[key] = url
+        _urls.move_to_end(key)
+        while len(_urls) > settings.THUMBNAIL_URL_CACHE_SIZE:
+            _urls.popitem(last=False)
+
+
+def _recall(keys):
+    with _urls_lock:
+        found = {key: _urls[key] for key in keys if key in _urls}
+        for key in found:
+            _urls.move_to_end(key)
+    return found
+
+
+def _fetch(keys):
+    """Сырые значения kvstore по ключам: кеш пачкой, затем база."""
+    kvstore = default.kvstore
+    if not isinstance(kvstore, CachedDbKVStore):
+        return {key: kvstore._get_raw(key) for key in keys}
+    values = kvstore.cache.get_many(keys)
+    missing = [key for key in keys if key not in values]
+    if missing:
+        found = dict(KVStoreModel.objects.filter(
+            key__in=missing).values_list('key', 'value'))
+        # как и сам sorl, запоминаем и отсутствие записи
+        kvstore.cache.set_many(
+            {key: found.get(key, EMPTY_VALUE) for key in missing},
+            thumbnail_settings.THUMBNAIL_CACHE_TIMEOUT)
+        values.update(found)
+    return {
+        key: value for key, value in values.items()
+        if value is not None and value is not EMPTY_VALUE
+    }
+
+
+def _srcset(urls):
+    return ', '.join(f'{url} {width}w' for width, url in urls)
+
+
+def _picture(size_variants, urls):
+    # urls: {(ширина, формат): url} готовых вариантов
+    base_width, base_format = size_variants[0][:2]
+    if (base_width, base_format) not in urls:
+        return None
+    by_format = {}
+    for width, image_format, _, _ in size_variants:
+        if (width, image_format) in urls:
+            by_format.setdefault(image_format, []).append(
+                (width, urls[width, image_format]))
+    return {
+        'src': urls[base_width, base_format],
+        'srcset': _srcset(sorted(by_format.pop(None))),
+        'sources': [
+            {'type': MIME_TYPES.get(image_format),
+             'srcset': _srcset(sorted(widths))}
+            for image_format, widths in by_format.items()
+        ],
+        'complete': len(urls) == len(size_variants),
+    }
+
+
+def resolve(images, size='card'):
+    """{имя картинки: варианты для <picture> или None} одной пачкой.
+
+    images — картинки (FieldFile) или их имена. None — основная миниатюра
+    ещё не построена.
+    """
+    size_variants = variants(size)
+    names = {str(image) for image in images if image}
+    result = _recall([(name, size) for name in names])
+    result = {name: result.get((name, size)) for name in names}
+    keys = {}
+    for name in names:
+        if result[name] is not None:
+            continue
+        for width, image_format, geometry, options in size_variants:
+            thumbnail = backend.thumbnail_file(name, geometry, **options)
+            keys[add_prefix(thumbnail.key)] = (name, width, image_format)
+    if not keys:
+        return result
+    urls = {}
+    for key, value in _fetch(list(keys)).items():
+        name, width, image_format = keys[key]
+        urls.setdefault(name, {})[width, image_format] = (
+            deserialize_image_file(value).url)
+    for name, found in urls.items():
+        result[name] = _picture(size_variants, found)
+        # недостроенный набор ещё дополнится, его не запоминаем
+        if result[name] is not None and result[name]['complete']:
+            _remember((name, size), result[name])
+    return result
+
+
+def generate(name):
+    """Строит все варианты всех размеров из POST_THUMBNAILS."""
+    for size in settings.POST_THUMBNAILS:
+        for _, _, geometry, options in variants(size):
+            backend.get_thumbnail(name, geometry, **options)
+
+
+def generate_safely(name):
+    """generate без исключений: True, если все варианты построены."""
+    try:
+        generate(name)
+    except Exception:
+        logger.exception('Не удалось построить миниатюры %s', name)
+        return False
+    return True
+
+
+def _generate(name, author_id, group_id):
+    if not generate_safely(name):
+        return
+    feed_cache.bump_feed_version()
+    feed_cache.bump_group_generation(group_id)
+    feed_cache.bump_author_generation(author_id)
+
+
+# картинки, уже отправленные в пул этим процессом
+_pending = set()
+_lock = threading.Lock()
+
+
+def _done(name):
+    with _lock:
+        _pending.discard(name)
+
+
+def _submit(name, author_id, group_id):
+    with _lock:
+        if name in _pending:
+            return
+        _pending.add(name)
+    try:
+        future = background.submit(
+            _generate, name, author_id, group_id,
+            workers='THUMBNAIL_WORKERS')
+    except BaseException:
+        _done(name)
+        raise
+    if future is None:
+        _done(name)
+    else:
+        future.add_done_callback(lambda future: _done(name))
+
+
+def schedule(post):
+    """Ставит генерацию миниатюр картинки поста после коммита."""
+    if not post.image:
+        return
+    name = post.image.name
+    transaction.on_commit(
+        lambda: _submit(name, post.author_id, post.group_id))
+
+
+def schedule_missing(post):
+    """Ставит генерацию для картинки, показанной с заглушкой.
+
+    Не чаще раза в THUMBNAIL_RETRY_TIMEOUT на картинку для всех процессов
+    сразу (cache.add атомарен, см. core.cache): иначе битая картинка
+    ставила бы задачу PIL при каждом показе.
+    """
+    if not post.image:
+        return
+    digest = hashlib.sha1(post.image.name.encode()).hexdigest()
+    if cache.add(f'posts:thumbnail:retry:{digest}', True,
+                 settings.THUMBNAIL_RETRY_TIMEOUT):
+        schedule(post)
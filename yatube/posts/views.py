@@ -1,78 +1,151 @@
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.models import User
 from django.core.paginator import Paginator
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
-from django.views.decorators.cache import cache_page
-
-from .forms import CommentForm, PostForm
-from .models import Follow, Group, Post
+from django.utils.http import urlencode
 
+from core.queries import query_budget
+from core.routers import replica_reads
 
-def paginator(request, object):
-    paginator = Paginator(object, settings.POSTS_PER_PAGE)
+from . import autocomplete as completions
+from . import cache as feed_cache
+from . import counters, export, feeds
+from .forms import CommentForm, PostForm
+from .models import Follow, Post
+from .paginators import CountedPaginator, CursorPaginator
+from .search import SEARCH_ORDERING, search_posts
+
+
+def paginator(request, object, ordering=('-pub_date', '-id'), count=None):
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    if settings.POSTS_PAGINATION == 'cursor' or after or before:
+        return CursorPaginator(
+            object, settings.POSTS_PER_PAGE, ordering=ordering
+        ).get_page(after=after, before=before)
+    if count is None:
+        paginator = Paginator(object, settings.POSTS_PER_PAGE)
+    else:
+        paginator = CountedPaginator(object, settings.POSTS_PER_PAGE, count)
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
     return page_obj
 
 
-@cache_page(20, key_prefix='index_page')
+@query_budget(6)
+@replica_reads
 def index(request):
     template = 'posts/index.html'
-    post_list = Post.objects.all()
+    post_list = Post.objects.visible().select_related('author', 'group')
+    page_obj = paginator(request, post_list, count=counters.posts_total)
     context = {
-        'page_obj': paginator(request, post_list)
+        'page_obj': page_obj,
+        **feed_cache.cache_context(page_obj, feed_cache.feed_version()),
     }
     return render(request, template, context)
 
 
 # В урл мы ждем парметр, и нужно его прередать в функцию для использования
+@query_budget(7)
+@replica_reads
 def group_posts(request, slug):
     template = 'posts/group_list.html'
-    group = get_object_or_404(Group, slug=slug)
-    posts = group.group_posts.all()
+    group = feed_cache.get_group_or_404(slug)
+    posts = group.group_posts.visible().select_related('author', 'group')
+    page_obj = paginator(
+        request, posts, count=lambda: counters.group_posts_total(group))
     context = {
-        'page_obj': paginator(request, posts),
+        'page_obj': page_obj,
         'group': group,
+        **feed_cache.cache_context(
+            page_obj, feed_cache.group_generation(group.pk)),
     }
     return render(request, template, context)
 
 
+@query_budget(7)
+@replica_reads
 def profile(request, username):
-    author = get_object_or_404(User, username=username)
-    posts = author.posts.all()
+    author = feed_cache.get_author_or_404(username)
+    posts = author.posts.select_related('author', 'group')
     template = 'posts/profile.html'
     if request.user.is_authenticated:
         following = Follow.objects.filter(
             user=request.user, author=author).exists()
     else:
         following = False
+    posts_count = counters.stats_for(author).posts_count
+    page_obj = paginator(request, posts, count=posts_count)
     context = {
-        'page_obj': paginator(request, posts),
-        'posts_count': author.posts.count(),
+        'page_obj': page_obj,
+        'posts_count': posts_count,
         'author': author,
         'following': following,
+        **feed_cache.cache_context(
+            page_obj, feed_cache.author_generation(author.pk)),
     }
     return render(request, template, context)
 
 
+@query_budget(5)
+@replica_reads
 def post_detail(request, post_id):
-    post = get_object_or_404(Post, id=post_id)
+    post = get_object_or_404(
+        Post.objects.visible().select_related('author__stats', 'group'),
+        id=post_id)
     template = 'posts/post_detail.html'
-    comments = post.comments.all()
+    comments = post.comments.exclude(
+        author__stats__pending_deletion=True).select_related('author')
     form = CommentForm(request.POST or None)
     context = {
         'post': post,
+        'posts_count': counters.stats_for(post.author).posts_count,
         'form': form,
         'comments': comments,
     }
     return render(request, template, context)
 
 
+@query_budget(4)
+@replica_reads
+def search(request):
+    template = 'posts/search.html'
+    query = request.GET.get('q', '').strip()
+    page_obj = None
+    if query:
+        page_obj = CursorPaginator(
+            search_posts(query), settings.POSTS_PER_PAGE,
+            ordering=SEARCH_ORDERING,
+        ).get_page(
+            after=request.GET.get('after'),
+            before=request.GET.get('before'),
+        )
+    context = {
+        'query': query,
+        'page_obj': page_obj,
+        'page_query': urlencode({'q': query}),
+    }
+    return render(request, template, context)
+
+
+@query_budget(2)
+def autocomplete(request):
+    query = request.GET.get('q', '')
+    try:
+        limit = int(request.GET.get('limit', settings.AUTOCOMPLETE_LIMIT))
+    except ValueError:
+        limit = settings.AUTOCOMPLETE_LIMIT
+    limit = max(0, min(limit, settings.AUTOCOMPLETE_LIMIT))
+    results = completions.search(query, limit) if query.strip() else []
+    return JsonResponse({'results': results})
+
+
 @login_required
+@query_budget(8)
 def post_create(request):
     template = 'posts/create.html'
-    form = PostForm(request.POST or None)
+    form = PostForm(request.POST or None, files=request.FILES or None)
     if form.is_valid():
         post = form.save(commit=False)
         post.author = request.user
@@ -85,6 +158,7 @@ def post_create(request):
 
 
 @login_required
+@query_budget(6)
 def post_edit(request, post_id):
     post = get_object_or_404(Post, id=post_id)
     form = PostForm(
@@ -92,7 +166,7 @@ def post_edit(request, post_id):
         files=request.FILES or None,
         instance=post,)
     template = 'posts/create.html'
-    if request.user != post.author:
+    if post.author_id != request.user.pk:
         return redirect('posts:post_detail', post_id)
 
     if form.is_valid():
@@ -107,9 +181,10 @@ def post_edit(request, post_id):
 
 
 @login_required
+@query_budget(5)
 def add_comment(request, post_id):
     # Получите пост и сохраните его в переменную post.
-    post = get_object_or_404(Post, id=post_id)
+    post = get_object_or_404(Post.objects.visible(), id=post_id)
     form = CommentForm(request.POST or None)
     template = 'posts/post_detail.html'
     context = {
@@ -125,20 +200,41 @@ def add_comment(request, post_id):
 
 
 @login_required
+@query_budget(2)
+def export_content(request):
+    output_format = request.GET.get('format')
+    if output_format not in export.FORMATS:
+        output_format = 'jsonl'
+    response = StreamingHttpResponse(
+        export.render(export.records(request.user), output_format),
+        content_type=(
+            'text/csv' if output_format == 'csv' else 'application/jsonl'),
+    )
+    response['Content-Disposition'] = (
+        'attachment; '
+        f'filename="yatube-{request.user.username}.{output_format}"')
+    return response
+
+
+@login_required
+@query_budget(6)
+@replica_reads
 def follow_index(request):
     template = 'posts/follow.html'
-    posts = Post.objects.filter(
-        author__following__user=request.user
-    ).select_related('author', 'group')
+    posts = feeds.follow_feed(request.user)
+    page_obj = paginator(
+        request, posts, ordering=feeds.FEED_ORDERING,
+        count=lambda: feeds.bounded_count(posts))
     context = {
-        'page_obj': paginator(request, posts),
+        'page_obj': page_obj,
     }
     return render(request, template, context)
 
 
 @login_required
+@query_budget(12)
 def profile_follow(request, username):
-    author = get_object_or_404(User, username=username)
+    author = feed_cache.get_author_or_404(username)
     if request.user != author:
         Follow.objects.get_or_create(
             user=request.user,
@@ -148,8 +244,9 @@ def profile_follow(request, username):
 
 
 @login_required
+@query_budget(10)
 def profile_unfollow(request, username):
-    author = get_object_or_404(User, username=username)
+    author = feed_cache.get_author_or_404(username)
     follow = Follow.objects.filter(
         user=request.user,
         author=author
@@ -49,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.QueryCountMiddleware',
+    'core.middleware.ReplicaPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -88,9 +90,70 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # секунды жизни соединения между запросами, 0 — новое на каждый
+        'CONN_MAX_AGE': int(os.environ.get('YATUBE_DB_CONN_MAX_AGE', 60)),
     }
 }
 
+# Реплики только для чтения (core.routers): пути к копиям базы через
+# запятую. В тестах реплики зеркалируют default.
+DATABASE_REPLICAS = []
+for number, path in enumerate(
+        filter(None, os.environ.get('YATUBE_DB_REPLICAS', '').split(',')), 1):
+    DATABASES[f'replica{number}'] = {
+        **DATABASES['default'],
+        'NAME': path,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{number}')
+
+DATABASE_ROUTERS = ['core.routers.ReplicaRouter']
+# Сколько секунд после записи клиент читает только с основной базы; столько
+# же живут закешированные значения, прочитанные с реплики
+REPLICA_PIN_SECONDS = 10
+
+# Выполняются на каждом новом соединении SQLite (core.db)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+    # отрицательное значение — размер в КиБ, а не в страницах
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+
+
+# Cache
+# L1 — LRU в памяти процесса, L2 — общий для процессов бэкенд. Ключи версий
+# и блокировок живут только в L2, чтобы инвалидация была видна всем сразу.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'core.cache.TwoTierCache',
+        'OPTIONS': {
+            'L2': 'shared',
+            'L1_TIMEOUT': 5,
+            'L1_MAX_BYTES': 32 * 1024 * 1024,
+            'L2_ONLY_PREFIXES': ('posts:version:', 'posts:lock:'),
+            # add() в FileBasedCache идёт под файлом-замком (core.cache);
+            # замок старше этого числа секунд считается брошенным
+            'ADD_LOCK_TIMEOUT': 10,
+        },
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get(
+            'YATUBE_CACHE_DIR', os.path.join(BASE_DIR, 'cache')),
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
+# Тесты работают с кешем во временном каталоге, а не в BASE_DIR/cache
+TEST_RUNNER = 'core.testing.TestRunner'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -133,6 +196,84 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = (os.path.join(BASE_DIR, 'static'),)
 
 POSTS_PER_PAGE = 10
+# 'offset' — нумерованные страницы (?page=), 'cursor' — keyset-пагинация
+# (?after=/?before=). Курсорный режим включается и при наличии токена.
+POSTS_PAGINATION = 'offset'
+# Размер пачки при раскладке постов по материализованным лентам подписок
+FEED_BATCH_SIZE = 1000
+# При переносе постов автора в ленты (подписка, возврат к раскладке,
+# пересборка) берутся только столько последних: старые посты в ленте
+# подписок почти не читают, а перенос остаётся ограниченным
+FEED_BACKFILL_POSTS = 200
+# Посты авторов с большим числом подписчиков не раскладываются по лентам,
+# а подмешиваются при чтении
+FEED_FANOUT_FOLLOWER_LIMIT = 10000
+# Обратно к раскладке автор переводится, только опустившись до этого числа
+# подписчиков: колебания около порога не гоняют перенос постов туда-обратно
+FEED_FANOUT_DEMOTE_LIMIT = 9000
+FEED_CELEBRITIES_CACHE_TIMEOUT = 300
+# Фрагменты лент инвалидируются версией, поэтому TTL может быть долгим
+FEED_CACHE_TIMEOUT = 60 * 60 * 24
+# Сколько секунд после истечения можно отдавать устаревший фрагмент,
+# пока его пересчитывает другой воркер
+FEED_CACHE_STALE_TIMEOUT = 60
+# Время жизни блокировки пересчёта и шаг опроса ожидающих воркеров
+FEED_CACHE_LOCK_TIMEOUT = 10
+FEED_CACHE_LOCK_POLL = 0.05
+# Коэффициент вероятностного раннего истечения (XFetch), 0 — выключено
+FEED_CACHE_EARLY_BETA = 1.0
+# Кеш поиска групп по slug и авторов по username
+LOOKUP_CACHE_TIMEOUT = 60 * 60
+# До этого числа постов общая лента считается точно (COUNT с LIMIT),
+# выше — оценивается по диапазону первичных ключей
+POSTS_COUNT_EXACT_LIMIT = 10000
+POSTS_COUNT_TIMEOUT = 60 * 60 * 24
+# Автодополнение авторов и групп (posts.autocomplete): наибольшее число
+# подсказок и как часто сверять индекс с изменениями других процессов
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_REFRESH = 5
+# Миниатюры картинок постов: {% post_image post 'card' %} в шаблонах.
+# Строятся заранее после сохранения поста (posts.thumbnails) в пуле из
+# THUMBNAIL_WORKERS процессов; 0 — прямо в процессе, после коммита.
+POST_THUMBNAILS = {
+    'card': ('960x339', {'crop': 'center', 'upscale': True}),
+}
+# Адаптивные варианты каждого размера: ширины (пропорции как у основной
+# геометрии) и форматы в дополнение к основному для <source> в <picture>
+POST_IMAGE_WIDTHS = (480, 960, 1440)
+POST_IMAGE_FORMATS = ('WEBP',)
+# Атрибут sizes: какой ширины карточка на экране
+POST_IMAGE_SIZES = '(min-width: 1200px) 960px, 100vw'
+THUMBNAIL_WORKERS = 2
+# Как часто можно повторять генерацию для картинки, показанной без миниатюр
+THUMBNAIL_RETRY_TIMEOUT = 60 * 60
+# Процессы для прочих фоновых заданий (core.background); 0 — прямо в
+# процессе, после коммита
+BACKGROUND_WORKERS = 1
+# Сколько URL готовых миниатюр помнить в памяти процесса
+THUMBNAIL_URL_CACHE_SIZE = 10000
+# Сколько строк читать из базы за раз при выгрузке (posts.export)
+EXPORT_CHUNK_SIZE = 2000
+# Превышение бюджета SQL-запросов (@query_budget) — исключение, а не
+# предупреждение в логе. В тестах включено всегда (core.testing.TestRunner)
+QUERY_BUDGET_STRICT = False
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'core.queries': {
+            'handlers': ['console'],
+            'level': os.environ.get('QUERY_LOG_LEVEL', 'WARNING'),
+            'propagate': False,
+        },
+    },
+}
 
 LOGIN_URL = 'users:login'
 LOGIN_REDIRECT_URL = 'posts:index'